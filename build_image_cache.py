@@ -0,0 +1,59 @@
+import argparse
+import os
+
+import numpy as np
+from fvcore.common.file_io import PathManager
+
+from detectron2.config import get_cfg
+from detectron2.utils.logger import setup_logger
+
+from core import add_config
+from core.image_cache import ImageCache, image_cache_params
+
+
+def setup_cfg(args):
+    cfg = get_cfg()
+    add_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    return cfg
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Pre-resize the images of some splits into an image cache")
+    parser.add_argument(
+        "--config-file",
+        default="configs/M-OWODB/t1.yaml",
+        metavar="FILE",
+        help="path to config file, its INPUT options decide the resize",
+    )
+    parser.add_argument("--dataset-root", default="./datasets/", help="contains ImageSets and JPEGImages")
+    parser.add_argument("--splits", nargs="+", default=["M-OWODB/test"], help="image sets to cache, e.g. M-OWODB/test")
+    parser.add_argument("--train", action="store_true", help="cache the training resize instead of the test one")
+    parser.add_argument("--num-workers", type=int, default=8, help="processes decoding and resizing the images")
+    parser.add_argument(
+        "--opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=[],
+        nargs=argparse.REMAINDER,
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    logger = setup_logger(name="core")
+    cfg = setup_cfg(args)
+    assert cfg.INPUT.IMAGE_CACHE_DIR, "Set INPUT.IMAGE_CACHE_DIR to the cache directory"
+    params = image_cache_params(cfg, args.train)
+    assert params is not None, "The training resize isn't deterministic, there is nothing to cache"
+
+    file_names = []
+    for split in args.splits:
+        with PathManager.open(os.path.join(args.dataset_root, "ImageSets", "Main", split + ".txt")) as f:
+            fileids = np.atleast_1d(np.loadtxt(f, dtype=np.str_)).tolist()
+        # the same file names as load_voc_instances
+        file_names.extend(os.path.join(args.dataset_root, "JPEGImages", fileid + ".jpg") for fileid in fileids)
+    cache = ImageCache.build(cfg.INPUT.IMAGE_CACHE_DIR, file_names, *params, num_workers=args.num_workers)
+    logger.info("{} images cached in {}".format(len(cache), cache.path))
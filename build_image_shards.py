@@ -0,0 +1,52 @@
+import argparse
+
+from detectron2.config import get_cfg
+from detectron2.utils.logger import setup_logger
+
+from core import add_config
+from core.image_shards import ImageShards
+from core.pascal_voc import VOC_COCO_CLASS_NAMES, load_voc_instances
+
+
+def setup_cfg(args):
+    cfg = get_cfg()
+    add_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    return cfg
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Pack the training images of a task into image shards")
+    parser.add_argument(
+        "--config-file",
+        default="configs/M-OWODB/t1.yaml",
+        metavar="FILE",
+        help="path to config file, its TEST options decide the annotations of the task",
+    )
+    parser.add_argument("--dataset-root", default="./datasets/", help="contains ImageSets and JPEGImages")
+    parser.add_argument("--task", default="M-OWODB/t1", help="the --task given to train_net.py")
+    parser.add_argument("--shard-size-mb", type=int, default=512, help="size of a shard file")
+    parser.add_argument("--num-workers", type=int, default=8, help="threads reading the images")
+    parser.add_argument(
+        "--opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=[],
+        nargs=argparse.REMAINDER,
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    setup_logger(name="core")
+    cfg = setup_cfg(args)
+    assert cfg.DATALOADER.IMAGE_SHARD_DIR, "Set DATALOADER.IMAGE_SHARD_DIR to the shard directory"
+
+    # the same dataset dicts as the "my_train" dataset of train_net.py
+    class_names = VOC_COCO_CLASS_NAMES[args.task.split("/")[0]]
+    dataset_dicts = load_voc_instances(args.dataset_root, args.task, class_names, cfg)
+    shards = ImageShards.write(cfg.DATALOADER.IMAGE_SHARD_DIR, args.task, dataset_dicts,
+                               shard_size=args.shard_size_mb << 20, num_workers=args.num_workers)
+    print("{} images packed into {} shards in {}".format(len(shards), shards.num_shards, shards.path))
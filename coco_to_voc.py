@@ -1,42 +1,136 @@
-import xml.etree.cElementTree as ET
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import xml.etree.cElementTree as ET
 from pycocotools.coco import COCO
 
+_category_names = {}
+
+
+def _init_worker(category_names):
+    global _category_names
+    _category_names = category_names
+
+
+def coco_to_voc_xml(image_details, annotations, category_names):
+    """The VOC annotation file of one COCO image, as the bytes ``ElementTree.write`` would write."""
+    annotation_el = ET.Element('annotation')
+    ET.SubElement(annotation_el, 'filename').text = image_details['file_name']
+
+    size_el = ET.SubElement(annotation_el, 'size')
+    ET.SubElement(size_el, 'width').text = str(image_details['width'])
+    ET.SubElement(size_el, 'height').text = str(image_details['height'])
+    ET.SubElement(size_el, 'depth').text = str(3)
+
+    for annotation in annotations:
+        object_el = ET.SubElement(annotation_el, 'object')
+        ET.SubElement(object_el, 'name').text = category_names[annotation['category_id']]
+        # ET.SubElement(object_el, 'name').text = 'unknown'
+        ET.SubElement(object_el, 'difficult').text = '0'
+        bb_el = ET.SubElement(object_el, 'bndbox')
+        ET.SubElement(bb_el, 'xmin').text = str(int(annotation['bbox'][0] + 1.0))
+        ET.SubElement(bb_el, 'ymin').text = str(int(annotation['bbox'][1] + 1.0))
+        ET.SubElement(bb_el, 'xmax').text = str(int(annotation['bbox'][0] + annotation['bbox'][2] + 1.0))
+        ET.SubElement(bb_el, 'ymax').text = str(int(annotation['bbox'][1] + annotation['bbox'][3] + 1.0))
+    return ET.tostring(annotation_el)
+
+
+def _write_atomic(path, data):
+    # write-then-rename, an interrupted run never leaves a truncated file behind
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _convert_images(args):
+    """Write the annotation files of a chunk of images whose content changed, returns their manifest entries."""
+    annotation_dir, images = args
+    results = []
+    for image_details, annotations, previous in images:
+        data = coco_to_voc_xml(image_details, annotations, _category_names)
+        checksum = hashlib.sha1(data).hexdigest()
+        file_name = image_details['file_name'].split('.')[0] + '.xml'
+        path = os.path.join(annotation_dir, file_name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if size != len(data):
+            changed = True
+        elif previous is not None and previous['sha1'] == checksum and previous['bytes'] == size:
+            changed = False  # the manifest vouches for the file, no need to read it
+        else:
+            with open(path, 'rb') as f:
+                changed = hashlib.sha1(f.read()).hexdigest() != checksum
+        if changed:
+            _write_atomic(path, data)
+        entry = {'file': file_name, 'sha1': checksum, 'bytes': len(data), 'width': image_details['width'],
+                 'height': image_details['height'], 'objects': len(annotations)}
+        results.append((image_details['id'], entry, changed))
+    return results
+
+
+def coco_to_voc_detection(coco_annotation_file, target_folder, num_workers=8, chunk_size=500):
+    """
+    Convert the images with annotations in ``coco_annotation_file`` to VOC annotation files, with
+    ``num_workers`` processes.
+
+    Files are only written when their content changes, so a run after a partial failure or a label map change
+    only touches the affected files. The manifest ``<annotation file name>.manifest.json`` in ``target_folder``
+    maps each image id to its annotation file, the sha1 and size in bytes of the file, the image size and the
+    number of objects, and can serve as an index of the annotations.
+    """
+    annotation_dir = os.path.join(target_folder, 'Annotations')
+    os.makedirs(annotation_dir, exist_ok=True)
+    manifest_file = os.path.join(
+        target_folder, os.path.splitext(os.path.basename(coco_annotation_file))[0] + '.manifest.json')
+    previous = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            previous = json.load(f)['images']
 
-def coco_to_voc_detection(coco_annotation_file, target_folder):
-    os.makedirs(os.path.join(target_folder, 'Annotations'), exist_ok=True)
     coco_instance = COCO(coco_annotation_file)
-    for index, image_id in enumerate(coco_instance.imgToAnns):
-        image_details = coco_instance.imgs[image_id]
-        annotation_el = ET.Element('annotation')
-        ET.SubElement(annotation_el, 'filename').text = image_details['file_name']
-
-        size_el = ET.SubElement(annotation_el, 'size')
-        ET.SubElement(size_el, 'width').text = str(image_details['width'])
-        ET.SubElement(size_el, 'height').text = str(image_details['height'])
-        ET.SubElement(size_el, 'depth').text = str(3)
-
-        for annotation in coco_instance.imgToAnns[image_id]:
-            object_el = ET.SubElement(annotation_el, 'object')
-            ET.SubElement(object_el, 'name').text = coco_instance.cats[annotation['category_id']]['name']
-            # ET.SubElement(object_el, 'name').text = 'unknown'
-            ET.SubElement(object_el, 'difficult').text = '0'
-            bb_el = ET.SubElement(object_el, 'bndbox')
-            ET.SubElement(bb_el, 'xmin').text = str(int(annotation['bbox'][0] + 1.0))
-            ET.SubElement(bb_el, 'ymin').text = str(int(annotation['bbox'][1] + 1.0))
-            ET.SubElement(bb_el, 'xmax').text = str(int(annotation['bbox'][0] + annotation['bbox'][2] + 1.0))
-            ET.SubElement(bb_el, 'ymax').text = str(int(annotation['bbox'][1] + annotation['bbox'][3] + 1.0))
-
-        ET.ElementTree(annotation_el).write(
-            os.path.join(target_folder, 'Annotations', image_details['file_name'].split('.')[0] + '.xml'))
-        if index % 10000 == 0:
-            print('Processed ' + str(index) + ' images.')
+    category_names = {category_id: cat['name'] for category_id, cat in coco_instance.cats.items()}
+    images = [(coco_instance.imgs[image_id], anns, previous.get(str(image_id)))
+              for image_id, anns in coco_instance.imgToAnns.items()]
+    chunks = [(annotation_dir, images[i:i + chunk_size]) for i in range(0, len(images), chunk_size)]
+
+    manifest, written = {}, 0
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(category_names,))
+        results = pool.imap_unordered(_convert_images, chunks)
+    else:
+        pool = None
+        _init_worker(category_names)
+        results = map(_convert_images, chunks)
+    try:
+        for chunk_results in results:
+            for image_id, entry, changed in chunk_results:
+                manifest[str(image_id)] = entry
+                written += changed
+            if len(manifest) // 10000 != (len(manifest) - len(chunk_results)) // 10000:
+                print('Processed ' + str(len(manifest)) + ' images.')
+    finally:
+        if pool is not None:
+            pool.terminate()  # every chunk is done unless the conversion failed
+
+    manifest = {'annotation_file': os.path.abspath(coco_annotation_file),
+                'images': {image_id: manifest[image_id] for image_id in sorted(manifest, key=int)}}
+    _write_atomic(manifest_file, json.dumps(manifest).encode())
+    print('Wrote {} of {} annotation files, the others were unchanged.'.format(written, len(images)))
+    return manifest
 
 
 if __name__ == '__main__':
-    coco_train_annotation_file = 'coco/annotations/instances_train2017.json'
-    coco_val_annotation_file = 'coco/annotations/instances_val2017.json'
-    target_folder = 'datasets/Annotations'
+    parser = argparse.ArgumentParser(description='Convert COCO annotations to VOC annotation files')
+    parser.add_argument('--coco-annotation-files', nargs='+', default=[
+        'coco/annotations/instances_train2017.json', 'coco/annotations/instances_val2017.json'])
+    parser.add_argument('--target-folder', default='datasets/Annotations')
+    parser.add_argument('--num-workers', type=int, default=8, help='processes writing the annotation files')
+    args = parser.parse_args()
 
-    coco_to_voc_detection(coco_train_annotation_file, target_folder)
-    coco_to_voc_detection(coco_val_annotation_file, target_folder)
+    for coco_annotation_file in args.coco_annotation_files:
+        coco_to_voc_detection(coco_annotation_file, args.target_folder, args.num_workers)
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import xml.etree.ElementTree as ET
+from collections.abc import Sequence
+
+import numpy as np
+from fvcore.common.file_io import PathManager
+
+from detectron2.structures import BoxMode
+
+__all__ = ["AnnotationIndex", "CompactAnnotations", "load_coco_records", "parse_voc_xml"]
+
+_FORMAT_VERSION = 1
+_ALIGNMENT = 64
+
+
+def parse_voc_xml(anno_file):
+    """
+    Parse one Pascal VOC annotation file.
+
+    Returns (height, width, names, boxes, difficult) with the raw object names, the raw
+    (xmin, ymin, xmax, ymax) boxes and the difficult flags, or None if the file can't be read.
+    """
+    try:
+        with PathManager.open(anno_file) as f:
+            tree = ET.parse(f)
+    except Exception:
+        return None
+
+    names, boxes, difficult = [], [], []
+    for obj in tree.findall("object"):
+        names.append(obj.find("name").text)
+        bbox = obj.find("bndbox")
+        boxes.append([float(bbox.find(x).text) for x in ["xmin", "ymin", "xmax", "ymax"]])
+        flag = obj.find("difficult")
+        difficult.append(0 if flag is None else int(flag.text))
+    height = int(tree.findall("./size/height")[0].text)
+    width = int(tree.findall("./size/width")[0].text)
+    return height, width, names, boxes, difficult
+
+
+def load_coco_records(coco_files, file_ids):
+    """
+    The records of ``file_ids`` found in COCO annotation json files, the same as :func:`parse_voc_xml` returns
+    for the XML files coco_to_voc.py writes: file id -> (height, width, names, boxes, difficult). Images without
+    annotations, which coco_to_voc.py doesn't write, map to None.
+    """
+    file_ids = set(file_ids)
+    records = {}
+    for coco_file in coco_files:
+        with PathManager.open(coco_file) as f:
+            dataset = json.load(f)
+        category_names = {cat["id"]: cat["name"] for cat in dataset["categories"]}
+        images = {}
+        for image in dataset["images"]:
+            file_id = image["file_name"].split(".")[0]
+            if file_id in file_ids:
+                images[image["id"]] = (file_id, (image["height"], image["width"], [], [], []))
+        for annotation in dataset["annotations"]:
+            if annotation["image_id"] not in images:
+                continue
+            _, (_, _, names, boxes, difficult) = images[annotation["image_id"]]
+            x, y, w, h = annotation["bbox"]
+            names.append(category_names[annotation["category_id"]])
+            # the integer coordinates coco_to_voc.py writes
+            boxes.append([float(int(x + 1.0)), float(int(y + 1.0)), float(int(x + w + 1.0)), float(int(y + h + 1.0))])
+            difficult.append(0)
+        del dataset
+        for file_id, record in images.values():
+            records[file_id] = record if record[2] else None
+    return records
+
+
+def _file_key(file_ids, anno_files, coco_files=(), xml_file_ids=None):
+    """
+    Fingerprint of an image set: its file ids and the mtime and size of every COCO json and annotation file.
+    Given ``xml_file_ids``, the images not found in the COCO json files, only their annotation files are looked
+    at.
+    """
+    xml_file_ids = None if xml_file_ids is None else set(xml_file_ids)
+    digest = hashlib.sha1(str(_FORMAT_VERSION).encode())
+    for coco_file in coco_files:
+        stat = os.stat(coco_file)
+        digest.update("{}:{}:{}\n".format(coco_file, stat.st_mtime_ns, stat.st_size).encode())
+    for file_id, anno_file in zip(file_ids, anno_files):
+        if xml_file_ids is not None and file_id not in xml_file_ids:
+            digest.update("{}:coco\n".format(file_id).encode())
+            continue
+        try:
+            stat = os.stat(anno_file)
+            digest.update("{}:{}:{}\n".format(file_id, stat.st_mtime_ns, stat.st_size).encode())
+        except OSError:
+            digest.update("{}:missing\n".format(file_id).encode())
+    return digest.hexdigest()
+
+
+class AnnotationIndex:
+    """
+    Columnar annotations of an image set: one entry per readable annotation file, in image set order.
+
+    Per image: ``file_ids``, ``heights``, ``widths`` and ``offsets`` ([num_images + 1], the objects of
+    image i are ``offsets[i]:offsets[i + 1]``). Per object: the raw ``boxes`` [num_objects, 4] as written
+    in the XML, ``difficult`` and ``name_ids`` into the ``names`` vocabulary. Files that couldn't be read
+    are listed in ``missing``. The images found in COCO annotation json files are read from there instead of
+    their XML, see :func:`load_coco_records`, and ``xml_file_ids`` lists the others (None without json files).
+
+    The index is saved to a single file, a JSON header followed by the raw arrays, that is memory-mapped
+    when loaded. It is keyed by the image set and the annotation mtimes, so stale caches are rebuilt.
+    """
+
+    _ARRAYS = ("file_ids", "heights", "widths", "offsets", "boxes", "difficult", "name_ids")
+
+    def __init__(self, file_ids, heights, widths, offsets, boxes, difficult, name_ids, names, missing=(),
+                 xml_file_ids=None):
+        self.file_ids = file_ids
+        self.heights = heights
+        self.widths = widths
+        self.offsets = offsets
+        self.boxes = boxes
+        self.difficult = difficult
+        self.name_ids = name_ids
+        self.names = list(names)
+        self.missing = list(missing)
+        self.xml_file_ids = xml_file_ids
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    @property
+    def num_objects(self):
+        return len(self.name_ids)
+
+    @classmethod
+    def get(cls, annotation_dirname, file_ids, cache_file="", num_workers=0, coco_files=()):
+        """
+        Load the index of ``file_ids`` from ``cache_file``, or build it and save it there. With ``coco_files``,
+        the freshness check only looks at the XML of the images the cached index didn't find in the json files.
+        """
+        file_ids = [str(file_id) for file_id in file_ids]
+        anno_files = [os.path.join(annotation_dirname, file_id + ".xml") for file_id in file_ids]
+        index = None
+        if cache_file:
+            # the key covers the json files, so the xml file ids of a cache built from other ones can't match
+            header = cls._read_header(cache_file)[0] if coco_files else None
+            xml_file_ids = header.get("xml_file_ids") if header else None
+            index = cls.load(cache_file, _file_key(file_ids, anno_files, coco_files, xml_file_ids))
+        if index is None:
+            index = cls.build(file_ids, anno_files, num_workers, coco_files)
+            if cache_file:
+                index.save(cache_file, _file_key(file_ids, anno_files, coco_files, index.xml_file_ids))
+        return index
+
+    @classmethod
+    def build(cls, file_ids, anno_files, num_workers=0, coco_files=()):
+        """
+        Parse ``anno_files`` with ``num_workers`` processes, in the calling process if it's 0 or 1. The images
+        in ``coco_files`` are read from the json files instead.
+        """
+        coco_records = load_coco_records(coco_files, file_ids) if coco_files else {}
+        xml_files = [anno_file for file_id, anno_file in zip(file_ids, anno_files) if file_id not in coco_records]
+        if num_workers > 1 and len(xml_files) > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                chunksize = max(1, min(256, len(xml_files) // (4 * num_workers)))
+                xml_records = pool.map(parse_voc_xml, xml_files, chunksize=chunksize)
+        else:
+            xml_records = [parse_voc_xml(anno_file) for anno_file in xml_files]
+        xml_records = iter(xml_records)
+        records = [coco_records[file_id] if file_id in coco_records else next(xml_records) for file_id in file_ids]
+
+        vocabulary = {}
+        kept_ids, heights, widths, counts, boxes, difficult, name_ids, missing = [], [], [], [], [], [], [], []
+        for file_id, anno_file, record in zip(file_ids, anno_files, records):
+            if record is None:
+                missing.append(anno_file)
+                continue
+            height, width, names, image_boxes, image_difficult = record
+            kept_ids.append(file_id)
+            heights.append(height)
+            widths.append(width)
+            counts.append(len(names))
+            boxes.extend(image_boxes)
+            difficult.extend(image_difficult)
+            name_ids.extend(vocabulary.setdefault(name, len(vocabulary)) for name in names)
+
+        return cls(
+            file_ids=np.array(kept_ids, dtype=np.str_),
+            heights=np.array(heights, dtype=np.int32),
+            widths=np.array(widths, dtype=np.int32),
+            offsets=np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+            boxes=np.array(boxes, dtype=np.float64).reshape(-1, 4),
+            difficult=np.array(difficult, dtype=np.uint8),
+            name_ids=np.array(name_ids, dtype=np.int32),
+            names=list(vocabulary),
+            missing=missing,
+            xml_file_ids=[file_id for file_id in file_ids if file_id not in coco_records] if coco_files else None,
+        )
+
+    def save(self, path, key=None):
+        arrays, offset = {}, 0
+        for name in self._ARRAYS:
+            array = np.ascontiguousarray(getattr(self, name))
+            arrays[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+        header = json.dumps({"version": _FORMAT_VERSION, "key": key, "names": self.names, "missing": self.missing,
+                             "xml_file_ids": self.xml_file_ids, "arrays": arrays}).encode()
+        data_start = -(-(8 + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+        PathManager.mkdirs(os.path.dirname(path) or ".")
+        # write-then-rename so concurrent ranks never read a partial file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with PathManager.open(tmp_path, "wb") as f:
+            f.write(struct.pack("<Q", len(header)) + header)
+            for name in self._ARRAYS:
+                f.seek(data_start + arrays[name]["offset"])
+                f.write(np.ascontiguousarray(getattr(self, name)).tobytes())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_header(path):
+        """The JSON header of the index saved at ``path`` and its size, (None, 0) if there is none."""
+        if not PathManager.exists(path):
+            return None, 0
+        with PathManager.open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            return json.loads(f.read(header_size).decode()), header_size
+
+    @classmethod
+    def load(cls, path, key=None):
+        """Memory-map the index saved at ``path``, None if there is none or it doesn't match ``key``."""
+        header, header_size = cls._read_header(path)
+        if header is None:
+            return None
+        if header.get("version") != _FORMAT_VERSION or header.get("key") != key:
+            logging.getLogger(__name__).info(
+                "Annotation index {} does not match the annotations, rebuilding.".format(path))
+            return None
+
+        local_path = PathManager.get_local_path(path)
+        data_start = -(-(8 + header_size) // _ALIGNMENT) * _ALIGNMENT
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+            if np.prod(shape) == 0:  # an empty array can't be memory-mapped
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(local_path, dtype=dtype, mode="r", offset=data_start + spec["offset"],
+                                         shape=shape)
+        return cls(names=header["names"], missing=header["missing"], xml_file_ids=header.get("xml_file_ids"),
+                   **arrays)
+
+
+class CompactAnnotations(Sequence):
+    """
+    The instance annotations of one image as two arrays: XYXY_ABS ``boxes`` [n, 4] and ``category_ids`` [n].
+
+    It reads like the usual list of annotation dicts, so detectron2's dataset utilities work unchanged, but it
+    pickles as two small arrays instead of one dict per object, and DatasetMapper transforms the arrays as a
+    whole. The arrays are never modified in place, so copies of a dataset dict can share them.
+    """
+
+    __slots__ = ("boxes", "category_ids")
+
+    def __init__(self, boxes, category_ids):
+        self.boxes = boxes
+        self.category_ids = category_ids
+
+    def __len__(self):
+        return len(self.category_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return {"category_id": int(self.category_ids[i]), "bbox": self.boxes[i].tolist(), "bbox_mode": BoxMode.XYXY_ABS}
+
+    def __getstate__(self):
+        # raw bytes pickle smaller than arrays, which matters with one instance per image
+        return (np.ascontiguousarray(self.boxes, dtype=np.float64).tobytes(),
+                np.ascontiguousarray(self.category_ids, dtype=np.int64).tobytes())
+
+    def __setstate__(self, state):
+        self.boxes = np.frombuffer(state[0], dtype=np.float64).reshape(-1, 4)
+        self.category_ids = np.frombuffer(state[1], dtype=np.int64)
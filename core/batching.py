@@ -0,0 +1,134 @@
+import bisect
+import itertools
+import logging
+
+import numpy as np
+import torch
+
+import detectron2.utils.comm as comm
+from detectron2.data import DatasetFromList, MapDataset, get_detection_dataset_dicts
+from detectron2.data import transforms as T
+from detectron2.data.build import trivial_batch_collator, worker_init_reset_seed
+from detectron2.data.samplers import RepeatFactorTrainingSampler, TrainingSampler
+
+from .dataset_mapper import _shape_only, sample_transforms
+
+__all__ = ["BucketedBatchDataset", "build_bucketed_train_loader", "build_bucketed_test_loader"]
+
+
+def _sample_short_edge(gen):
+    """
+    One short edge of a ResizeShortestEdge gen, drawn like its ``get_transform`` does, as an int: numpy ints
+    aren't taken for a single size by ResizeShortestEdge.
+    """
+    if gen.is_range:
+        return int(np.random.randint(gen.short_edge_length[0], gen.short_edge_length[1] + 1))
+    return int(np.random.choice(gen.short_edge_length))
+
+
+class BucketedBatchDataset(torch.utils.data.IterableDataset):
+    """
+    Batches of mapped dataset dicts whose images have about the same aspect ratio and the same short edge, so
+    ``ImageList.from_tensors`` pads them little.
+
+    Indices come from an infinite per-rank ``sampler`` and are shared out between the data loader workers.
+    Without a sampler, the dataset dicts come from iterating ``dataset``, which shares them out itself, like
+    :class:`core.image_shards.ImageShardDataset`.
+    The flip and crop of each image are sampled from the "height" and "width" of its dataset dict, before it
+    is read, and place it in one of the buckets split by ``aspect_ratios`` (width / height). Each bucket draws
+    the short edge of its next batch from the mapper's last ResizeShortestEdge when it starts filling, and a
+    batch is yielded as soon as it holds ``batch_size`` images.
+    """
+
+    def __init__(self, dataset, mapper, sampler, batch_size, aspect_ratios):
+        assert isinstance(mapper.tfm_gens[-1], T.ResizeShortestEdge), "The mapper has to end with a resize"
+        self.dataset = dataset
+        self.mapper = mapper
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.aspect_ratios = sorted(aspect_ratios)
+
+    def __iter__(self):
+        if self.sampler is None:
+            dataset_dicts = iter(self.dataset)
+        else:
+            indices = iter(self.sampler)
+            worker_info = torch.utils.data.get_worker_info()
+            if worker_info is not None:
+                indices = itertools.islice(indices, worker_info.id, None, worker_info.num_workers)
+            dataset_dicts = (self.dataset[index] for index in indices)
+
+        resize = self.mapper.tfm_gens[-1]
+        buckets = [[] for _ in range(len(self.aspect_ratios) + 1)]
+        short_edges = [None] * len(buckets)
+        for dataset_dict in dataset_dicts:
+            gens = self.mapper.choose_gens()
+            transforms, (height, width) = sample_transforms(gens[:-1], dataset_dict["height"], dataset_dict["width"])
+            i = bisect.bisect(self.aspect_ratios, width / height)
+            if not buckets[i]:
+                short_edges[i] = _sample_short_edge(resize)
+            tfm = T.ResizeShortestEdge(short_edges[i], resize.max_size, "choice").get_transform(
+                _shape_only((height, width)))
+            data = self.mapper(dataset_dict, T.TransformList(transforms.transforms + [tfm]))
+            if data is None:
+                continue
+            buckets[i].append(data)
+            if len(buckets[i]) == self.batch_size:
+                yield buckets[i][:]
+                del buckets[i][:]
+
+
+def build_bucketed_train_loader(cfg, mapper):
+    """
+    A train loader like ``build_detection_train_loader``, whose batches come from :class:`BucketedBatchDataset`.
+    """
+    dataset_dicts = get_detection_dataset_dicts(
+        cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS)
+
+    sampler_name = cfg.DATALOADER.SAMPLER_TRAIN
+    logging.getLogger(__name__).info("Using training sampler {} with bucketed batching".format(sampler_name))
+    if sampler_name == "TrainingSampler":
+        sampler = TrainingSampler(len(dataset_dicts))
+    elif sampler_name == "RepeatFactorTrainingSampler":
+        repeat_factors = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency(
+            dataset_dicts, cfg.DATALOADER.REPEAT_THRESHOLD)
+        sampler = RepeatFactorTrainingSampler(repeat_factors)
+    else:
+        raise ValueError("Unknown training sampler: {}".format(sampler_name))
+
+    world_size = comm.get_world_size()
+    total_batch_size = cfg.SOLVER.IMS_PER_BATCH
+    assert total_batch_size > 0 and total_batch_size % world_size == 0, \
+        "Total batch size ({}) must be divisible by the number of gpus ({}).".format(total_batch_size, world_size)
+
+    dataset = BucketedBatchDataset(DatasetFromList(dataset_dicts, copy=False), mapper, sampler,
+                                   total_batch_size // world_size, cfg.DATALOADER.BUCKET_ASPECT_RATIOS)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        collate_fn=trivial_batch_collator,
+        worker_init_fn=worker_init_reset_seed,
+    )
+
+
+def build_bucketed_test_loader(cfg, dataset_name, mapper):
+    """
+    A test loader like ``build_detection_test_loader`` with ``cfg.TEST.IMS_PER_BATCH`` images per batch. Each
+    rank takes a contiguous part of the dataset, like ``InferenceSampler``, and batches its images in order
+    of aspect ratio: with the one test resize they mostly come out the same size.
+    """
+    dataset_dicts = get_detection_dataset_dicts([dataset_name], filter_empty=False)
+    indices = np.array_split(np.arange(len(dataset_dicts)), comm.get_world_size())[comm.get_rank()]
+    aspect_ratios = np.array([dataset_dicts[i]["width"] / dataset_dicts[i]["height"] for i in indices])
+    indices = indices[np.argsort(aspect_ratios, kind="stable")].tolist()
+    batch_size = cfg.TEST.IMS_PER_BATCH
+    batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+    dataset = MapDataset(DatasetFromList(dataset_dicts, copy=False), mapper)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=batches,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        collate_fn=trivial_batch_collator,
+    )
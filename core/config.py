@@ -7,6 +7,9 @@ def add_config(cfg):
     cfg.MODEL.DROPOUT = 0.0
     cfg.MODEL.DIM_FEEDFORWARD = 2048
     cfg.MODEL.ACTIVATION = 'relu'
+    cfg.MODEL.ATTENTION_BACKEND = 'mha'  # proposal self-attention: 'mha', 'sdpa', 'chunked' or 'topk'
+    cfg.MODEL.ATTENTION_CHUNK_SIZE = 128  # queries per chunk for 'chunked' and 'topk'
+    cfg.MODEL.ATTENTION_TOPK = 64  # keys attended by each query for 'topk'
     cfg.MODEL.HIDDEN_DIM = 256
     cfg.MODEL.NUM_CLS = 1
     cfg.MODEL.NUM_REG = 3
@@ -15,6 +18,16 @@ def add_config(cfg):
     # Dynamic Conv.
     cfg.MODEL.NUM_DYNAMIC = 2
     cfg.MODEL.DIM_DYNAMIC = 64
+    cfg.MODEL.DYNAMIC_CONV_CHUNK_SIZE = 0  # proposals per chunk, bounds the generated parameters; 0 disables
+
+    # RoI pooling.
+    # Pool all FPN levels with one ROIAlign call on maps padded to the finest level's size. Trades launches for
+    # memory: the padded stack holds #levels x the P2 features (4x instead of ~1.33x for P2-P5) for the whole
+    # head forward, so keep it off unless kernel launches dominate, e.g. small images or few proposals.
+    cfg.MODEL.ROI_POOLER_SINGLE_CALL = False
+    # Inference: reuse a stage's RoI features for proposals that barely moved since they were pooled (0 disables).
+    cfg.MODEL.ROI_REUSE_PIXEL_TOL = 0.0  # max coordinate change in pixels
+    cfg.MODEL.ROI_REUSE_IOU_THRESH = 0.0  # min IoU with the pooled box
 
     # Loss.
     cfg.MODEL.CLASS_WEIGHT = 2.0
@@ -22,6 +35,7 @@ def add_config(cfg):
     cfg.MODEL.NC_WEIGHT = 0.1
     cfg.MODEL.GIOU_WEIGHT = 2.0
     cfg.MODEL.L1_WEIGHT = 5.0
+    cfg.MODEL.IOU_LOSS_TYPE = 'giou'  # box overlap loss of loss_giou: 'giou', 'diou' or 'ciou'
     cfg.MODEL.DEEP_SUPERVISION = True
     cfg.MODEL.NO_OBJECT_WEIGHT = 0.1
 
@@ -33,6 +47,18 @@ def add_config(cfg):
     # Dynamic K
     cfg.MODEL.OTA_K = 5
     cfg.MODEL.FORWARD_K = 10
+    # Matching of the deep-supervision outputs: 'full' rematches every stage, 'reuse' uses the final-stage
+    # assignment, 'stride' rematches every AUX_MATCHING_STRIDE-th stage counted back from the final one and
+    # reuses the closest later match for the others, 'periodic' rematches every AUX_MATCHING_PERIOD
+    # iterations and reuses the final-stage assignment in between.
+    cfg.MODEL.AUX_MATCHING = 'full'
+    cfg.MODEL.AUX_MATCHING_STRIDE = 2
+    cfg.MODEL.AUX_MATCHING_PERIOD = 10
+    # Keep the matcher and losses free of host-device syncs, skips the box sanity checks.
+    cfg.MODEL.SYNC_FREE = False
+    # Count the host-device syncs of every loss computation and log where they happen. Off CUDA this patches the
+    # tensor-to-Python conversions of torch.Tensor for the whole process while the loss runs, debugging only.
+    cfg.MODEL.SYNC_DEBUG = False
 
     # WARM_UP
     cfg.MODEL.CHANGE_START = 0
@@ -43,13 +69,52 @@ def add_config(cfg):
 
     # Inference
     cfg.MODEL.USE_NMS = True
+    # drop candidates before topk/NMS, keep below TEST.SCORE_THRESH / 2. Scores of exactly 0 are kept whatever the
+    # threshold, inference relabels those to the unknown class
+    cfg.MODEL.INFERENCE_SCORE_THRESH = 0.0
+    cfg.MODEL.INFERENCE_MAX_DETS_PER_CLASS = 0  # cap detections per class after NMS, 0 disables
+    cfg.MODEL.INFERENCE_PRUNE_STAGE = 0  # drop weak proposals after this head stage, 0 disables
+    cfg.MODEL.INFERENCE_PRUNE_SCORE_THRESH = 0.0  # proposals scoring below are dropped
+    cfg.MODEL.INFERENCE_PRUNE_TOPK = 0  # at most this many proposals survive per set, 0 means no limit
+
+    # Anytime inference: stop early on a deadline or once head stages converge, 0 disables a criterion
+    cfg.MODEL.ANYTIME_DEADLINE_MS = 0.0  # per-image latency budget of the forward pass
+    cfg.MODEL.ANYTIME_BOX_DELTA = 0.0  # max box change (pixels) between consecutive stages
+    cfg.MODEL.ANYTIME_SCORE_DELTA = 0.0  # max score change between consecutive stages
     cfg.MODEL.M_STEP = 20
     cfg.MODEL.SAMPLING_METHOD = 'Random_'
+    cfg.MODEL.INFERENCE_MAX_PROPOSALS_PER_PASS = 2500  # per image, M_STEP slices are stacked up to this budget
+
+    # Proposal bank for multi-sample inference, not built when SAMPLING_METHOD is 'Random'
+    cfg.MODEL.PROPOSAL_GRID_LEVELS = 10  # values per coordinate, the grid has LEVELS ** 4 boxes
+    cfg.MODEL.PROPOSAL_GRID_RANGE = (-2.0, 2.0)
+    cfg.MODEL.PROPOSAL_BANK_SIZE = 10000  # should cover NUM_PROPOSALS * M_STEP
+    cfg.MODEL.PROPOSAL_BANK_SEED = 0
+    cfg.MODEL.PROPOSAL_BANK_CACHE = ""  # optional file to persist the bank, e.g. "output/proposal_bank.pth"
 
     # Disentanglement
     cfg.MODEL.DISENTANGLED = 2  # 0: RandBox, 1: separate head, 2: feature orthogonality
     cfg.MODEL.DECORR_WEIGHT = 1.  # weight for prediction decorrelation loss
     cfg.MODEL.UNCERTAINTY = 0
+    # Annotation loading
+    cfg.DATASETS.ANNOTATION_CACHE_DIR = ""  # optional dir to cache the parsed annotations, e.g. "datasets/cache"
+    cfg.DATASETS.ANNOTATION_NUM_WORKERS = 8  # processes parsing the annotation files, 0 parses in the caller
+    # COCO json files read instead of the XML coco_to_voc.py writes, e.g. ("coco/annotations/instances_val2017.json",)
+    cfg.DATASETS.COCO_ANNOTATION_FILES = ()
+
+    # Decode JPEGs at a reduced scale and crop/resize them with one resampling step, pixels differ slightly.
+    cfg.INPUT.FUSED_DECODE = False
+    # Optional dir of pre-resized images, read when the resize is deterministic, see build_image_cache.py.
+    cfg.INPUT.IMAGE_CACHE_DIR = ""
+
+    # Batch images of about the same aspect ratio, with one short edge per batch, to pad less.
+    cfg.DATALOADER.BUCKETED_BATCHING = False
+    cfg.DATALOADER.BUCKET_ASPECT_RATIOS = (0.8, 1.0, 1.25, 1.5)  # width / height boundaries of the buckets
+    cfg.TEST.IMS_PER_BATCH = 1  # images per inference batch and GPU, above 1 they are batched by aspect ratio
+    # Optional dir of image shards to train from, read sequentially, see build_image_shards.py.
+    cfg.DATALOADER.IMAGE_SHARD_DIR = ""
+    cfg.DATALOADER.SHARD_SHUFFLE_BUFFER = 1024  # images per data loader worker
+
     # Optimizer.
     cfg.SOLVER.OPTIMIZER = "ADAMW"
     cfg.SOLVER.BACKBONE_MULTIPLIER = 1.0
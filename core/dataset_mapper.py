@@ -1,10 +1,18 @@
 import copy
+import io
 import logging
+import math
 import numpy as np
 import torch
+from fvcore.common.file_io import PathManager
+from PIL import Image
 
 from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
+from detectron2.structures import Boxes, Instances
+
+from .annotation_index import CompactAnnotations
+from .image_cache import ImageCache, image_cache_params
 
 __all__ = ["DatasetMapper"]
 
@@ -38,6 +46,116 @@ def build_transform_gen(cfg, is_train):
     return tfm_gens
 
 
+def compact_annotations_to_instances(annotations, transforms, image_size):
+    """
+    Transform :class:`CompactAnnotations` and build the Instances of the model, the same as
+    ``transform_instance_annotations`` and ``annotations_to_instances`` do object by object.
+    """
+    boxes = annotations.boxes
+    if len(boxes):
+        boxes = transforms.apply_box(boxes).clip(min=0)
+        boxes = np.minimum(boxes, list(image_size + image_size)[::-1])
+    target = Instances(image_size)
+    target.gt_boxes = Boxes(boxes.reshape(-1, 4))
+    target.gt_classes = torch.tensor(annotations.category_ids, dtype=torch.int64)
+    return target
+
+
+def _shape_only(shape):
+    """A zero-copy stand-in for an image of ``shape``, enough for transform gens that only look at the size."""
+    return np.broadcast_to(np.zeros((1, 1, 1), dtype=np.uint8), tuple(shape) + (3,))
+
+
+def transformed_shape(transforms, height, width):
+    """The (height, width) of an image of ``height`` x ``width`` after flip, resize and crop ``transforms``."""
+    shape = (height, width)
+    for tfm in transforms:
+        if isinstance(tfm, T.ResizeTransform):
+            shape = (tfm.new_h, tfm.new_w)
+        elif isinstance(tfm, T.CropTransform):
+            shape = (tfm.h, tfm.w)
+        elif not isinstance(tfm, (T.HFlipTransform, T.VFlipTransform, T.NoOpTransform)):
+            raise NotImplementedError("Can't tell the output size of {}".format(tfm))
+    return shape
+
+
+def sample_transforms(gens, height, width):
+    """
+    Sample the transforms of ``gens`` for an image of ``height`` x ``width`` without the image, like
+    ``T.apply_transform_gens`` does, for gens that only look at the image size.
+
+    Returns the TransformList and the (height, width) of the transformed image.
+    """
+    transforms, shape = [], (height, width)
+    for gen in gens:
+        tfm = gen.get_transform(_shape_only(shape))
+        transforms.append(tfm)
+        shape = transformed_shape([tfm], *shape)
+    return T.TransformList(transforms), shape
+
+
+def read_image_transformed(file_name, gens, format=None, dataset_dict=None, transforms=None):
+    """
+    Read an image and apply flip, resize and crop transform gens to it with a single resampling step, decoding
+    JPEGs at the smallest reduced scale (PIL draft mode) that still covers the output resolution.
+
+    The transforms are sampled from the image size, like ``T.apply_transform_gens`` does, so the returned
+    transforms and the boxes they map are the same. Only the pixels differ slightly, from resampling once.
+
+    Returns the image in ``format`` and the TransformList, or (None, None) for images with an EXIF orientation,
+    which have to be rotated before sampling the transforms. ``transforms`` already sampled for the image size
+    are applied instead of sampling ``gens``. ``file_name`` can also be an open file.
+    """
+    with (PathManager.open(file_name, "rb") if isinstance(file_name, str) else file_name) as f:
+        image = Image.open(f)
+        if image.getexif().get(0x0112, 1) != 1:  # EXIF orientation tag
+            return None, None
+        width, height = image.size
+        if dataset_dict is not None:
+            utils.check_image_size(dataset_dict, _shape_only((height, width)))
+
+        if transforms is None:
+            transforms, (out_h, out_w) = sample_transforms(gens, height, width)
+        else:
+            out_h, out_w = transformed_shape(transforms, height, width)
+        # compose the transforms into out = a * src + b per axis
+        ax, bx, ay, by = 1.0, 0.0, 1.0, 0.0
+        interp = Image.BILINEAR
+        for tfm in transforms:
+            if isinstance(tfm, T.HFlipTransform):
+                ax, bx = -ax, tfm.width - bx
+            elif isinstance(tfm, T.VFlipTransform):
+                ay, by = -ay, tfm.height - by
+            elif isinstance(tfm, T.ResizeTransform):
+                scale_x, scale_y = tfm.new_w / tfm.w, tfm.new_h / tfm.h
+                ax, bx, ay, by = ax * scale_x, bx * scale_x, ay * scale_y, by * scale_y
+                interp = tfm.interp
+            elif isinstance(tfm, T.CropTransform):
+                bx, by = bx - tfm.x0, by - tfm.y0
+
+        # the source region that ends up in the output
+        x0, x1 = sorted((-bx / ax, (out_w - bx) / ax))
+        y0, y1 = sorted((-by / ay, (out_h - by) / ay))
+        reduction = min((x1 - x0) / out_w, (y1 - y0) / out_h)
+        if reduction >= 2:
+            image.draft(image.mode, (math.ceil(width / reduction), math.ceil(height / reduction)))
+        scale_x, scale_y = image.size[0] / width, image.size[1] / height
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image = image.resize((out_w, out_h), interp, box=(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y))
+    if ax < 0:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    if ay < 0:
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+    return utils.convert_PIL_to_numpy(image, format), transforms
+
+
+def read_image_bytes(data, format=None):
+    """``utils.read_image`` of an encoded image in memory."""
+    image = utils._apply_exif_orientation(Image.open(io.BytesIO(data)))
+    return utils.convert_PIL_to_numpy(image, format)
+
+
 class DatasetMapper:
     """
     A callable which takes a dataset dict in Detectron2 Dataset format,
@@ -67,28 +185,81 @@ class DatasetMapper:
 
         self.img_format = cfg.INPUT.FORMAT
         self.is_train = is_train
+        fusable = (T.RandomFlip, T.ResizeShortestEdge, T.RandomCrop)
+        self.fused_decode = cfg.INPUT.FUSED_DECODE and all(
+            isinstance(gen, fusable) for gen in self.tfm_gens + (self.crop_gen or []))
+        cache_params = image_cache_params(cfg, is_train)
+        self.image_cache = None
+        if cfg.INPUT.IMAGE_CACHE_DIR and cache_params is not None:
+            self.image_cache = ImageCache.open(cfg.INPUT.IMAGE_CACHE_DIR, *cache_params)
 
-    def __call__(self, dataset_dict):
+    def choose_gens(self):
+        """The transform gens of one image: the random crop is applied to half of them."""
+        if self.crop_gen is None or np.random.rand() > 0.5:
+            return self.tfm_gens
+        return self.tfm_gens[:-1] + self.crop_gen + self.tfm_gens[-1:]
+
+    def read_cached_image(self, dataset_dict, gens, transforms=None):
+        """
+        The image from the image cache, which holds it already resized, and the transforms sampled for it, or
+        ``transforms`` if they are given. Returns (None, None) for images that aren't cached.
+        """
+        cached = self.image_cache.get(dataset_dict["file_name"])
+        if cached is None:
+            return None, None
+        image, (height, width) = cached
+        utils.check_image_size(dataset_dict, _shape_only((height, width)))
+        if transforms is None:
+            transforms, shape = sample_transforms(gens, height, width)
+        else:
+            shape = transformed_shape(transforms, height, width)
+        if tuple(image.shape[1:]) != shape:  # cached with another resize, decode it after all
+            image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
+            return transforms.apply_image(image), transforms
+
+        image = image.transpose(1, 2, 0)  # a view, transposed back without a copy below
+        for tfm in transforms:  # the deterministic resize is cached, only the flips are left
+            if isinstance(tfm, T.HFlipTransform):
+                image = image[:, ::-1]
+            elif isinstance(tfm, T.VFlipTransform):
+                image = image[::-1]
+        return image, transforms
+
+    def __call__(self, dataset_dict, transforms=None):
         """
         Args:
-            dataset_dict (dict): Metadata of one image, in Detectron2 Dataset format.
+            dataset_dict (dict): Metadata of one image, in Detectron2 Dataset format. The encoded image can come
+                with it as "image_bytes", see :class:`core.image_shards.ImageShardDataset`.
+            transforms (TransformList, optional): transforms already sampled for the "height" and "width" of the
+                image, applied instead of the transform gens, see :class:`core.batching.BucketedBatchDataset`.
 
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
-        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
-        utils.check_image_size(dataset_dict, image)
-
-        if self.crop_gen is None:
-            image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+        if isinstance(dataset_dict.get("annotations"), CompactAnnotations):
+            dataset_dict = dict(dataset_dict)  # compact annotations aren't modified below, a shallow copy will do
         else:
-            if np.random.rand() > 0.5:
-                image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+            dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        gens = self.choose_gens() if transforms is None else None
+        image_bytes = dataset_dict.pop("image_bytes", None)
+
+        image = None
+        if self.image_cache is not None:
+            image, sampled = self.read_cached_image(dataset_dict, gens, transforms)
+        if image is None and self.fused_decode:
+            image_file = dataset_dict["file_name"] if image_bytes is None else io.BytesIO(image_bytes)
+            image, sampled = read_image_transformed(image_file, gens, self.img_format, dataset_dict, transforms)
+        if image is None:
+            if image_bytes is None:
+                image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
             else:
-                image, transforms = T.apply_transform_gens(
-                    self.tfm_gens[:-1] + self.crop_gen + self.tfm_gens[-1:], image
-                )
+                image = read_image_bytes(image_bytes, self.img_format)
+            utils.check_image_size(dataset_dict, image)
+            if transforms is None:
+                image, sampled = T.apply_transform_gens(gens, image)
+            else:
+                image, sampled = transforms.apply_image(image), transforms
+        transforms = sampled
 
         image_shape = image.shape[:2]  # h, w
 
@@ -102,7 +273,10 @@ class DatasetMapper:
             dataset_dict.pop("annotations", None)
             return dataset_dict
 
-        if "annotations" in dataset_dict:
+        if isinstance(dataset_dict.get("annotations"), CompactAnnotations):
+            instances = compact_annotations_to_instances(dataset_dict.pop("annotations"), transforms, image_shape)
+            dataset_dict["instances"] = utils.filter_empty_instances(instances)
+        elif "annotations" in dataset_dict:
             # USER: Modify this if you want to keep them for some reason.
             for anno in dataset_dict["annotations"]:
                 anno.pop("segmentation", None)
@@ -1,5 +1,7 @@
+import logging
 import math
 import random
+from time import perf_counter
 from typing import List
 from collections import namedtuple
 
@@ -11,9 +13,12 @@ from detectron2.layers import batched_nms
 from detectron2.modeling import META_ARCH_REGISTRY, build_backbone, detector_postprocess
 
 from detectron2.structures import Boxes, ImageList, Instances
+from detectron2.utils.events import get_event_storage
+from detectron2.utils.logger import log_every_n_seconds
 
 from .loss import SetCriterionDynamicK, HungarianMatcherDynamicK
 from .head import DynamicHead
+from .proposal_bank import ProposalBank
 from .util.box_ops import box_cxcywh_to_xyxy, box_xyxy_to_cxcywh
 from .util.misc import nested_tensor_from_tensor_list
 
@@ -81,6 +86,10 @@ class RandBox(nn.Module):
         timesteps, = betas.shape
         self.num_timesteps = int(timesteps)
         self.multiple_sample = cfg.MODEL.M_STEP
+        self.max_proposals_per_pass = cfg.MODEL.INFERENCE_MAX_PROPOSALS_PER_PASS
+        self.anytime_deadline = cfg.MODEL.ANYTIME_DEADLINE_MS
+        self.anytime = self.anytime_deadline > 0 or cfg.MODEL.ANYTIME_BOX_DELTA > 0 or cfg.MODEL.ANYTIME_SCORE_DELTA > 0
+        self.anytime_exit = {}
         self.sampling_timesteps = default(sampling_timesteps, timesteps)
         assert self.sampling_timesteps <= timesteps
         self.ddim_sampling_eta = 1.
@@ -112,18 +121,12 @@ class RandBox(nn.Module):
         self.register_buffer('posterior_mean_coef1', betas * torch.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod))
         self.register_buffer('posterior_mean_coef2',
                              (1. - alphas_cumprod_prev) * torch.sqrt(alphas) / (1. - alphas_cumprod))
-        self.x_dic = torch.rand((10000, 4))
-        self.x_meta = torch.arange(start=-2, end=2, step=0.4)
-        for i1 in range(10):
-            for i2 in range(10):
-                for i3 in range(10):
-                    for i4 in range(10):
-                        self.x_dic[i1 * 1000 + i2 * 100 + i3 * 10 + i4][0], \
-                        self.x_dic[i1 * 1000 + i2 * 100 + i3 * 10 + i4][1], \
-                        self.x_dic[i1 * 1000 + i2 * 100 + i3 * 10 + i4][2], \
-                        self.x_dic[i1 * 1000 + i2 * 100 + i3 * 10 + i4][3] = self.x_meta[i1], self.x_meta[i2], \
-                        self.x_meta[i3], self.x_meta[i4]
-        self.x_dic = self.x_dic[torch.randperm(self.x_dic.size(0))]
+        # Fixed proposal bank for multi-sample inference, random sampling draws its boxes from noise instead.
+        self.proposal_bank = None
+        if self.sampling_method != 'Random':
+            self.proposal_bank = ProposalBank.from_config(cfg)
+            assert self.proposal_bank.bank_size >= self.num_proposals * self.multiple_sample, \
+                "MODEL.PROPOSAL_BANK_SIZE must cover NUM_PROPOSALS * M_STEP boxes"
         # Build Dynamic Head.
         self.head = DynamicHead(cfg=cfg, roi_input_shape=self.backbone.output_shape())
         # Loss parameters:
@@ -135,6 +138,8 @@ class RandBox(nn.Module):
         decorr_weight = cfg.MODEL.DECORR_WEIGHT
         self.deep_supervision = cfg.MODEL.DEEP_SUPERVISION
         self.use_nms = cfg.MODEL.USE_NMS
+        self.inference_score_thresh = cfg.MODEL.INFERENCE_SCORE_THRESH
+        self.inference_max_dets_per_class = cfg.MODEL.INFERENCE_MAX_DETS_PER_CLASS
 
         # Build Criterion.
         matcher = HungarianMatcherDynamicK(
@@ -161,6 +166,8 @@ class RandBox(nn.Module):
         pixel_mean = torch.Tensor(cfg.MODEL.PIXEL_MEAN).to(self.device).view(3, 1, 1)
         pixel_std = torch.Tensor(cfg.MODEL.PIXEL_STD).to(self.device).view(3, 1, 1)
         self.normalizer = lambda x: (x - pixel_mean) / pixel_std
+        self.inference_pixels = [0, 0]  # image and padded pixels of the inference batches so far
+        self.roi_reuse_counts = [0, 0]  # reused and total RoI features of the inference batches so far
         self.to(self.device)
 
     def predict_noise_from_start(self, x_t, t, x0):
@@ -169,17 +176,18 @@ class RandBox(nn.Module):
                 extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
         )
 
-    def model_predictions(self, backbone_feats, images_whwh, x, t, x_self_cond=None, clip_x_start=False, sample_i=0):
+    def model_predictions(self, backbone_feats, images_whwh, x, t, x_self_cond=None, clip_x_start=False, sample_i=0,
+                          deadline=None):
         if self.sampling_method == 'Random':
             x_boxes = torch.clamp(x, min=-1 * self.scale, max=self.scale)
             x_boxes = ((x_boxes / self.scale) + 1) / 2
         else:
-            x_boxes = self.x_dic.to(x.device)[self.num_proposals * sample_i:self.num_proposals * (sample_i + 1), :]
+            x_boxes = self.proposal_bank(sample_i, self.num_proposals)
             x_boxes = ((x_boxes / self.scale) + 1) / 2
 
         x_boxes = box_cxcywh_to_xyxy(x_boxes)
         x_boxes = x_boxes * images_whwh[:, None, :]
-        outputs_class, outputs_objectness, outputs_coord = self.head(backbone_feats, x_boxes, t, None)
+        outputs_class, outputs_objectness, outputs_coord = self.head(backbone_feats, x_boxes, t, None, deadline=deadline)
 
         x_start = outputs_coord[-1]  # (batch, num_proposals, 4) predict boxes: absolute coordinates (x1, y1, x2, y2)
         x_start = x_start / images_whwh[:, None, :]
@@ -191,7 +199,73 @@ class RandBox(nn.Module):
         return ModelPrediction(pred_noise, x_start), outputs_class, outputs_objectness, outputs_coord
 
     @torch.no_grad()
-    def ddim_sample(self, batched_inputs, backbone_feats, images_whwh, images, clip_denoised=True, do_postprocess=True):
+    def multi_sample_predictions(self, backbone_feats, images_whwh, time_pairs, deadline=None):
+        """
+        Run the head on all M_STEP proposal slices of the proposal bank, stacking as many slices as
+        the memory budget allows into one head pass. Slices are stacked along the batch dimension,
+        so self-attention still only mixes proposals of the same slice.
+
+        Returns the final-stage class logits, objectness and boxes of shape
+        (1, batch, num_proposals * M_STEP, K), with slice ``i`` at proposals [i * num_proposals, (i + 1) * num_proposals).
+        Once ``deadline`` has passed no further pass is started, and only the slices computed so far are returned.
+        """
+        batch = images_whwh.shape[0]
+        num_proposals = self.num_proposals
+        samples_per_pass = max(1, self.max_proposals_per_pass // num_proposals)
+
+        class_cat = objectness_cat = coord_cat = None
+        for start in range(0, self.multiple_sample, samples_per_pass):
+            num_samples = min(samples_per_pass, self.multiple_sample - start)
+            x_boxes = self.proposal_bank(start, num_proposals, num_samples).view(num_samples, num_proposals, 4)
+            x_boxes = ((x_boxes / self.scale) + 1) / 2
+            x_boxes = box_cxcywh_to_xyxy(x_boxes)
+            x_boxes = (x_boxes[None] * images_whwh[:, None, None, :]).flatten(0, 1)  # (batch * num_samples, N, 4)
+
+            for time, time_next in time_pairs:
+                time_cond = torch.full((batch * num_samples,), time, device=self.device, dtype=torch.long)
+                outputs_class, outputs_objectness, outputs_coord = self.head(backbone_feats, x_boxes, time_cond, None,
+                                                                             deadline=deadline)
+                self._record_head_exit()
+
+            outputs_class = outputs_class[-1].view(batch, num_samples * num_proposals, -1)
+            outputs_objectness = outputs_objectness[-1].view(batch, num_samples * num_proposals, -1)
+            outputs_coord = outputs_coord[-1].view(batch, num_samples * num_proposals, -1)
+            if class_cat is None:
+                total = self.multiple_sample * num_proposals
+                class_cat = outputs_class.new_empty((batch, total, outputs_class.shape[-1]))
+                objectness_cat = outputs_objectness.new_empty((batch, total, outputs_objectness.shape[-1]))
+                coord_cat = outputs_coord.new_empty((batch, total, outputs_coord.shape[-1]))
+            proposal_slice = slice(start * num_proposals, (start + num_samples) * num_proposals)
+            class_cat[:, proposal_slice] = outputs_class
+            objectness_cat[:, proposal_slice] = outputs_objectness
+            coord_cat[:, proposal_slice] = outputs_coord
+
+            self.anytime_exit["samples"] = start + num_samples
+            if start + num_samples < self.multiple_sample and \
+                    (self.head.exit_reason == "deadline" or self._deadline_passed(deadline)):
+                self.anytime_exit["reason"] = "deadline"
+                break
+
+        computed = self.anytime_exit["samples"] * num_proposals
+        return class_cat[None, :, :computed], objectness_cat[None, :, :computed], coord_cat[None, :, :computed]
+
+    def _record_head_exit(self):
+        """Keep the earliest early exit of the head over all its passes of one inference."""
+        anytime_exit = self.anytime_exit
+        if self.head.exit_reason != "complete" and (
+                anytime_exit["reason"] == "complete" or self.head.exit_stage < anytime_exit["stage"]):
+            anytime_exit["stage"], anytime_exit["reason"] = self.head.exit_stage, self.head.exit_reason
+
+    def _deadline_passed(self, deadline):
+        if deadline is None:
+            return False
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return perf_counter() > deadline
+
+    @torch.no_grad()
+    def ddim_sample(self, batched_inputs, backbone_feats, images_whwh, images, clip_denoised=True, do_postprocess=True,
+                    deadline=None):
         batch = images_whwh.shape[0]
         shape = (batch, self.num_proposals, 4)
         total_timesteps, sampling_timesteps, eta, objective = self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
@@ -204,32 +278,20 @@ class RandBox(nn.Module):
         img = torch.randn(shape, device=self.device)
 
         x_start = None
+        self.anytime_exit = {"reason": "complete", "stage": self.num_heads, "samples": 1}
         if self.sampling_method == 'Random':
             for time, time_next in time_pairs:
                 time_cond = torch.full((batch,), time, device=self.device, dtype=torch.long)
                 self_cond = x_start if self.self_condition else None
 
                 preds, class_cat, objectness_cat, coord_cat = self.model_predictions(backbone_feats, images_whwh, img, time_cond,
-                                                                     self_cond, clip_x_start=clip_denoised)
+                                                                     self_cond, clip_x_start=clip_denoised,
+                                                                     deadline=deadline)
                 pred_noise, x_start = preds.pred_noise, preds.pred_x_start
+                self._record_head_exit()
         else:
-            for sample_step in range(self.multiple_sample):
-                for time, time_next in time_pairs:
-                    time_cond = torch.full((batch,), time, device=self.device, dtype=torch.long)
-                    self_cond = x_start if self.self_condition else None
-
-                    preds, outputs_class, outputs_objectness, outputs_coord = self.model_predictions(backbone_feats, images_whwh, img,
-                                                                                 time_cond,
-                                                                                 self_cond, clip_x_start=clip_denoised,
-                                                                                 sample_i=sample_step)
-                if sample_step == 0:
-                    class_cat = outputs_class
-                    objectness_cat = outputs_objectness
-                    coord_cat = outputs_coord
-                else:
-                    class_cat = torch.cat((class_cat, outputs_class), 2)
-                    objectness_cat = torch.cat((objectness_cat, outputs_objectness), 2)
-                    coord_cat = torch.cat((coord_cat, outputs_coord), 2)
+            class_cat, objectness_cat, coord_cat = self.multi_sample_predictions(backbone_feats, images_whwh,
+                                                                                 time_pairs, deadline=deadline)
 
         results = self.inference(class_cat[-1], objectness_cat[-1], coord_cat[-1], images.image_sizes)
 
@@ -239,7 +301,10 @@ class RandBox(nn.Module):
                 height = input_per_image.get("height", image_size[0])
                 width = input_per_image.get("width", image_size[1])
                 r = detector_postprocess(results_per_image, height, width)
-                processed_results.append({"instances": r})
+                if self.anytime:
+                    processed_results.append({"instances": r, "anytime_exit": dict(self.anytime_exit)})
+                else:
+                    processed_results.append({"instances": r})
             return processed_results
 
     # forward diffusion
@@ -267,6 +332,12 @@ class RandBox(nn.Module):
                 * "height", "width" (int): the output resolution of the model, used in inference.
                   See :meth:`postprocess` for details.
         """
+        if not self.training and self.anytime_deadline > 0:
+            # the budget covers the whole forward pass, backbone included
+            deadline = perf_counter() + self.anytime_deadline / 1000. * len(batched_inputs)
+        else:
+            deadline = None
+
         images, images_whwh = self.preprocess_image(batched_inputs)
         if isinstance(images, (list, torch.Tensor)):
             images = nested_tensor_from_tensor_list(images)
@@ -280,13 +351,14 @@ class RandBox(nn.Module):
 
         # Prepare Proposals.
         if not self.training:
-            results = self.ddim_sample(batched_inputs, features, images_whwh, images, do_postprocess=do_postprocess)
+            results = self.ddim_sample(batched_inputs, features, images_whwh, images, do_postprocess=do_postprocess,
+                                       deadline=deadline)
+            self.log_roi_reuse_rate()
             return results
 
         if self.training:
-            gt_instances = [x["instances"].to(self.device) for x in batched_inputs]
+            gt_instances = [x["instances"] for x in batched_inputs]
             targets, x_boxes, noises, t = self.prepare_targets(gt_instances)
-            t = t.squeeze(-1)
             x_boxes = x_boxes * images_whwh[:, None, :]
 
             outputs_class, output_objectness, outputs_coord = self.head(features, x_boxes, t, None)
@@ -302,23 +374,17 @@ class RandBox(nn.Module):
                     loss_dict[k] *= weight_dict[k]
             return loss_dict
 
-    def prepare_diffusion_concat(self, gt_boxes):
+    def prepare_diffusion_concat(self, batch_size):
         """
-        :param gt_boxes: (cx, cy, w, h), normalized
-        :param num_proposals:
-        """
-        t = torch.randint(0, self.num_timesteps, (1,), device=self.device).long()
-        noise = torch.randn(self.num_proposals, 4, device=self.device)
+        Sample the noised training proposals of the whole batch.
 
-        num_gt = gt_boxes.shape[0]
-        if not num_gt:  # generate fake gt boxes if empty gt boxes
-            gt_boxes = torch.as_tensor([[0.5, 0.5, 1., 1.]], dtype=torch.float, device=self.device)
-            num_gt = 1
+        :return: (batch_size, num_proposals, 4) normalized (x1, y1, x2, y2) boxes, the noise and the (batch_size,)
+            timesteps.
+        """
+        t = torch.randint(0, self.num_timesteps, (batch_size,), device=self.device).long()
+        noise = torch.randn(batch_size, self.num_proposals, 4, device=self.device)
 
-        box_placeholder = torch.randn(self.num_proposals - num_gt, 4,
-                                      device=self.device) / 6. + 0.5  # 3sigma = 1/2 --> sigma: 1/6
-        box_placeholder[:, 2:] = torch.clip(box_placeholder[:, 2:], min=1e-4)
-        x_start = torch.randn(self.num_proposals, 4, device=self.device)
+        x_start = torch.randn(batch_size, self.num_proposals, 4, device=self.device)
 
         x_start = (x_start * 2. - 1.) * self.scale
 
@@ -333,31 +399,45 @@ class RandBox(nn.Module):
         return diff_boxes, noise, t
 
     def prepare_targets(self, targets):
-        new_targets = []
-        diffused_boxes = []
-        noises = []
-        ts = []
-        for targets_per_image in targets:
-            target = {}
-            h, w = targets_per_image.image_size
-            image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float, device=self.device)
-            gt_classes = targets_per_image.gt_classes
-            gt_boxes = targets_per_image.gt_boxes.tensor / image_size_xyxy
-            gt_boxes = box_xyxy_to_cxcywh(gt_boxes)
-            d_boxes, d_noise, d_t = self.prepare_diffusion_concat(gt_boxes)
-            diffused_boxes.append(d_boxes)
-            noises.append(d_noise)
-            ts.append(d_t)
-            target["labels"] = gt_classes.to(self.device)
-            target["boxes"] = gt_boxes.to(self.device)
-            target["boxes_xyxy"] = targets_per_image.gt_boxes.tensor.to(self.device)
-            target["image_size_xyxy"] = image_size_xyxy.to(self.device)
-            image_size_xyxy_tgt = image_size_xyxy.unsqueeze(0).repeat(len(gt_boxes), 1)
-            target["image_size_xyxy_tgt"] = image_size_xyxy_tgt.to(self.device)
-            target["area"] = targets_per_image.gt_boxes.area().to(self.device)
-            new_targets.append(target)
-
-        return new_targets, torch.stack(diffused_boxes), torch.stack(noises), torch.stack(ts)
+        """
+        Pack the gt instances of the batch into flat tensors, moved to the device with a single copy.
+
+        Returns the packed targets, whose per-gt fields are concatenated over the images (see
+        :func:`core.loss.split_targets` for the layout), and the diffusion boxes, noise and timesteps.
+        """
+        num_gts = [len(targets_per_image) for targets_per_image in targets]
+        image_size_xyxy = torch.as_tensor([[w, h, w, h] for h, w in (t.image_size for t in targets)],
+                                          dtype=torch.float)
+        batch_idx = torch.repeat_interleave(torch.arange(len(targets)), torch.as_tensor(num_gts, dtype=torch.long))
+        gt_idx = torch.cat([torch.arange(n) for n in num_gts])
+        # boxes, labels and indices share one float buffer, class and gt indices stay exact well below 2 ** 24
+        packed = torch.cat([
+            torch.cat([t.gt_boxes.tensor.float().cpu() for t in targets]),
+            torch.cat([t.gt_classes.cpu() for t in targets]).float()[:, None],
+            batch_idx.float()[:, None],
+            gt_idx.float()[:, None],
+        ], dim=1)
+        packed = torch.cat([packed.flatten(), image_size_xyxy.flatten()]).to(self.device)
+        image_size_xyxy = packed[packed.numel() - 4 * len(targets):].view(-1, 4)
+        packed = packed[:7 * sum(num_gts)].view(-1, 7)
+
+        boxes_xyxy = packed[:, :4]
+        batch_idx = packed[:, 5].long()
+        image_size_xyxy_tgt = image_size_xyxy[batch_idx]
+        new_targets = {
+            "labels": packed[:, 4].long(),
+            "boxes": box_xyxy_to_cxcywh(boxes_xyxy / image_size_xyxy_tgt),
+            "boxes_xyxy": boxes_xyxy,
+            "image_size_xyxy": image_size_xyxy,
+            "image_size_xyxy_tgt": image_size_xyxy_tgt,
+            "area": (boxes_xyxy[:, 2] - boxes_xyxy[:, 0]) * (boxes_xyxy[:, 3] - boxes_xyxy[:, 1]),
+            "batch_idx": batch_idx,
+            "gt_idx": packed[:, 6].long(),
+            "num_gts": num_gts,
+        }
+        diffused_boxes, noises, ts = self.prepare_diffusion_concat(len(targets))
+
+        return new_targets, diffused_boxes, noises, ts
 
     def inference(self, box_cls, box_objectness, box_pred, image_sizes):
         """
@@ -377,26 +457,29 @@ class RandBox(nn.Module):
         assert len(box_cls) == len(image_sizes)
         results = []
 
-        if self.sampling_method == 'Random':
-            multiple_sample = 1
-        else:
-            multiple_sample = self.multiple_sample
-
         if self.disentangled == 0:
             scores = torch.sigmoid(box_cls)
         else:
             scores = torch.softmax(box_cls, dim=-1) * box_objectness
-        labels = torch.arange(self.num_classes, device=self.device). \
-            unsqueeze(0).repeat(self.num_proposals * multiple_sample, 1).flatten(0, 1)
+        num_topk = box_cls.shape[1]  # num_proposals * M_STEP, unless anytime inference stopped early
 
         for i, (scores_per_image, box_pred_per_image, image_size) in enumerate(zip(
                 scores, box_pred, image_sizes
         )):
-            scores_per_image, topk_indices = scores_per_image.flatten(0, 1).topk(
-                self.num_proposals * multiple_sample, sorted=False)
-            labels_per_image = labels[topk_indices]
-            box_pred_per_image = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes, 1).view(-1, 4)
-            box_pred_per_image = box_pred_per_image[topk_indices]
+            # recover (proposal, class) from the flat index instead of materializing class-repeated boxes
+            scores_per_image = scores_per_image.flatten(0, 1)
+            if self.inference_score_thresh > 0:
+                # zero scores stay candidates, they are the uncertain ones relabeled to the unknown class below
+                candidate_indices = torch.nonzero((scores_per_image > self.inference_score_thresh) |
+                                                  (scores_per_image == 0), as_tuple=True)[0]
+                scores_per_image = scores_per_image[candidate_indices]
+                scores_per_image, topk_indices = scores_per_image.topk(min(num_topk, len(candidate_indices)),
+                                                                       sorted=False)
+                topk_indices = candidate_indices[topk_indices]
+            else:
+                scores_per_image, topk_indices = scores_per_image.topk(num_topk, sorted=False)
+            labels_per_image = topk_indices % self.num_classes
+            box_pred_per_image = box_pred_per_image[topk_indices // self.num_classes]
 
             if self.use_nms:
                 keep = batched_nms(box_pred_per_image, scores_per_image, labels_per_image, 0.6)
@@ -404,6 +487,12 @@ class RandBox(nn.Module):
                 scores_per_image = scores_per_image[keep]
                 labels_per_image = labels_per_image[keep]
 
+            if self.inference_max_dets_per_class > 0:
+                keep = self.keep_top_per_class(scores_per_image, labels_per_image, self.inference_max_dets_per_class)
+                box_pred_per_image = box_pred_per_image[keep]
+                scores_per_image = scores_per_image[keep]
+                labels_per_image = labels_per_image[keep]
+
             unknown_class_id = self.num_classes - 1
             uncertain_indices = (scores_per_image == 0)  # 之前在ddim_sample中将高不确定性类设为0
             labels_per_image[uncertain_indices] = unknown_class_id  # 将高不确定性类标记为未知类
@@ -422,17 +511,67 @@ class RandBox(nn.Module):
 
         return results
 
+    @staticmethod
+    def keep_top_per_class(scores, labels, max_per_class):
+        """
+        Return the indices of the ``max_per_class`` highest scoring detections of every class,
+        in descending score order.
+        """
+        order = scores.argsort(descending=True)
+        # a stable sort by label keeps the score order inside each class
+        order = order[labels[order].argsort(stable=True)]
+        sorted_labels = labels[order]
+        counts = torch.bincount(sorted_labels)
+        starts = counts.cumsum(0) - counts
+        rank = torch.arange(len(order), device=order.device) - starts[sorted_labels]
+        keep = order[rank < max_per_class]
+        return keep[scores[keep].argsort(descending=True)]
+
     def preprocess_image(self, batched_inputs):
         """
         Normalize, pad and batch the input images.
         """
         images = [self.normalizer(x["image"].to(self.device)) for x in batched_inputs]
         images = ImageList.from_tensors(images, self.size_divisibility)
+        self.log_padding_efficiency(images)
 
-        images_whwh = list()
-        for bi in batched_inputs:
-            h, w = bi["image"].shape[-2:]
-            images_whwh.append(torch.tensor([w, h, w, h], dtype=torch.float32, device=self.device))
-        images_whwh = torch.stack(images_whwh)
+        image_sizes = [bi["image"].shape[-2:] for bi in batched_inputs]
+        images_whwh = torch.tensor([[w, h, w, h] for h, w in image_sizes], dtype=torch.float32, device=self.device)
 
-        return images, images_whwh
\ No newline at end of file
+        return images, images_whwh
+
+    def log_padding_efficiency(self, images):
+        """
+        Log the share of the padded batch covered by images, the backbone compute that isn't spent on padding.
+        """
+        image_pixels = sum(h * w for h, w in images.image_sizes)
+        padded_pixels = images.tensor.shape[0] * images.tensor.shape[-2] * images.tensor.shape[-1]
+        if self.training:
+            try:
+                get_event_storage().put_scalar('padding_efficiency', image_pixels / padded_pixels)
+            except AssertionError:  # not called from a training loop
+                pass
+            return
+        self.inference_pixels[0] += image_pixels
+        self.inference_pixels[1] += padded_pixels
+        log_every_n_seconds(logging.INFO, "Padding efficiency of the inference batches: {:.1%}".format(
+            self.inference_pixels[0] / self.inference_pixels[1]), n=60, name=__name__)
+
+    def log_roi_reuse_rate(self):
+        """
+        Log the share of RoI features the head reused instead of pooling them again, and reset its counts so
+        every forward is logged on its own.
+        """
+        if not self.head.roi_reuse:
+            return
+        stats, rate = self.head.roi_reuse_stats, self.head.roi_reuse_rate()
+        self.head.reset_roi_reuse_stats()
+        try:
+            get_event_storage().put_scalar('roi_reuse_rate', rate)
+        except AssertionError:  # not called from a training loop
+            pass
+        self.roi_reuse_counts[0] += stats["reused"]
+        self.roi_reuse_counts[1] += stats["pooled"] + stats["reused"]
+        if self.roi_reuse_counts[1]:
+            log_every_n_seconds(logging.INFO, "RoI reuse rate of the inference batches: {:.1%}".format(
+                self.roi_reuse_counts[0] / self.roi_reuse_counts[1]), n=60, name=__name__)
\ No newline at end of file
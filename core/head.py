@@ -1,14 +1,19 @@
 import copy
 import math
+import time
 
 import numpy as np
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from einops import rearrange
 
+from torchvision.ops import roi_align
+
 from detectron2.modeling.poolers import ROIPooler
-from detectron2.structures import Boxes
+
+from .util.box_ops import paired_box_iou
 
 _DEFAULT_SCALE_CLAMP = math.log(100000.0 / 16)
 
@@ -47,6 +52,24 @@ class DynamicHead(nn.Module):
         ])
         self.num_heads = num_heads
         self.return_intermediate = cfg.MODEL.DEEP_SUPERVISION
+        self.disentangled = cfg.MODEL.DISENTANGLED
+
+        # Inference-time proposal pruning.
+        self.prune_stage = cfg.MODEL.INFERENCE_PRUNE_STAGE
+        self.prune_score_thresh = cfg.MODEL.INFERENCE_PRUNE_SCORE_THRESH
+        self.prune_topk = cfg.MODEL.INFERENCE_PRUNE_TOPK
+
+        # Anytime inference.
+        self.exit_box_delta = cfg.MODEL.ANYTIME_BOX_DELTA
+        self.exit_score_delta = cfg.MODEL.ANYTIME_SCORE_DELTA
+        self.exit_stage, self.exit_reason = self.num_heads, "complete"
+
+        # Inference-time RoI feature reuse between stages.
+        self.roi_reuse_pixel_tol = cfg.MODEL.ROI_REUSE_PIXEL_TOL
+        self.roi_reuse_iou_thresh = cfg.MODEL.ROI_REUSE_IOU_THRESH
+        self.roi_reuse = self.roi_reuse_pixel_tol > 0 or self.roi_reuse_iou_thresh > 0
+        self.roi_reuse_stats = {"pooled": 0, "reused": 0}
+        self._roi_cache = None
 
         # Gaussian random feature embedding layer for time
         self.d_model = d_model
@@ -87,9 +110,14 @@ class DynamicHead(nn.Module):
             sampling_ratio=sampling_ratio,
             pooler_type=pooler_type,
         )
-        return box_pooler
+        return ProposalPooler(box_pooler, single_call=cfg.MODEL.ROI_POOLER_SINGLE_CALL)
 
-    def forward(self, features, init_bboxes, t, init_features):
+    def forward(self, features, init_bboxes, t, init_features, deadline=None):
+        """
+        Args:
+            deadline (float): optional ``time.perf_counter()`` value, inference stops after the
+                first stage that finishes past it. See :meth:`_early_exit_reason`.
+        """
 
         inter_class_logits = []
         inter_objectness = []
@@ -105,20 +133,246 @@ class DynamicHead(nn.Module):
         else:
             proposal_features = None
 
+        keep_idx = None
+        last_class_logits = last_objectness = last_pred_bboxes = None
+        self.exit_stage, self.exit_reason = self.num_heads, "complete"
+        self._roi_cache = None
+        pooler = self._pool_with_reuse if self.roi_reuse and not self.training else self.box_pooler
         for head_idx, rcnn_head in enumerate(self.head_series):
             class_logits, objectness, pred_bboxes, proposal_features = rcnn_head(features, bboxes, proposal_features,
-                                                                           self.box_pooler)
+                                                                           pooler)
+            bboxes = pred_bboxes.detach()
+            if keep_idx is not None:
+                # pruned proposals keep the predictions of the stage they were dropped at
+                class_logits = _scatter_proposals(last_class_logits, class_logits, keep_idx)
+                objectness = _scatter_proposals(last_objectness, objectness, keep_idx)
+                pred_bboxes = _scatter_proposals(last_pred_bboxes, pred_bboxes, keep_idx)
+            elif not self.training and head_idx + 1 == self.prune_stage and head_idx + 1 < self.num_heads:
+                keep_idx = self._select_proposals(class_logits, objectness)
+                bboxes = _gather_proposals(bboxes, keep_idx)
+                proposal_features = proposal_features.view(len(keep_idx), num_boxes, self.d_model)
+                proposal_features = _gather_proposals(proposal_features, keep_idx).view(1, -1, self.d_model)
+                if self._roi_cache is not None:
+                    cached_boxes, roi_features = self._roi_cache
+                    self._roi_cache = (
+                        _gather_proposals(cached_boxes.view(len(keep_idx), num_boxes, 4), keep_idx).view(-1, 4),
+                        _gather_proposals(roi_features.view(len(keep_idx), num_boxes, -1), keep_idx).view(
+                            -1, *roi_features.shape[1:]))
+
             if self.return_intermediate:
                 inter_class_logits.append(class_logits)
                 inter_objectness.append(objectness)
                 inter_pred_bboxes.append(pred_bboxes)
-            bboxes = pred_bboxes.detach()
+
+            if not self.training and head_idx + 1 < self.num_heads:
+                exit_reason = self._early_exit_reason(class_logits, objectness, pred_bboxes, last_class_logits,
+                                                      last_objectness, last_pred_bboxes, deadline)
+                if exit_reason is not None:
+                    self.exit_stage, self.exit_reason = head_idx + 1, exit_reason
+                    break
+            last_class_logits, last_objectness, last_pred_bboxes = class_logits, objectness, pred_bboxes
+
+        self.box_pooler.clear_cache()
+        self._roi_cache = None
 
         if self.return_intermediate:
             return torch.stack(inter_class_logits), torch.stack(inter_objectness), torch.stack(inter_pred_bboxes)
 
         return class_logits[None], objectness[None], pred_bboxes[None]
 
+    def _pool_with_reuse(self, features, bboxes):
+        """
+        Pool RoI features, reusing the ones pooled at an earlier stage for proposals that barely moved since.
+
+        A proposal is re-pooled when any of its coordinates moved more than MODEL.ROI_REUSE_PIXEL_TOL pixels,
+        or its IoU dropped below MODEL.ROI_REUSE_IOU_THRESH, w.r.t. the box its cached features were pooled
+        at (a criterion set to 0 is ignored). Pooled and reused counts are accumulated in ``roi_reuse_stats``.
+        """
+        boxes = bboxes.reshape(-1, 4)
+        if self._roi_cache is None or self._roi_cache[0].shape != boxes.shape:
+            roi_features = self.box_pooler(features, bboxes)
+            cached_boxes = boxes
+            num_pooled = boxes.shape[0]
+        else:
+            cached_boxes, roi_features = self._roi_cache
+            moved = torch.zeros_like(boxes[:, 0], dtype=torch.bool)
+            if self.roi_reuse_pixel_tol > 0:
+                moved |= (boxes - cached_boxes).abs().amax(dim=-1) > self.roi_reuse_pixel_tol
+            if self.roi_reuse_iou_thresh > 0:
+                moved |= ~(paired_box_iou(boxes, cached_boxes)[0] >= self.roi_reuse_iou_thresh)
+            stale = torch.nonzero(moved, as_tuple=True)[0]
+            num_pooled = len(stale)
+            if num_pooled > 0:
+                roi_features = roi_features.index_copy(0, stale, self.box_pooler(features, bboxes, select=stale))
+                cached_boxes = cached_boxes.index_copy(0, stale, boxes[stale])
+        self._roi_cache = (cached_boxes, roi_features)
+        self.roi_reuse_stats["pooled"] += num_pooled
+        self.roi_reuse_stats["reused"] += boxes.shape[0] - num_pooled
+        return roi_features
+
+    def roi_reuse_rate(self):
+        """Fraction of RoI features served from the reuse cache since the stats were last reset."""
+        total = self.roi_reuse_stats["pooled"] + self.roi_reuse_stats["reused"]
+        return self.roi_reuse_stats["reused"] / total if total else 0.0
+
+    def reset_roi_reuse_stats(self):
+        self.roi_reuse_stats = {"pooled": 0, "reused": 0}
+
+    def _proposal_scores(self, class_logits, objectness):
+        """Per-class scores as used by postprocessing, of shape (N, nr_boxes, K)."""
+        if self.disentangled == 0:
+            return torch.sigmoid(class_logits)
+        return torch.softmax(class_logits, dim=-1) * objectness
+
+    def _early_exit_reason(self, class_logits, objectness, pred_bboxes, last_class_logits, last_objectness,
+                           last_pred_bboxes, deadline):
+        """
+        Decide whether anytime inference can stop after the current stage.
+
+        Returns "deadline" once ``deadline`` has passed, "converged" when the largest box change (in pixels)
+        and score change w.r.t. the previous stage are below MODEL.ANYTIME_BOX_DELTA and
+        MODEL.ANYTIME_SCORE_DELTA (a criterion set to 0 is ignored), or None to keep going.
+        """
+        if deadline is not None:
+            if pred_bboxes.is_cuda:
+                torch.cuda.synchronize(pred_bboxes.device)
+            if time.perf_counter() > deadline:
+                return "deadline"
+
+        if last_pred_bboxes is None or (self.exit_box_delta <= 0 and self.exit_score_delta <= 0):
+            return None
+        if self.exit_box_delta > 0:
+            if (pred_bboxes - last_pred_bboxes).abs().max() >= self.exit_box_delta:
+                return None
+        if self.exit_score_delta > 0:
+            score_delta = self._proposal_scores(class_logits, objectness) - \
+                          self._proposal_scores(last_class_logits, last_objectness)
+            if score_delta.abs().max() >= self.exit_score_delta:
+                return None
+        return "converged"
+
+    def _select_proposals(self, class_logits, objectness):
+        """
+        Pick the proposals that survive inference-time pruning, using the same score as postprocessing.
+        Every row keeps the same number of proposals, so the survivor count is the largest count above
+        the score threshold over the batch, capped by the top-k limit.
+
+        Returns:
+            keep_idx (Tensor): (N, num_keep) proposal indices, sorted by descending score.
+        """
+        scores = self._proposal_scores(class_logits, objectness).max(dim=-1).values
+
+        num_keep = scores.shape[1]
+        if self.prune_score_thresh > 0:
+            num_keep = int((scores > self.prune_score_thresh).sum(dim=1).max().clamp(min=1))
+        if self.prune_topk > 0:
+            num_keep = min(num_keep, self.prune_topk)
+        return scores.topk(num_keep, dim=1).indices
+
+
+class ProposalPooler(nn.Module):
+    """
+    ROI pooling for proposals given as one (num_images, boxes_per_image, 4) tensor.
+
+    It pools exactly like the wrapped detectron2 :class:`ROIPooler`, but assigns FPN levels and batch indices
+    with tensor ops instead of going through per-image :class:`Boxes` lists, and reuses the batch index buffer
+    across head stages while the proposal layout does not change.
+
+    With ``single_call``, all levels are pooled by a single ROIAlign call on the levels padded to the size of
+    the finest one and stacked along the batch dimension. The padded stack is built once per head forward
+    and shared by all stages, it takes #levels times the memory of the finest level, about three times the
+    memory of the FPN features themselves. Results only differ from per-level pooling for sampling points that
+    fall within one feature pixel past the bottom or right border of a coarser level.
+    """
+
+    def __init__(self, pooler, single_call=False):
+        super().__init__()
+        self.pooler = pooler
+        level_pooler = pooler.level_poolers[0]
+        self.single_call = single_call and len(pooler.level_poolers) > 1 and hasattr(level_pooler, "aligned")
+        if self.single_call:
+            self.sampling_ratio = level_pooler.sampling_ratio
+            self.aligned = level_pooler.aligned
+            self.register_buffer('level_scales', torch.tensor([p.spatial_scale for p in pooler.level_poolers]),
+                                 persistent=False)
+        self._batch_index = None
+        self._stacked_features = None
+
+    def clear_cache(self):
+        """Drop the stacked feature maps, called once the head is done with the current images."""
+        self._stacked_features = None
+
+    def _get_batch_index(self, num_images, boxes_per_image, boxes):
+        batch_index = self._batch_index
+        if batch_index is None or batch_index.shape[0] != num_images * boxes_per_image or \
+                batch_index.device != boxes.device or batch_index.dtype != boxes.dtype:
+            batch_index = torch.arange(num_images, device=boxes.device, dtype=boxes.dtype)
+            batch_index = batch_index.repeat_interleave(boxes_per_image)[:, None]
+            self._batch_index = batch_index
+        return batch_index
+
+    def _assign_levels(self, boxes):
+        # same heuristic as detectron2's assign_boxes_to_levels, eqn.(1) in the FPN paper
+        pooler = self.pooler
+        box_sizes = torch.sqrt((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+        level_assignments = torch.floor(
+            pooler.canonical_level + torch.log2(box_sizes / pooler.canonical_box_size + 1e-8))
+        level_assignments = torch.clamp(level_assignments, min=pooler.min_level, max=pooler.max_level)
+        return level_assignments.to(torch.int64) - pooler.min_level
+
+    def _stack_levels(self, features):
+        if self._stacked_features is not None and self._stacked_features[0] is features[0]:
+            return self._stacked_features[1]
+        num_images, channels, height, width = features[0].shape
+        stacked = features[0].new_zeros((len(features), num_images, channels, height, width))
+        for level, feature in enumerate(features):
+            h, w = feature.shape[-2:]
+            stacked[level, :, :, :h, :w] = feature
+            # replicate the border once, so sampling right at the border matches the unpadded map
+            if h < height:
+                stacked[level, :, :, h, :w] = feature[:, :, -1]
+            if w < width:
+                stacked[level, :, :, :h, w] = feature[:, :, :, -1]
+            if h < height and w < width:
+                stacked[level, :, :, h, w] = feature[:, :, -1, -1]
+        stacked = stacked.flatten(0, 1)
+        self._stacked_features = (features[0], stacked)
+        return stacked
+
+    def forward(self, features, bboxes, select=None):
+        """
+        :param features: list of FPN feature maps (num_images, C, H, W)
+        :param bboxes: (num_images, boxes_per_image, 4) absolute (x1, y1, x2, y2)
+        :param select: optional indices into the flattened boxes, only those are pooled
+        :return: (num_images * boxes_per_image, C, output_size, output_size), or (len(select), ...)
+        """
+        pooler = self.pooler
+        num_images, boxes_per_image = bboxes.shape[:2]
+        boxes = bboxes.reshape(-1, 4)
+        batch_index = self._get_batch_index(num_images, boxes_per_image, boxes)
+        if select is not None:
+            boxes, batch_index = boxes[select], batch_index[select]
+        if boxes.shape[0] == 0:
+            return features[0].new_zeros((0, features[0].shape[1]) + pooler.output_size)
+
+        if len(pooler.level_poolers) == 1:
+            return pooler.level_poolers[0](features[0], torch.cat([batch_index, boxes], dim=1))
+
+        level_assignments = self._assign_levels(boxes)
+        if self.single_call:
+            stacked = self._stack_levels(features)
+            rois = torch.cat([batch_index + level_assignments[:, None] * num_images,
+                              boxes * self.level_scales[level_assignments, None]], dim=1)
+            return roi_align(stacked, rois.to(stacked.dtype), pooler.output_size, 1.0, self.sampling_ratio,
+                             self.aligned)
+
+        rois = torch.cat([batch_index, boxes], dim=1)
+        output = features[0].new_zeros((boxes.shape[0], features[0].shape[1]) + pooler.output_size)
+        for level, level_pooler in enumerate(pooler.level_poolers):
+            inds = torch.nonzero(level_assignments == level, as_tuple=True)[0]
+            output.index_put_((inds,), level_pooler(features[level], rois[inds]))
+        return output
+
 
 class RCNNHead(nn.Module):
 
@@ -130,7 +384,7 @@ class RCNNHead(nn.Module):
         self.disentangled = cfg.MODEL.DISENTANGLED
 
         # dynamic.
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = ProposalSelfAttention(cfg, d_model, nhead, dropout=dropout)
         self.inst_interact = DynamicConv(cfg)
 
         self.linear1 = nn.Linear(d_model, dim_feedforward)
@@ -195,10 +449,10 @@ class RCNNHead(nn.Module):
         N, nr_boxes = bboxes.shape[:2]
 
         # roi_feature.
-        proposal_boxes = list()
-        for b in range(N):
-            proposal_boxes.append(Boxes(bboxes[b]))
-        roi_features = pooler(features, proposal_boxes)
+        # N may be a multiple of the image count when several proposal sets are stacked per image,
+        # pool each image's sets together so the rois stay ordered as (N, nr_boxes).
+        num_images = len(features[0])
+        roi_features = pooler(features, bboxes.view(num_images, -1, 4))
 
         if pro_features is None:
             pro_features = roi_features.view(N, nr_boxes, self.d_model, -1).mean(-1)
@@ -206,14 +460,13 @@ class RCNNHead(nn.Module):
         roi_features = roi_features.view(N * nr_boxes, self.d_model, -1).permute(2, 0, 1)
 
         # self_att.
-        pro_features = pro_features.view(N, nr_boxes, self.d_model).permute(1, 0, 2)
-        pro_features2 = self.self_attn(pro_features, pro_features, value=pro_features)[0]
+        pro_features = pro_features.view(N, nr_boxes, self.d_model)
+        pro_features2 = self.self_attn.attend(pro_features)
         pro_features = pro_features + self.dropout1(pro_features2)
         pro_features = self.norm1(pro_features)
 
         # inst_interact.
-        pro_features = pro_features.view(nr_boxes, N, self.d_model).permute(1, 0, 2).reshape(1, N * nr_boxes,
-                                                                                             self.d_model)
+        pro_features = pro_features.reshape(1, N * nr_boxes, self.d_model)
         pro_features2 = self.inst_interact(pro_features, roi_features)
         pro_features = pro_features + self.dropout2(pro_features2)
         obj_features = self.norm2(pro_features)
@@ -314,6 +567,65 @@ class RCNNHead(nn.Module):
         return pred_boxes
 
 
+class ProposalSelfAttention(nn.MultiheadAttention):
+    """
+    Self-attention among the proposals of an image with a selectable execution backend.
+
+    It keeps the parameters of :class:`nn.MultiheadAttention`, so existing checkpoints load unchanged
+    and the backend can be switched with MODEL.ATTENTION_BACKEND:
+
+    * "mha": the stock nn.MultiheadAttention kernel in sequence-first layout.
+    * "sdpa": F.scaled_dot_product_attention in batch-first layout.
+    * "chunked": exact attention computed over query chunks of MODEL.ATTENTION_CHUNK_SIZE,
+      peak memory grows linearly instead of quadratically in the number of proposals.
+    * "topk": sparse approximation where every query only attends to its MODEL.ATTENTION_TOPK
+      highest scoring keys, computed in query chunks as above.
+    """
+
+    def __init__(self, cfg, embed_dim, num_heads, dropout=0.0):
+        super().__init__(embed_dim, num_heads, dropout=dropout)
+        self.backend = cfg.MODEL.ATTENTION_BACKEND
+        self.chunk_size = cfg.MODEL.ATTENTION_CHUNK_SIZE
+        self.topk = cfg.MODEL.ATTENTION_TOPK
+        assert self.backend in ("mha", "sdpa", "chunked", "topk"), f"unknown attention backend {self.backend}"
+
+    def attend(self, x):
+        """
+        :param x: (N, nr_boxes, d_model)
+        :return: (N, nr_boxes, d_model)
+        """
+        if self.backend == "mha":
+            x = x.transpose(0, 1)
+            return self(x, x, value=x, need_weights=False)[0].transpose(0, 1)
+
+        N, L, _ = x.shape
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = [y.view(N, L, self.num_heads, self.head_dim).transpose(1, 2) for y in (q, k, v)]
+        dropout_p = self.dropout if self.training else 0.0
+
+        if self.backend == "sdpa":
+            out = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        else:
+            q = q * self.head_dim ** -0.5
+            out = torch.cat([self._attend_chunk(q_chunk, k, v, dropout_p)
+                             for q_chunk in q.split(self.chunk_size, dim=2)], dim=2)
+
+        out = out.transpose(1, 2).reshape(N, L, self.embed_dim)
+        return self.out_proj(out)
+
+    def _attend_chunk(self, q, k, v, dropout_p):
+        attn = torch.matmul(q, k.transpose(-2, -1))  # (N, nhead, chunk, L)
+        if self.backend == "topk" and self.topk < k.shape[2]:
+            attn, topk_idx = attn.topk(self.topk, dim=-1)
+            attn = F.dropout(attn.softmax(dim=-1), p=dropout_p)
+            # (N, nhead, chunk, topk, head_dim) values of the selected keys
+            v = v[:, :, None].expand(-1, -1, q.shape[2], -1, -1)
+            v = v.gather(3, topk_idx[..., None].expand(-1, -1, -1, -1, self.head_dim))
+            return torch.matmul(attn[..., None, :], v).squeeze(-2)
+        attn = F.dropout(attn.softmax(dim=-1), p=dropout_p)
+        return torch.matmul(attn, v)
+
+
 class DynamicConv(nn.Module):
 
     def __init__(self, cfg):
@@ -335,11 +647,31 @@ class DynamicConv(nn.Module):
         self.out_layer = nn.Linear(num_output, self.hidden_dim)
         self.norm3 = nn.LayerNorm(self.hidden_dim)
 
+        # Proposals per chunk, 0 generates the dynamic parameters of all proposals at once.
+        self.chunk_size = cfg.MODEL.DYNAMIC_CONV_CHUNK_SIZE
+
     def forward(self, pro_features, roi_features):
         '''
         pro_features: (1,  N * nr_boxes, self.d_model)
         roi_features: (49, N * nr_boxes, self.d_model)
         '''
+        if self.chunk_size <= 0 or pro_features.shape[1] <= self.chunk_size:
+            return self._dynamic_conv(pro_features, roi_features)
+
+        # Every proposal only interacts with its own parameters, so proposals can be processed in chunks and
+        # only one chunk of (num_dynamic * hidden_dim * dim_dynamic) parameters is alive at a time. In training
+        # the chunks are recomputed in backward instead of keeping their parameters for autograd.
+        recompute = torch.is_grad_enabled() and (pro_features.requires_grad or roi_features.requires_grad)
+        outputs = []
+        for pro_chunk, roi_chunk in zip(pro_features.split(self.chunk_size, dim=1),
+                                        roi_features.split(self.chunk_size, dim=1)):
+            if recompute:
+                outputs.append(checkpoint(self._dynamic_conv, pro_chunk, roi_chunk, use_reentrant=False))
+            else:
+                outputs.append(self._dynamic_conv(pro_chunk, roi_chunk))
+        return torch.cat(outputs)
+
+    def _dynamic_conv(self, pro_features, roi_features):
         features = roi_features.permute(1, 0, 2)
         parameters = self.dynamic_layer(pro_features).permute(1, 0, 2)
 
@@ -362,6 +694,16 @@ class DynamicConv(nn.Module):
         return features
 
 
+def _gather_proposals(x, keep_idx):
+    """Select proposals ``keep_idx`` (N, K) from ``x`` (N, nr_boxes, C)."""
+    return x.gather(1, keep_idx[..., None].expand(-1, -1, x.shape[-1]))
+
+
+def _scatter_proposals(x, src, keep_idx):
+    """Return a copy of ``x`` (N, nr_boxes, C) with proposals ``keep_idx`` (N, K) replaced by ``src``."""
+    return x.scatter(1, keep_idx[..., None].expand(-1, -1, x.shape[-1]), src)
+
+
 def _get_activation_fn(activation):
     """Return an activation function given a string"""
     if activation == "relu":
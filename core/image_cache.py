@@ -0,0 +1,135 @@
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+from fvcore.common.file_io import PathManager
+
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+
+__all__ = ["ImageCache", "image_cache_params"]
+
+
+def image_cache_params(cfg, is_train):
+    """
+    (short edge, max size, format) of the resize that DatasetMapper applies, None if it isn't deterministic:
+    a cache only holds one size per image.
+    """
+    if is_train:
+        if cfg.INPUT.CROP.ENABLED or len(set(cfg.INPUT.MIN_SIZE_TRAIN)) != 1:
+            return None
+        return cfg.INPUT.MIN_SIZE_TRAIN[0], cfg.INPUT.MAX_SIZE_TRAIN, cfg.INPUT.FORMAT
+    return cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST, cfg.INPUT.FORMAT
+
+
+def _resize_image(args):
+    file_name, short_edge, max_size, format = args
+    image = utils.read_image(file_name, format=format)
+    height, width = image.shape[:2]
+    tfm = T.ResizeShortestEdge(short_edge, max_size, "choice").get_transform(image)
+    image = np.ascontiguousarray(tfm.apply_image(image).transpose(2, 0, 1))
+    return file_name, (height, width), image
+
+
+class ImageCache:
+    """
+    Resized uint8 CHW images in one memory-mapped file, with an index of their offsets, keyed by absolute file
+    name so that relative and absolute file names of the same image hit the same entry.
+
+    A cache holds the images of one resize, its files are ``<key>.bin`` and ``<key>.index.npz`` in the cache
+    directory, the key is made of the resize parameters. Build it with :meth:`build` or build_image_cache.py.
+    The data file is only mapped on the first read, so the cache can be pickled to data loader workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with PathManager.open(path + ".index.npz", "rb") as f:
+            index = np.load(f)
+            self.file_names = index["file_names"].tolist()
+            self.offsets = index["offsets"]
+            self.shapes = index["shapes"]
+            self.src_shapes = index["src_shapes"]
+        # indexes written with relative names resolve against the working directory, as their reads did
+        self._rows = {os.path.abspath(file_name): row for row, file_name in enumerate(self.file_names)}
+        self._data = None
+
+    @staticmethod
+    def key(short_edge, max_size, format):
+        return "short{}_max{}_{}".format(short_edge, max_size, format)
+
+    @classmethod
+    def open(cls, cache_dir, short_edge, max_size, format):
+        """The cache of this resize in ``cache_dir``, None if it hasn't been built."""
+        path = os.path.join(cache_dir, cls.key(short_edge, max_size, format))
+        if not PathManager.exists(path + ".index.npz"):
+            logging.getLogger(__name__).info("No image cache at {}, build it with build_image_cache.py.".format(path))
+            return None
+        return cls(path)
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def get(self, file_name):
+        """The cached CHW image of ``file_name`` and the (height, width) of the original, None if not cached."""
+        row = self._rows.get(os.path.abspath(file_name))
+        if row is None:
+            return None
+        if self._data is None:
+            # copy-on-write, so tensors can wrap the pages without copying and never write back
+            self._data = np.memmap(PathManager.get_local_path(self.path + ".bin"), dtype=np.uint8, mode="c")
+        shape = tuple(self.shapes[row])
+        offset = self.offsets[row]
+        image = self._data[offset:offset + int(np.prod(shape))].reshape(shape)
+        return image, tuple(self.src_shapes[row])
+
+    @classmethod
+    def build(cls, cache_dir, file_names, short_edge, max_size, format, num_workers=0):
+        """
+        Resize ``file_names`` and add them to the cache, with ``num_workers`` processes. Images already in the
+        cache are skipped, so an interrupted build can be resumed.
+        """
+        path = os.path.join(cache_dir, cls.key(short_edge, max_size, format))
+        PathManager.mkdirs(cache_dir)
+        names, offsets, shapes, src_shapes = [], [], [], []
+        if PathManager.exists(path + ".index.npz"):
+            cache = cls(path)
+            names, offsets = list(cache.file_names), list(cache.offsets)
+            shapes, src_shapes = [tuple(s) for s in cache.shapes], [tuple(s) for s in cache.src_shapes]
+        done = {os.path.abspath(f) for f in names}
+        todo = sorted({os.path.abspath(f) for f in file_names} - done)
+
+        logger = logging.getLogger(__name__)
+        logger.info("Caching {} images in {}, {} are already there.".format(len(todo), path, len(done)))
+        end = offsets[-1] + int(np.prod(shapes[-1])) if names else 0
+        args = [(file_name, short_edge, max_size, format) for file_name in todo]
+        pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+        try:
+            results = pool.imap(_resize_image, args, chunksize=16) if pool else map(_resize_image, args)
+            with open(path + ".bin", "r+b" if done else "wb") as f:
+                f.truncate(end)  # drop a partial image left by an interrupted build
+                f.seek(end)
+                for i, (file_name, src_shape, image) in enumerate(results):
+                    f.write(image.data)
+                    names.append(file_name)
+                    offsets.append(end)
+                    shapes.append(image.shape)
+                    src_shapes.append(src_shape)
+                    end += image.nbytes
+                    if (i + 1) % 1000 == 0:
+                        logger.info("Cached {} / {} images.".format(i + 1, len(todo)))
+        finally:
+            if pool is not None:
+                pool.close()
+            # write-then-rename, readers only ever see complete indexes
+            tmp_path = "{}.{}.tmp.npz".format(path, os.getpid())
+            np.savez(tmp_path, file_names=np.array(names, dtype=np.str_), offsets=np.array(offsets, dtype=np.int64),
+                     shapes=np.array(shapes, dtype=np.int64).reshape(-1, 3),
+                     src_shapes=np.array(src_shapes, dtype=np.int64).reshape(-1, 2))
+            os.replace(tmp_path, path + ".index.npz")
+        return cls(path)
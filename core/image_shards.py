@@ -0,0 +1,291 @@
+import hashlib
+import itertools
+import logging
+import math
+import operator
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import torch
+from fvcore.common.file_io import PathManager
+
+import detectron2.utils.comm as comm
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.build import trivial_batch_collator, worker_init_reset_seed
+from detectron2.data.common import AspectRatioGroupedDataset
+
+from .annotation_index import CompactAnnotations
+from .batching import BucketedBatchDataset
+
+__all__ = ["ImageShards", "ImageShardDataset", "build_sharded_train_loader"]
+
+
+def annotation_digest(dataset_dicts):
+    """Fingerprint of the images and the :class:`CompactAnnotations` of dataset dicts, in any order."""
+    digests = []
+    for dataset_dict in dataset_dicts:
+        annotations = dataset_dict["annotations"]
+        digest = hashlib.sha1(os.path.basename(dataset_dict["file_name"]).encode())
+        digest.update(np.ascontiguousarray(annotations.boxes, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(annotations.category_ids, dtype=np.int64).tobytes())
+        digests.append(digest.hexdigest())
+    return hashlib.sha1("".join(sorted(digests)).encode()).hexdigest()
+
+
+def _read_file(file_name):
+    with PathManager.open(file_name, "rb") as f:
+        return f.read()
+
+
+def _read_files(pool, file_names, window):
+    """
+    The contents of ``file_names`` in order, read by ``pool`` ``window`` files at a time. The next window is read
+    while the previous one is consumed, so at most two windows are held in memory.
+    """
+    pending = None
+    for start in range(0, len(file_names), window):
+        next_window = pool.map_async(_read_file, file_names[start:start + window])
+        if pending is not None:
+            yield from pending.get()
+        pending = next_window
+    if pending is not None:
+        yield from pending.get()
+
+
+class ImageShards:
+    """
+    Encoded images and their annotation arrays packed in a few large ``shard-<i>.bin`` files, so training reads
+    them sequentially instead of opening one small file per image.
+
+    Each record of a shard is the encoded image followed by the XYXY_ABS boxes (float64) and category ids (int64)
+    of its :class:`CompactAnnotations`. ``index.npz`` holds the shard, offset and sizes of every record and the
+    rest of its dataset dict. Shards hold the dataset dicts of one image set, with the annotations of one task,
+    which :meth:`open` checks. Build them with :meth:`write` or build_image_shards.py.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with PathManager.open(os.path.join(path, "index.npz"), "rb") as f:
+            index = np.load(f)
+            self.digest = str(index["digest"])
+            self.num_shards = int(index["num_shards"])
+            self.file_names = index["file_names"].tolist()
+            self.image_ids = index["image_ids"].tolist()
+            self.heights = index["heights"].tolist()
+            self.widths = index["widths"].tolist()
+            self.shards = index["shards"]
+            self.offsets = index["offsets"]
+            self.image_sizes = index["image_sizes"]
+            self.num_objects = index["num_objects"]
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @classmethod
+    def open(cls, shard_dir, split, dataset_dicts):
+        """The shards of ``split`` in ``shard_dir``, None if they haven't been built for these dataset dicts."""
+        path = os.path.join(shard_dir, split.replace("/", "_"))
+        logger = logging.getLogger(__name__)
+        if not PathManager.exists(os.path.join(path, "index.npz")):
+            logger.info("No image shards at {}, build them with build_image_shards.py.".format(path))
+            return None
+        shards = cls(path)
+        if shards.digest != annotation_digest(dataset_dicts):
+            logger.warning("The image shards at {} hold other annotations, rebuild them.".format(path))
+            return None
+        return shards
+
+    def shard_file(self, shard):
+        return os.path.join(self.path, "shard-{:05d}.bin".format(shard))
+
+    def chunks(self, num_chunks):
+        """
+        Split the shards into at least ``num_chunks`` contiguous runs of records (shard, first row, end row), each
+        shard into the same number of runs.
+        """
+        per_shard = math.ceil(num_chunks / self.num_shards)
+        bounds = np.searchsorted(self.shards, np.arange(self.num_shards + 1))
+        chunks = []
+        for shard in range(self.num_shards):
+            rows = np.linspace(bounds[shard], bounds[shard + 1], per_shard + 1).astype(np.int64)
+            chunks.extend((shard, start, end) for start, end in zip(rows[:-1].tolist(), rows[1:].tolist())
+                          if end > start)
+        return chunks
+
+    def read(self, shard, start, end, filter_empty=False):
+        """
+        The dataset dicts of rows ``start:end`` of ``shard``, with their encoded image as "image_bytes". With
+        ``filter_empty``, the images without annotations are skipped.
+        """
+        with PathManager.open(self.shard_file(shard), "rb", buffering=1 << 22) as f:
+            f.seek(int(self.offsets[start]))
+            for row in range(start, end):
+                num_objects = int(self.num_objects[row])
+                if filter_empty and num_objects == 0:
+                    f.seek(int(self.image_sizes[row]), os.SEEK_CUR)
+                    continue
+                image_bytes = f.read(int(self.image_sizes[row]))
+                boxes = np.frombuffer(f.read(32 * num_objects), dtype=np.float64).reshape(-1, 4)
+                category_ids = np.frombuffer(f.read(8 * num_objects), dtype=np.int64)
+                yield {
+                    "file_name": self.file_names[row],
+                    "image_id": self.image_ids[row],
+                    "height": self.heights[row],
+                    "width": self.widths[row],
+                    "annotations": CompactAnnotations(boxes, category_ids),
+                    "image_bytes": image_bytes,
+                }
+
+    @classmethod
+    def write(cls, shard_dir, split, dataset_dicts, shard_size=1 << 29, num_workers=8, seed=0):
+        """
+        Pack the images of ``dataset_dicts`` into shards of about ``shard_size`` bytes, in a random order so
+        that consecutive records aren't related. ``num_workers`` threads read the image files, 16 per thread at a
+        time.
+        """
+        path = os.path.join(shard_dir, split.replace("/", "_"))
+        PathManager.mkdirs(path)
+        if PathManager.exists(os.path.join(path, "index.npz")):
+            os.remove(os.path.join(path, "index.npz"))  # the old shards are overwritten below
+        dataset_dicts = [dataset_dicts[i] for i in np.random.RandomState(seed).permutation(len(dataset_dicts))]
+        file_names = [dataset_dict["file_name"] for dataset_dict in dataset_dicts]
+
+        logger = logging.getLogger(__name__)
+        logger.info("Packing {} images into shards in {}.".format(len(dataset_dicts), path))
+        shards, offsets, image_sizes, num_objects = [], [], [], []
+        shard, offset, f = -1, shard_size, None
+        num_workers = max(num_workers, 1)
+        with ThreadPool(num_workers) as pool:
+            for i, (dataset_dict, image_bytes) in enumerate(
+                    zip(dataset_dicts, _read_files(pool, file_names, num_workers * 16))):
+                if offset >= shard_size:
+                    if f is not None:
+                        f.close()
+                    shard, offset = shard + 1, 0
+                    f = open(os.path.join(path, "shard-{:05d}.bin".format(shard)), "wb")
+                annotations = dataset_dict["annotations"]
+                assert isinstance(annotations, CompactAnnotations), "Only CompactAnnotations can be packed"
+                record = b"".join([image_bytes, np.ascontiguousarray(annotations.boxes, dtype=np.float64).tobytes(),
+                                   np.ascontiguousarray(annotations.category_ids, dtype=np.int64).tobytes()])
+                f.write(record)
+                shards.append(shard)
+                offsets.append(offset)
+                image_sizes.append(len(image_bytes))
+                num_objects.append(len(annotations))
+                offset += len(record)
+                if (i + 1) % 10000 == 0:
+                    logger.info("Packed {} / {} images.".format(i + 1, len(dataset_dicts)))
+        if f is not None:
+            f.close()
+
+        # write-then-rename, readers only ever see complete indexes
+        tmp_path = os.path.join(path, "index.{}.tmp.npz".format(os.getpid()))
+        np.savez(tmp_path, digest=np.array(annotation_digest(dataset_dicts)), num_shards=np.array(shard + 1),
+                 file_names=np.array(file_names, dtype=np.str_),
+                 image_ids=np.array([str(d["image_id"]) for d in dataset_dicts], dtype=np.str_),
+                 heights=np.array([d["height"] for d in dataset_dicts], dtype=np.int64),
+                 widths=np.array([d["width"] for d in dataset_dicts], dtype=np.int64),
+                 shards=np.array(shards, dtype=np.int64), offsets=np.array(offsets, dtype=np.int64),
+                 image_sizes=np.array(image_sizes, dtype=np.int64), num_objects=np.array(num_objects, dtype=np.int64))
+        os.replace(tmp_path, os.path.join(path, "index.npz"))
+        return cls(path)
+
+
+class ImageShardDataset(torch.utils.data.IterableDataset):
+    """
+    An infinite stream of dataset dicts read sequentially from :class:`ImageShards`, mapped by ``mapper`` if
+    it's given.
+
+    Every epoch, the shards are split into contiguous chunks of records which are shuffled with a seed shared
+    by all ranks, and dealt out to the data loader workers of all ranks, so every worker reads different
+    chunks. The records of each worker go through a shuffle buffer of ``shuffle_buffer`` encoded images. With
+    ``filter_empty``, the images without annotations are left out.
+    """
+
+    def __init__(self, shards, mapper=None, shuffle_buffer=1024, seed=None, filter_empty=False):
+        self.shards = shards
+        self.mapper = mapper
+        self.shuffle_buffer = shuffle_buffer
+        self.filter_empty = filter_empty
+        self.seed = comm.shared_random_seed() if seed is None else seed
+        self.rank = comm.get_rank()
+        self.world_size = comm.get_world_size()
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = self.rank * num_workers + (0 if worker_info is None else worker_info.id)
+        num_readers = self.world_size * num_workers
+        chunks = [(shards, chunk) for shards in self.shards for chunk in shards.chunks(num_readers)]
+        assert len(chunks) >= num_readers, "Fewer images than data loader workers"
+
+        rng = np.random.RandomState([self.seed, worker_id])
+        buffer = []
+        for epoch in itertools.count():
+            order = np.random.RandomState([self.seed, epoch]).permutation(len(chunks))
+            for i in order[worker_id::num_readers].tolist():
+                shards, (shard, start, end) = chunks[i]
+                for dataset_dict in shards.read(shard, start, end, self.filter_empty):
+                    if len(buffer) < self.shuffle_buffer:
+                        buffer.append(dataset_dict)
+                        continue
+                    if buffer:
+                        j = rng.randint(len(buffer))
+                        buffer[j], dataset_dict = dataset_dict, buffer[j]
+                    if self.mapper is not None:
+                        dataset_dict = self.mapper(dataset_dict)
+                        if dataset_dict is None:
+                            continue
+                    yield dataset_dict
+
+
+def build_sharded_train_loader(cfg, mapper):
+    """
+    A train loader of the :class:`ImageShards` in DATALOADER.IMAGE_SHARD_DIR, None if some datasets of
+    DATASETS.TRAIN haven't been packed, or not with their current annotations, or if DATALOADER.SAMPLER_TRAIN
+    isn't the TrainingSampler, whose uniform shuffling is all the shards can do.
+
+    Images are batched like ``build_detection_train_loader`` does, or by :class:`BucketedBatchDataset` with
+    DATALOADER.BUCKETED_BATCHING.
+    """
+    logger = logging.getLogger(__name__)
+    if cfg.DATALOADER.SAMPLER_TRAIN != "TrainingSampler":
+        logger.warning("Image shards can't be read with the {}, reading the image files.".format(
+            cfg.DATALOADER.SAMPLER_TRAIN))
+        return None
+
+    shards = []
+    for name in cfg.DATASETS.TRAIN:
+        dataset_shards = ImageShards.open(cfg.DATALOADER.IMAGE_SHARD_DIR, MetadataCatalog.get(name).split,
+                                          DatasetCatalog.get(name))
+        if dataset_shards is None:
+            return None
+        shards.append(dataset_shards)
+
+    world_size = comm.get_world_size()
+    total_batch_size = cfg.SOLVER.IMS_PER_BATCH
+    assert total_batch_size > 0 and total_batch_size % world_size == 0, \
+        "Total batch size ({}) must be divisible by the number of gpus ({}).".format(total_batch_size, world_size)
+    batch_size = total_batch_size // world_size
+    filter_empty = cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS
+    num_images = sum(int(np.count_nonzero(s.num_objects)) if filter_empty else len(s) for s in shards)
+    logger.info("Reading {} images from shards".format(num_images))
+
+    if cfg.DATALOADER.BUCKETED_BATCHING:
+        dataset = ImageShardDataset(shards, shuffle_buffer=cfg.DATALOADER.SHARD_SHUFFLE_BUFFER,
+                                    filter_empty=filter_empty)
+        dataset = BucketedBatchDataset(dataset, mapper, None, batch_size, cfg.DATALOADER.BUCKET_ASPECT_RATIOS)
+        return torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=cfg.DATALOADER.NUM_WORKERS,
+                                           collate_fn=trivial_batch_collator, worker_init_fn=worker_init_reset_seed)
+
+    dataset = ImageShardDataset(shards, mapper, shuffle_buffer=cfg.DATALOADER.SHARD_SHUFFLE_BUFFER,
+                                filter_empty=filter_empty)
+    if cfg.DATALOADER.ASPECT_RATIO_GROUPING:
+        data_loader = torch.utils.data.DataLoader(dataset, num_workers=cfg.DATALOADER.NUM_WORKERS,
+                                                  collate_fn=operator.itemgetter(0),
+                                                  worker_init_fn=worker_init_reset_seed)
+        return AspectRatioGroupedDataset(data_loader, batch_size)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, drop_last=True,
+                                       num_workers=cfg.DATALOADER.NUM_WORKERS, collate_fn=trivial_batch_collator,
+                                       worker_init_fn=worker_init_reset_seed)
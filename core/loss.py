@@ -1,12 +1,93 @@
 import torch
 import torch.nn.functional as F
 from torch import nn
-from fvcore.nn import sigmoid_focal_loss_jit
-import torchvision.ops as ops
+from torch.nn.utils.rnn import pad_sequence
 from .util import box_ops
 from .util.box_ops import box_cxcywh_to_xyxy, box_xyxy_to_cxcywh, generalized_box_iou
-import copy
+import logging
+import time
 import numpy as np
+from detectron2.utils.events import get_event_storage
+from detectron2.utils.logger import log_every_n_seconds
+from .util.sync_debug import SyncCounter
+
+
+def _softplus(x):
+    """ log(1 + exp(x)), i.e. the binary cross entropy of logit x against target 0. """
+    return x.clamp(min=0) + torch.log1p(torch.exp(-x.abs()))
+
+
+def sparse_sigmoid_focal_loss(logits, prob, target_classes, alpha: float = 0.25, gamma: float = 2):
+    """
+    Summed sigmoid focal loss of ``logits`` [..., K] against one-hot targets given as class indices
+    ``target_classes`` [...], where an index outside [0, K) means background, without building the one-hot tensor.
+
+    Every logit takes the negative term, computed in closed form over the whole tensor, and the matched
+    (query, class) pairs then swap it for the positive term. ``prob`` is ``sigmoid(logits)``.
+    """
+    num_classes = logits.shape[-1]
+    loss = ((1 - alpha) * _softplus(logits) * prob ** gamma).sum()
+
+    is_pos = (target_classes >= 0) & (target_classes < num_classes)
+    pos_idx = target_classes.clamp(0, num_classes - 1).unsqueeze(-1)
+    pos_logits = logits.gather(-1, pos_idx).squeeze(-1)
+    pos_prob = prob.gather(-1, pos_idx).squeeze(-1)
+    correction = alpha * _softplus(-pos_logits) * (1 - pos_prob) ** gamma - \
+        (1 - alpha) * _softplus(pos_logits) * pos_prob ** gamma
+    return loss + torch.where(is_pos, correction, torch.zeros_like(correction)).sum()
+
+
+def split_targets(targets):
+    """
+    Per-image target dicts from the packed targets of RandBox.prepare_targets, lists are returned unchanged.
+
+    The packed form holds the per-gt fields "labels", "boxes", "boxes_xyxy", "image_size_xyxy_tgt" and "area"
+    concatenated over the images, the [bs, 4] "image_size_xyxy", the per-gt "batch_idx" and "gt_idx" (index
+    within its image) and the host-side list "num_gts".
+    """
+    if isinstance(targets, (list, tuple)):
+        return targets
+    num_gts = targets["num_gts"]
+    fields = ("labels", "boxes", "boxes_xyxy", "image_size_xyxy_tgt", "area")
+    split_fields = {k: targets[k].split(num_gts) for k in fields}
+    return [dict({k: split_fields[k][i] for k in fields}, image_size_xyxy=targets["image_size_xyxy"][i])
+            for i in range(len(num_gts))]
+
+
+def pad_targets(targets):
+    """
+    Pad the gt sets of per-image or packed targets to the largest one in the batch.
+
+    Returns "labels" [bs, max_gt], "boxes_xyxy" [bs, max_gt, 4] (padded with a unit box, so the padded entries
+    stay finite through the iou terms), "image_size_xyxy_tgt" [bs, max_gt, 4] (padded with ones),
+    "image_size_xyxy" [bs, 4], the validity mask "valid" [bs, max_gt] and the list "num_gts".
+    """
+    if isinstance(targets, (list, tuple)):
+        valid = pad_sequence([torch.ones_like(t["labels"], dtype=torch.bool) for t in targets], batch_first=True)
+        boxes_xyxy = pad_sequence([t["boxes_xyxy"] for t in targets], batch_first=True)
+        return {
+            "labels": pad_sequence([t["labels"] for t in targets], batch_first=True),
+            "boxes_xyxy": torch.where(valid[..., None], boxes_xyxy, boxes_xyxy.new_tensor([0., 0., 1., 1.])),
+            "image_size_xyxy_tgt": pad_sequence([t["image_size_xyxy_tgt"] for t in targets], batch_first=True,
+                                                padding_value=1.0),
+            "image_size_xyxy": torch.stack([t["image_size_xyxy"] for t in targets]),
+            "valid": valid,
+            "num_gts": [len(t["labels"]) for t in targets],
+        }
+
+    num_gts = targets["num_gts"]
+    shape = (len(num_gts), max(num_gts, default=0))
+    index = (targets["batch_idx"], targets["gt_idx"])
+    boxes_xyxy = targets["boxes_xyxy"]
+    return {
+        "labels": targets["labels"].new_zeros(shape).index_put_(index, targets["labels"]),
+        "boxes_xyxy": boxes_xyxy.new_tensor([0., 0., 1., 1.]).repeat(*shape, 1).index_put_(index, boxes_xyxy),
+        "image_size_xyxy_tgt": boxes_xyxy.new_ones(shape + (4,)).index_put_(index, targets["image_size_xyxy_tgt"]),
+        "image_size_xyxy": targets["image_size_xyxy"],
+        "valid": torch.zeros(shape, dtype=torch.bool, device=boxes_xyxy.device).index_put_(
+            index, torch.ones_like(targets["labels"], dtype=torch.bool)),
+        "num_gts": num_gts,
+    }
 
 
 class SetCriterionDynamicK(nn.Module):
@@ -38,56 +119,44 @@ class SetCriterionDynamicK(nn.Module):
         self.focal_loss_alpha = cfg.MODEL.ALPHA
         self.focal_loss_gamma = cfg.MODEL.GAMMA
         self.disentangled = cfg.MODEL.DISENTANGLED
+        self.paired_iou = {
+            'giou': box_ops.paired_generalized_box_iou,
+            'diou': box_ops.paired_distance_box_iou,
+            'ciou': box_ops.paired_complete_box_iou,
+        }[cfg.MODEL.IOU_LOSS_TYPE]
+
+        self.aux_matching = cfg.MODEL.AUX_MATCHING
+        assert self.aux_matching in ('full', 'reuse', 'stride', 'periodic'), self.aux_matching
+        self.aux_matching_stride = cfg.MODEL.AUX_MATCHING_STRIDE
+        self.aux_matching_period = cfg.MODEL.AUX_MATCHING_PERIOD
+        self._matching_time, self._num_matchings = 0.0, 0
+
+        self.sync_free = cfg.MODEL.SYNC_FREE
+        self.sync_debug = cfg.MODEL.SYNC_DEBUG
+        self._prob_cache = {}
 
     def loss_labels(self, outputs, targets, indices):
         """Classification loss (NLL)
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
         assert 'pred_logits' in outputs
-        if self.disentangled == 0:
-            src_logits = outputs['pred_logits']
-        else:
-            assert 'pred_objectness' in outputs
-            src_prob = torch.softmax(outputs['pred_logits'], dim=-1) * outputs['pred_objectness']
-            src_logits = torch.log(src_prob / (1 - src_prob))
-        batch_size = len(targets)
+        src_prob, src_logits = self._get_src_prob(outputs)
 
         if self.cfg.TEST.MASK == 2:
             seen_logits = list(range(0, self.cfg.TEST.PREV_INTRODUCED_CLS))
             masked_logit = src_logits.clone()
             masked_logit[..., seen_logits] = -10e10
             src_logits = masked_logit
+            masked_prob = src_prob.clone()
+            masked_prob[..., seen_logits] = 0
+            src_prob = masked_prob
 
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=src_logits.device)
-        src_logits_list = []
-        target_classes_o_list = []
-        for batch_idx in range(batch_size):
-            valid_query = indices[batch_idx][0]
-            gt_multi_idx = indices[batch_idx][1]
-            if len(gt_multi_idx) == 0:
-                continue
-            bz_src_logits = src_logits[batch_idx]
-            target_classes_o = targets[batch_idx]["labels"]
-            target_classes[batch_idx, valid_query] = target_classes_o[gt_multi_idx]
+        target_classes, num_boxes = self._get_target_classes(src_logits, targets, indices)
 
-            src_logits_list.append(bz_src_logits[valid_query])
-            target_classes_o_list.append(target_classes_o[gt_multi_idx])
+        cls_loss = sparse_sigmoid_focal_loss(src_logits, src_prob, target_classes, alpha=self.focal_loss_alpha,
+                                             gamma=self.focal_loss_gamma)
 
-        num_boxes = torch.cat(target_classes_o_list).shape[0] if len(target_classes_o_list) != 0 else 1
-
-        target_classes_onehot = torch.zeros([src_logits.shape[0], src_logits.shape[1], self.num_classes + 1],
-                                            dtype=src_logits.dtype, layout=src_logits.layout,
-                                            device=src_logits.device)
-        target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
-        target_classes_onehot = target_classes_onehot[:, :, :-1]
-
-        src_logits = src_logits.flatten(0, 1)
-        target_classes_onehot = target_classes_onehot.flatten(0, 1)
-        cls_loss = sigmoid_focal_loss_jit(src_logits, target_classes_onehot, alpha=self.focal_loss_alpha,
-                                              gamma=self.focal_loss_gamma, reduction="none")
-
-        losses = {'loss_ce': torch.sum(cls_loss) / num_boxes}
+        losses = {'loss_ce': cls_loss / num_boxes}
 
         return losses
 
@@ -96,44 +165,14 @@ class SetCriterionDynamicK(nn.Module):
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
         assert 'pred_logits' in outputs
-        if self.disentangled == 0:
-            src_logits = outputs['pred_logits']
-        else:
-            assert 'pred_objectness' in outputs
-            src_prob = torch.softmax(outputs['pred_logits'], dim=-1) * outputs['pred_objectness']
-            src_logits = torch.log(src_prob / (1 - src_prob))
-        batch_size = len(targets)
+        src_prob, src_logits = self._get_src_prob(outputs)
 
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=src_logits.device)
-        src_logits_list = []
-        target_classes_o_list = []
-        for batch_idx in range(batch_size):
-            valid_query = indices[batch_idx][0]
-            gt_multi_idx = indices[batch_idx][1]
-            if len(gt_multi_idx) == 0:
-                continue
-            bz_src_logits = src_logits[batch_idx]
-            target_classes_o = targets[batch_idx]["labels"]
-            target_classes[batch_idx, valid_query] = target_classes_o[gt_multi_idx]
-
-            src_logits_list.append(bz_src_logits[valid_query])
-            target_classes_o_list.append(target_classes_o[gt_multi_idx])
-
-        num_boxes = torch.cat(target_classes_o_list).shape[0] if len(target_classes_o_list) != 0 else 1
+        target_classes, num_boxes = self._get_target_classes(src_logits, targets, indices)
 
-        target_classes_onehot = torch.zeros([src_logits.shape[0], src_logits.shape[1], self.num_classes + 1],
-                                            dtype=src_logits.dtype, layout=src_logits.layout,
-                                            device=src_logits.device)
-        target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
-        target_classes_onehot = target_classes_onehot[:, :, :-1]
+        cls_loss = sparse_sigmoid_focal_loss(src_logits, src_prob, target_classes, alpha=self.focal_loss_alpha,
+                                             gamma=self.focal_loss_gamma)
 
-        src_logits = src_logits.flatten(0, 1)
-        target_classes_onehot = target_classes_onehot.flatten(0, 1)
-        cls_loss = sigmoid_focal_loss_jit(src_logits, target_classes_onehot, alpha=self.focal_loss_alpha,
-                                          gamma=self.focal_loss_gamma, reduction="none")
-
-        losses = {'loss_nc_ce': torch.sum(cls_loss) / num_boxes}
+        losses = {'loss_nc_ce': cls_loss / num_boxes}
 
         return losses
 
@@ -143,6 +182,8 @@ class SetCriterionDynamicK(nn.Module):
            The target boxes are expected in format (center_x, center_y, w, h), normalized by the image size.
         """
         assert 'pred_boxes' in outputs
+        if self.sync_free:
+            return self._loss_boxes_dense(outputs, targets, indices)
         # idx = self._get_src_permutation_idx(indices)
         src_boxes = outputs['pred_boxes']
 
@@ -178,7 +219,7 @@ class SetCriterionDynamicK(nn.Module):
             losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
             # loss_giou = giou_loss(box_ops.box_cxcywh_to_xyxy(src_boxes), box_ops.box_cxcywh_to_xyxy(target_boxes))
-            loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(src_boxes, target_boxes_abs_xyxy))
+            loss_giou = 1 - self.paired_iou(src_boxes, target_boxes_abs_xyxy)
             losses['loss_giou'] = loss_giou.sum() / num_boxes
         else:
             losses = {'loss_bbox': outputs['pred_boxes'].sum() * 0,
@@ -186,6 +227,34 @@ class SetCriterionDynamicK(nn.Module):
 
         return losses
 
+    def _loss_boxes_dense(self, outputs, targets, indices):
+        """ loss_boxes for the sync-free matcher output, where every query carries a gt index and the losses
+        of the unmatched ones are masked out instead of indexed away.
+        """
+        src_boxes = outputs['pred_boxes']
+        loss_bbox, loss_giou, num_boxes = 0, 0, 0
+        for batch_idx in range(len(targets)):
+            valid_query = indices[batch_idx][0]
+            gt_multi_idx = indices[batch_idx][1]
+            if len(gt_multi_idx) == 0:
+                continue
+            bz_image_whwh = targets[batch_idx]['image_size_xyxy']
+            bz_src_boxes = src_boxes[batch_idx]
+            bz_target_boxes = targets[batch_idx]["boxes"][gt_multi_idx]  # normalized (cx, cy, w, h)
+            bz_target_boxes_xyxy = targets[batch_idx]["boxes_xyxy"][gt_multi_idx]  # absolute (x1, y1, x2, y2)
+
+            bz_loss_bbox = F.l1_loss(bz_src_boxes / bz_image_whwh, box_cxcywh_to_xyxy(bz_target_boxes),
+                                     reduction='none').sum(-1)
+            bz_loss_giou = 1 - self.paired_iou(bz_src_boxes, bz_target_boxes_xyxy)
+            loss_bbox = loss_bbox + torch.where(valid_query, bz_loss_bbox, torch.zeros_like(bz_loss_bbox)).sum()
+            loss_giou = loss_giou + torch.where(valid_query, bz_loss_giou, torch.zeros_like(bz_loss_giou)).sum()
+            num_boxes = num_boxes + valid_query.sum()
+
+        if isinstance(num_boxes, int):
+            return {'loss_bbox': src_boxes.sum() * 0, 'loss_giou': src_boxes.sum() * 0}
+        num_boxes = num_boxes.clamp(min=1)
+        return {'loss_bbox': loss_bbox / num_boxes, 'loss_giou': loss_giou / num_boxes}
+
     def loss_decorr(self, outputs, targets, indices):
         assert self.disentangled != 0
         cls_scores = outputs['pred_logits'].softmax(-1).flatten(0, 1).detach()
@@ -198,6 +267,48 @@ class SetCriterionDynamicK(nn.Module):
 
         return {'loss_decorr': loss_decorr}
 
+    def _get_src_prob(self, outputs):
+        """ Class probabilities and the matching logits of ``outputs``, computed once per output and shared by the
+        classification losses of one forward, the cache is emptied when it starts and ends.
+        """
+        key = id(outputs['pred_logits'])
+        cached = self._prob_cache.get(key)
+        # the cached entry holds its pred_logits, so only the very same tensor hits
+        if cached is None or cached[0] is not outputs['pred_logits']:
+            if self.disentangled == 0:
+                src_logits = outputs['pred_logits']
+                src_prob = src_logits.sigmoid()
+            else:
+                assert 'pred_objectness' in outputs
+                src_prob = torch.softmax(outputs['pred_logits'], dim=-1) * outputs['pred_objectness']
+                src_logits = torch.log(src_prob / (1 - src_prob))
+            self._prob_cache[key] = (outputs['pred_logits'], src_prob, src_logits)
+        return self._prob_cache[key][1:]
+
+    def _get_target_classes(self, src_logits, targets, indices):
+        """ Per-query target classes (num_classes for the background) and the number of matched queries. """
+        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
+                                    dtype=torch.int64, device=src_logits.device)
+        num_boxes = 0
+        for batch_idx in range(len(targets)):
+            valid_query = indices[batch_idx][0]
+            gt_multi_idx = indices[batch_idx][1]
+            if len(gt_multi_idx) == 0:
+                continue
+            target_classes_o = targets[batch_idx]["labels"]
+            if self.sync_free:
+                # gt_multi_idx holds a gt for every query, only the valid ones are kept
+                target_classes[batch_idx] = torch.where(valid_query, target_classes_o[gt_multi_idx],
+                                                        target_classes[batch_idx])
+                num_boxes = num_boxes + valid_query.sum()
+            else:
+                target_classes[batch_idx, valid_query] = target_classes_o[gt_multi_idx]
+                num_boxes += len(gt_multi_idx)
+
+        if self.sync_free and not isinstance(num_boxes, int):
+            return target_classes, num_boxes.clamp(min=1)
+        return target_classes, max(num_boxes, 1)
+
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
         batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
@@ -225,13 +336,32 @@ class SetCriterionDynamicK(nn.Module):
         Parameters:
              outputs: dict of tensors, see the output specification of the model for the format
              targets: list of dicts, such that len(targets) == batch_size.
-                      The expected keys in each dict depends on the losses applied, see each loss' doc
+                      The expected keys in each dict depends on the losses applied, see each loss' doc.
+                      The packed targets of RandBox.prepare_targets are accepted too, see split_targets.
         """
+        if not self.sync_debug:
+            return self._compute_losses(outputs, targets)
+
+        with SyncCounter() as sync_counter:
+            losses = self._compute_losses(outputs, targets)
+        try:
+            get_event_storage().put_scalar('sync_count', sync_counter.total, smoothing_hint=False)
+        except AssertionError:  # not called from a training loop
+            pass
+        log_every_n_seconds(logging.INFO, "Host-device syncs in the loss: {}".format(sync_counter.summary()),
+                            n=60, name=__name__)
+        return losses
+
+    def _compute_losses(self, outputs, targets):
         self.start_count += 1
+        self._prob_cache = {}
+        self._matching_time, self._num_matchings = 0.0, 0
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs'}
+        # the matcher pads the packed targets directly, the losses work on the per-image ones
+        matcher_targets, targets = targets, split_targets(targets)
 
         # Retrieve the matching between the outputs of the last layer and the targets
-        indices, _, ow_indices, unknown_targets = self.matcher(outputs_without_aux, targets)
+        indices, ow_indices, unknown_targets = self._match(outputs_without_aux, matcher_targets)
 
         # Compute all the requested losses
         losses = {}
@@ -244,8 +374,10 @@ class SetCriterionDynamicK(nn.Module):
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
+            aux_matches = self._match_aux_outputs(outputs['aux_outputs'], matcher_targets,
+                                                  (indices, ow_indices, unknown_targets))
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices, _, ow_indices, unknown_targets = self.matcher(aux_outputs, targets)
+                indices, ow_indices, unknown_targets = aux_matches[i]
                 for loss in self.losses:
                     if loss == 'nc_labels':
                         if self.start_count > self.start_iter:
@@ -257,8 +389,45 @@ class SetCriterionDynamicK(nn.Module):
                         l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
                         losses.update(l_dict)
 
+        self._prob_cache = {}
+        self._log_matching_time()
         return losses
 
+    def _match(self, outputs, targets):
+        start = time.perf_counter()
+        indices, _, ow_indices, unknown_targets = self.matcher(outputs, targets)
+        self._matching_time += time.perf_counter() - start
+        self._num_matchings += 1
+        return indices, ow_indices, unknown_targets
+
+    def _match_aux_outputs(self, aux_outputs, targets, final_match):
+        """ Return the matching used for each auxiliary output, following MODEL.AUX_MATCHING.
+        Reused matchings only ever come from the current batch, a cached assignment would point at other targets.
+        """
+        num_aux = len(aux_outputs)
+        if self.aux_matching == 'full' or \
+                (self.aux_matching == 'periodic' and (self.start_count - 1) % self.aux_matching_period == 0):
+            return [self._match(aux, targets) for aux in aux_outputs]
+
+        if self.aux_matching == 'stride':
+            aux_matches = [None] * num_aux
+            match = final_match
+            for i in reversed(range(num_aux)):
+                if (num_aux - i) % self.aux_matching_stride == 0:
+                    match = self._match(aux_outputs[i], targets)
+                aux_matches[i] = match
+            return aux_matches
+
+        return [final_match] * num_aux
+
+    def _log_matching_time(self):
+        try:
+            storage = get_event_storage()
+        except AssertionError:  # not called from a training loop
+            return
+        storage.put_scalar('matching_time_{}'.format(self.aux_matching), self._matching_time, smoothing_hint=True)
+        storage.put_scalar('matching_count', self._num_matchings, smoothing_hint=True)
+
 
 class HungarianMatcherDynamicK(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
@@ -284,6 +453,7 @@ class HungarianMatcherDynamicK(nn.Module):
         self.focal_loss_alpha = cfg.MODEL.ALPHA
         self.focal_loss_gamma = cfg.MODEL.GAMMA
         self.disentangled = cfg.MODEL.DISENTANGLED
+        self.sync_free = cfg.MODEL.SYNC_FREE
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
     def forward(self, outputs, targets):
@@ -462,180 +632,227 @@ class HungarianMatcherDynamicK(nn.Module):
                 out_prob = torch.softmax(outputs['pred_logits'], dim=-1) * outputs['pred_objectness']
             out_bbox = outputs["pred_boxes"]  # [batch_size,  num_queries, 4]
             
-            indices, matched_ids, unknown_labels, ow_indices = [], [], [], []
-            for batch_idx in range(bs):
-                bz_boxes = out_bbox[batch_idx]  # [num_proposals, 4]
-                bz_out_prob = out_prob[batch_idx]
-                bz_tgt_ids = targets[batch_idx]["labels"]
-                num_insts = len(bz_tgt_ids)
-                if num_insts == 0:  # empty object in key frame
-                    non_valid = torch.zeros(bz_out_prob.shape[0]).to(bz_out_prob) > 0
-                    indices_batchi = (non_valid, torch.arange(0, 0).to(bz_out_prob))
-                    matched_qidx = torch.arange(0, 0).to(bz_out_prob)
-                    indices.append(indices_batchi)
-                    matched_ids.append(matched_qidx)
-                else:
-                    bz_gtboxs = targets[batch_idx]['boxes']  # [num_gt, 4] normalized (cx, xy, w, h)
-                    bz_gtboxs_abs_xyxy = targets[batch_idx]['boxes_xyxy']
-                    fg_mask, is_in_boxes_and_center = self.get_in_boxes_info(
-                        box_xyxy_to_cxcywh(bz_boxes),  # absolute (cx, cy, w, h)
-                        box_xyxy_to_cxcywh(bz_gtboxs_abs_xyxy),  # absolute (cx, cy, w, h)
-                        expanded_strides=32
-                    )
-
-                    pair_wise_ious = ops.box_iou(bz_boxes, bz_gtboxs_abs_xyxy)
-
-                    # Compute the classification cost.
-                    alpha = self.focal_loss_alpha
-                    gamma = self.focal_loss_gamma
-                    neg_cost_class = (1 - alpha) * (bz_out_prob ** gamma) * (-(1 - bz_out_prob + 1e-8).log())
-                    pos_cost_class = alpha * ((1 - bz_out_prob) ** gamma) * (-(bz_out_prob + 1e-8).log())
-                    cost_class = pos_cost_class[:, bz_tgt_ids] - neg_cost_class[:, bz_tgt_ids]
-
-                    # Compute the L1 cost between boxes
-                    # image_size_out = torch.cat([v["image_size_xyxy"].unsqueeze(0) for v in targets])
-                    # image_size_out = image_size_out.unsqueeze(1).repeat(1, num_queries, 1).flatten(0, 1)
-                    # image_size_tgt = torch.cat([v["image_size_xyxy_tgt"] for v in targets])
-
-                    bz_image_size_out = targets[batch_idx]['image_size_xyxy']
-                    bz_image_size_tgt = targets[batch_idx]['image_size_xyxy_tgt']
-
-                    bz_out_bbox_ = bz_boxes / bz_image_size_out  # normalize (x1, y1, x2, y2)
-                    bz_tgt_bbox_ = bz_gtboxs_abs_xyxy / bz_image_size_tgt  # normalize (x1, y1, x2, y2)
-                    cost_bbox = torch.cdist(bz_out_bbox_, bz_tgt_bbox_, p=1)
-
-                    cost_giou = -generalized_box_iou(bz_boxes, bz_gtboxs_abs_xyxy)
-
-                    # Final cost matrix
-                    cost = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou + 100.0 * (
-                        ~is_in_boxes_and_center)
-                    # cost = (cost_class + 3.0 * cost_giou + 100.0 * (~is_in_boxes_and_center))  # [num_query,num_gt]
-                    cost[~fg_mask] = cost[~fg_mask] + 10000.0
-
-                    # if bz_gtboxs.shape[0]>0:
-                    indices_batchi, matched_qidx = self.dynamic_k_matching(cost, pair_wise_ious, bz_gtboxs.shape[0])
-
-                    indices.append(indices_batchi)
-                    matched_ids.append(matched_qidx)
-
-                if self.cfg.MODEL.NC:
-                    #                 ==========================================================
-                    forward_score = torch.sum(bz_out_prob, dim=1)
-                    _, forward_index = torch.topk(forward_score, self.forward_k, largest=True, sorted=True)
-                    forward_index_list = forward_index.cpu().numpy().tolist()
-                    unknown_label = []
-                    for each in forward_index_list:
-                        if each not in matched_qidx.cpu().numpy().tolist():
-                            unknown_label.append(each)
-                    unknown_indices_batchi_a = copy.deepcopy(indices_batchi[0])
-                    unknown_indices_batchi_b = torch.tensor([0] * len(unknown_label), dtype=torch.long,
-                                                            device=unknown_indices_batchi_a.device)
-                    for each in range(unknown_indices_batchi_a.shape[0]):
-                        if each in unknown_label:
-                            unknown_indices_batchi_a[each] = True
-                        else:
-                            unknown_indices_batchi_a[each] = False
-
-                    unknown_labels.append(unknown_label)
-                    ow_indices.append((unknown_indices_batchi_a, unknown_indices_batchi_b))
-                                    # ==========================================================
-
-            #         ==================================================
-            unknown_targets = []
-            for i, unknown_label in enumerate(unknown_labels):
-                unity_label = [self.cfg.MODEL.NUM_CLASSES-1] * len(unknown_label)
-                unity_boxes = targets[i]['image_size_xyxy'].unsqueeze(0)
-                unity_boxes_xyxy = targets[i]['image_size_xyxy'].unsqueeze(0)
-                unity_image_size_xyxy_tgt = targets[i]['image_size_xyxy'].unsqueeze(0)
-                unity_area = targets[i]['image_size_xyxy'].unsqueeze(0)
-                unknown_target = {'labels': torch.tensor(unity_label, dtype=torch.long, device=targets[0]['labels'].device),
-                                  'boxes': unity_boxes.repeat(len(unknown_label), 1),
-                                  'image_size_xyxy': targets[i]['image_size_xyxy'],
-                                  'boxes_xyxy': unity_boxes_xyxy.repeat(len(unknown_label), 1),
-                                  'image_size_xyxy_tgt': unity_image_size_xyxy_tgt.repeat(len(unknown_label), 1),
-                                  'area': unity_area.repeat(len(unknown_label), 1)}
-                unknown_targets.append(unknown_target)
-            #         ==================================================
+            padded_targets = pad_targets(targets)
+            indices, matched_ids, matched_query = self.batched_matching(out_prob, out_bbox, padded_targets)
+
+            ow_indices, unknown_targets = [], []
+            if self.cfg.MODEL.NC:
+                ow_indices, unknown_targets = self.select_unknowns(out_prob, matched_query, padded_targets)
 
             return indices, matched_ids, ow_indices, unknown_targets
 
-    def get_in_boxes_info(self, boxes, target_gts, expanded_strides):
+    def batched_matching(self, out_prob, out_bbox, targets):
+        """
+        SimOTA for the whole batch at once, on the GT sets padded to the largest one by pad_targets.
+
+        Returns per-image ``indices`` ((selected_query, gt_indices) pairs) and ``matched_ids``, the same
+        assignment as matching every image on its own, and a [bs, num_queries] mask of the queries in
+        ``matched_ids``. With MODEL.SYNC_FREE, ``gt_indices`` holds a gt index for every query (meaningful
+        where ``selected_query`` is set), which avoids sizing the per-image tensors on the host.
+        """
+        bs, num_queries = out_prob.shape[:2]
+        num_gts = targets["num_gts"]
+        if max(num_gts) == 0:
+            non_valid = out_prob.new_zeros(num_queries) > 0
+            return [(non_valid, torch.arange(0, 0).to(out_prob)) for _ in range(bs)], \
+                   [torch.arange(0, 0).to(out_prob) for _ in range(bs)], \
+                   out_prob.new_zeros((bs, num_queries), dtype=torch.bool)
+
+        gt_valid = targets["valid"]  # [bs, max_gt]
+        tgt_ids = targets["labels"]
+        gtboxs_abs_xyxy = targets["boxes_xyxy"]
+        image_size_out = targets["image_size_xyxy"][:, None]  # [bs, 1, 4]
+        image_size_tgt = targets["image_size_xyxy_tgt"]
+
+        fg_mask, is_in_boxes_and_center = self.get_in_boxes_info(
+            box_xyxy_to_cxcywh(out_bbox),  # absolute (cx, cy, w, h)
+            box_xyxy_to_cxcywh(gtboxs_abs_xyxy),  # absolute (cx, cy, w, h)
+            expanded_strides=32,
+            gt_valid=gt_valid,
+        )
+
+        pair_wise_ious = box_ops.box_iou(out_bbox, gtboxs_abs_xyxy)[0]
+
+        # Compute the classification cost.
+        alpha = self.focal_loss_alpha
+        gamma = self.focal_loss_gamma
+        neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
+        pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
+        gather_ids = tgt_ids[:, None].expand(-1, num_queries, -1)
+        cost_class = pos_cost_class.gather(2, gather_ids) - neg_cost_class.gather(2, gather_ids)
+
+        # Compute the L1 cost between boxes
+        out_bbox_ = out_bbox / image_size_out  # normalize (x1, y1, x2, y2)
+        tgt_bbox_ = gtboxs_abs_xyxy / image_size_tgt  # normalize (x1, y1, x2, y2)
+        cost_bbox = torch.cdist(out_bbox_, tgt_bbox_, p=1)
+
+        cost_giou = -generalized_box_iou(out_bbox, gtboxs_abs_xyxy, validate=not self.sync_free)
+
+        # Final cost matrix
+        cost = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou + 100.0 * (
+            ~is_in_boxes_and_center)
+        cost = torch.where(fg_mask[..., None], cost, cost + 10000.0)
+        cost = cost.masked_fill(~gt_valid[:, None], float('inf'))
+
+        matching_matrix, matched_query_id = self.dynamic_k_matching(cost, pair_wise_ious, gt_valid)
+
+        selected_query = matching_matrix.sum(2) > 0  # [bs, num_queries]
+        gt_indices = matching_matrix.argmax(2)
+        if not self.sync_free:
+            gt_indices = gt_indices[selected_query].split(selected_query.sum(1).tolist())
+        indices, matched_ids = [], []
+        for batch_idx in range(bs):
+            if num_gts[batch_idx] == 0:
+                indices.append((selected_query[batch_idx], torch.arange(0, 0).to(out_prob)))
+                matched_ids.append(torch.arange(0, 0).to(out_prob))
+            else:
+                indices.append((selected_query[batch_idx], gt_indices[batch_idx]))
+                matched_ids.append(matched_query_id[batch_idx, :num_gts[batch_idx]])
+        # padded gts point at query 0, add rather than scatter so they can't clear a real match there
+        matched_query = torch.zeros_like(cost[..., 0]).scatter_add_(1, matched_query_id, gt_valid.to(cost)) > 0
+        return indices, matched_ids, matched_query
+
+    def select_unknowns(self, out_prob, matched_query, targets):
+        """
+        Pseudo targets for the NC loss: among the FORWARD_K queries with the largest summed class probability,
+        the ones not matched to any gt become unknowns, each with a whole-image box labelled as the last class.
+
+        Returns per-image ``ow_indices`` ((unknown_query, zero gt indices) pairs) and ``unknown_targets``,
+        ``targets`` are padded by pad_targets.
+        """
+        forward_score = torch.sum(out_prob, dim=2)
+        _, forward_index = torch.topk(forward_score, self.forward_k, dim=1, largest=True, sorted=True)
+        unknown_query = torch.zeros_like(matched_query).scatter_(1, forward_index, True) & ~matched_query
+        if self.sync_free:
+            return self._select_unknowns_dense(unknown_query, targets)
+        num_unknowns = unknown_query.sum(1)
+
+        image_size_xyxy = targets['image_size_xyxy']
+        unity_boxes = image_size_xyxy.repeat_interleave(num_unknowns, dim=0)
+        unity_labels = torch.full((len(unity_boxes),), self.cfg.MODEL.NUM_CLASSES - 1, dtype=torch.long,
+                                  device=targets['labels'].device)
+        num_unknowns = num_unknowns.tolist()
+
+        ow_indices, unknown_targets = [], []
+        for i, (unity_label, unity_box) in enumerate(zip(unity_labels.split(num_unknowns),
+                                                         unity_boxes.split(num_unknowns))):
+            ow_indices.append((unknown_query[i], torch.zeros_like(unity_label, device=unknown_query.device)))
+            unknown_targets.append({'labels': unity_label,
+                                    'boxes': unity_box,
+                                    'image_size_xyxy': image_size_xyxy[i],
+                                    'boxes_xyxy': unity_box,
+                                    'image_size_xyxy_tgt': unity_box,
+                                    'area': unity_box})
+        return ow_indices, unknown_targets
+
+    def _select_unknowns_dense(self, unknown_query, targets):
+        """ select_unknowns without host syncs: each image gets a single unknown target and every query points
+        at it, ``unknown_query`` tells which queries are actually unknowns.
+        """
+        ow_indices, unknown_targets = [], []
+        gt_indices = torch.zeros_like(unknown_query, dtype=torch.long)
+        for i, image_size_xyxy in enumerate(targets['image_size_xyxy']):
+            unity_box = image_size_xyxy.unsqueeze(0)
+            ow_indices.append((unknown_query[i], gt_indices[i]))
+            unknown_targets.append({'labels': torch.full((1,), self.cfg.MODEL.NUM_CLASSES - 1, dtype=torch.long,
+                                                         device=targets['labels'].device),
+                                    'boxes': unity_box,
+                                    'image_size_xyxy': image_size_xyxy,
+                                    'boxes_xyxy': unity_box,
+                                    'image_size_xyxy_tgt': unity_box,
+                                    'area': unity_box})
+        return ow_indices, unknown_targets
+
+    def get_in_boxes_info(self, boxes, target_gts, expanded_strides, gt_valid=None):
+        """
+        boxes [..., num_query, 4] and target_gts [..., num_gt, 4] are absolute (cx, cy, w, h), padded gts
+        are excluded with ``gt_valid`` [..., num_gt].
+        """
         xy_target_gts = box_cxcywh_to_xyxy(target_gts)  # (x1, y1, x2, y2)
 
-        anchor_center_x = boxes[:, 0].unsqueeze(1)
-        anchor_center_y = boxes[:, 1].unsqueeze(1)
+        anchor_center_x = boxes[..., 0].unsqueeze(-1)
+        anchor_center_y = boxes[..., 1].unsqueeze(-1)
 
         # whether the center of each anchor is inside a gt box
-        b_l = anchor_center_x > xy_target_gts[:, 0].unsqueeze(0)
-        b_r = anchor_center_x < xy_target_gts[:, 2].unsqueeze(0)
-        b_t = anchor_center_y > xy_target_gts[:, 1].unsqueeze(0)
-        b_b = anchor_center_y < xy_target_gts[:, 3].unsqueeze(0)
+        b_l = anchor_center_x > xy_target_gts[..., 0].unsqueeze(-2)
+        b_r = anchor_center_x < xy_target_gts[..., 2].unsqueeze(-2)
+        b_t = anchor_center_y > xy_target_gts[..., 1].unsqueeze(-2)
+        b_b = anchor_center_y < xy_target_gts[..., 3].unsqueeze(-2)
         # (b_l.long()+b_r.long()+b_t.long()+b_b.long())==4 [300,num_gt] ,
         is_in_boxes = ((b_l.long() + b_r.long() + b_t.long() + b_b.long()) == 4)
-        is_in_boxes_all = is_in_boxes.sum(1) > 0  # [num_query]
+        if gt_valid is not None:
+            is_in_boxes &= gt_valid.unsqueeze(-2)
+        is_in_boxes_all = is_in_boxes.sum(-1) > 0  # [num_query]
         # in fixed center
         center_radius = 2.5
         # Modified to self-adapted sampling --- the center size depends on the size of the gt boxes
         # https://github.com/dulucas/UVO_Challenge/blob/main/Track1/detection/mmdet/core/bbox/assigners/rpn_sim_ota_assigner.py#L212
         b_l = anchor_center_x > (
-                    target_gts[:, 0] - (center_radius * (xy_target_gts[:, 2] - xy_target_gts[:, 0]))).unsqueeze(0)
+                    target_gts[..., 0] - (center_radius * (xy_target_gts[..., 2] - xy_target_gts[..., 0]))).unsqueeze(-2)
         b_r = anchor_center_x < (
-                    target_gts[:, 0] + (center_radius * (xy_target_gts[:, 2] - xy_target_gts[:, 0]))).unsqueeze(0)
+                    target_gts[..., 0] + (center_radius * (xy_target_gts[..., 2] - xy_target_gts[..., 0]))).unsqueeze(-2)
         b_t = anchor_center_y > (
-                    target_gts[:, 1] - (center_radius * (xy_target_gts[:, 3] - xy_target_gts[:, 1]))).unsqueeze(0)
+                    target_gts[..., 1] - (center_radius * (xy_target_gts[..., 3] - xy_target_gts[..., 1]))).unsqueeze(-2)
         b_b = anchor_center_y < (
-                    target_gts[:, 1] + (center_radius * (xy_target_gts[:, 3] - xy_target_gts[:, 1]))).unsqueeze(0)
+                    target_gts[..., 1] + (center_radius * (xy_target_gts[..., 3] - xy_target_gts[..., 1]))).unsqueeze(-2)
 
         is_in_centers = ((b_l.long() + b_r.long() + b_t.long() + b_b.long()) == 4)
-        is_in_centers_all = is_in_centers.sum(1) > 0
+        if gt_valid is not None:
+            is_in_centers &= gt_valid.unsqueeze(-2)
+        is_in_centers_all = is_in_centers.sum(-1) > 0
 
         is_in_boxes_anchor = is_in_boxes_all | is_in_centers_all
         is_in_boxes_and_center = (is_in_boxes & is_in_centers)
 
         return is_in_boxes_anchor, is_in_boxes_and_center
 
-    def dynamic_k_matching(self, cost, pair_wise_ious, num_gt):
-        matching_matrix = torch.zeros_like(cost)  # [300,num_gt]
-        ious_in_boxes_matrix = pair_wise_ious
+    def dynamic_k_matching(self, cost, pair_wise_ious, gt_valid):
+        """
+        Batched dynamic-k assignment on [bs, num_query, max_gt] costs, padded gt columns hold inf cost.
+
+        Every gt takes its dynamic_k cheapest queries, found with a single top-k of size OTA_K (dynamic_k never
+        exceeds it), instead of one top-k per gt. Queries claimed by several gts keep the cheapest one, and gts
+        left without a query take the cheapest unmatched one, as in the per-image implementation.
+        Note ``cost`` is updated in place.
+
+        Returns the [bs, num_query, max_gt] matching matrix and the [bs, max_gt] cheapest matched query per gt.
+        """
+        num_queries = cost.shape[1]
         n_candidate_k = self.ota_k
 
         # Take the sum of the predicted value and the top 10 iou of gt with the largest iou as dynamic_k
-        topk_ious, _ = torch.topk(ious_in_boxes_matrix, n_candidate_k, dim=0)
-        dynamic_ks = torch.clamp(topk_ious.sum(0).int(), min=1)
-
-        for gt_idx in range(num_gt):
-            _, pos_idx = torch.topk(cost[:, gt_idx], k=dynamic_ks[gt_idx].item(), largest=False)
-            matching_matrix[:, gt_idx][pos_idx] = 1.0
+        topk_ious, _ = torch.topk(pair_wise_ious, n_candidate_k, dim=1)
+        dynamic_ks = torch.clamp(topk_ious.sum(1).int(), min=1)  # [bs, max_gt]
 
+        _, pos_idx = torch.topk(cost, k=n_candidate_k, dim=1, largest=False)
+        in_k = torch.arange(n_candidate_k, device=cost.device)[None, :, None] < dynamic_ks[:, None]
+        matching_matrix = torch.zeros_like(cost).scatter_(1, pos_idx, (in_k & gt_valid[:, None]).to(cost))
         del topk_ious, dynamic_ks, pos_idx
 
-        anchor_matching_gt = matching_matrix.sum(1)
-
-        if (anchor_matching_gt > 1).sum() > 0:
-            _, cost_argmin = torch.min(cost[anchor_matching_gt > 1], dim=1)
-            matching_matrix[anchor_matching_gt > 1] *= 0
-            matching_matrix[anchor_matching_gt > 1, cost_argmin,] = 1
-
-        while (matching_matrix.sum(0) == 0).any():
-            num_zero_gt = (matching_matrix.sum(0) == 0).sum()
-            matched_query_id = matching_matrix.sum(1) > 0
-            cost[matched_query_id] += 100000.0
-            unmatch_id = torch.nonzero(matching_matrix.sum(0) == 0, as_tuple=False).squeeze(1)
-            for gt_idx in unmatch_id:
-                pos_idx = torch.argmin(cost[:, gt_idx])
-                matching_matrix[:, gt_idx][pos_idx] = 1.0
-            if (matching_matrix.sum(1) > 1).sum() > 0:  # If a query matches more than one gt
-                _, cost_argmin = torch.min(cost[anchor_matching_gt > 1],
-                                           dim=1)  # find gt for these queries with minimal cost
-                matching_matrix[anchor_matching_gt > 1] *= 0  # reset mapping relationship
-                matching_matrix[anchor_matching_gt > 1, cost_argmin,] = 1  # keep gt with minimal cost
-
-        assert not (matching_matrix.sum(0) == 0).any()
-        selected_query = matching_matrix.sum(1) > 0
-        gt_indices = matching_matrix[selected_query].max(1)[1]
-        assert selected_query.sum() == len(gt_indices)
-
-        cost[matching_matrix == 0] = cost[matching_matrix == 0] + float('inf')
-        matched_query_id = torch.min(cost, dim=0)[1]
-
-        return (selected_query, gt_indices), matched_query_id
\ No newline at end of file
+        def _keep_cheapest_gt(matching_matrix, rows):
+            cost_argmin = F.one_hot(cost.argmin(2), cost.shape[2]).to(cost)
+            return torch.where(rows[..., None], cost_argmin, matching_matrix)
+
+        anchor_matching_gt = matching_matrix.sum(2)  # [bs, num_query]
+        multiple_match = anchor_matching_gt > 1
+        matching_matrix = _keep_cheapest_gt(matching_matrix, multiple_match)
+
+        unmatched_gt = (matching_matrix.sum(1) == 0) & gt_valid
+        unmatched_image = unmatched_gt.any(1)
+        # the sync-free mode runs a single masked round, which matches every gt unless all queries are taken
+        while self.sync_free or unmatched_image.any():
+            matched_query_id = (matching_matrix.sum(2) > 0) & unmatched_image[:, None]
+            cost += 100000.0 * matched_query_id[..., None]
+            pos_idx = torch.argmin(cost, dim=1, keepdim=True)
+            matching_matrix.scatter_add_(1, pos_idx, unmatched_gt[:, None].to(cost))
+            # If a query matches more than one gt, keep the gt with minimal cost. Like the per-image
+            # implementation, this resets the queries that matched several gts before the loop.
+            reset_image = (matching_matrix.sum(2) > 1).any(1) & unmatched_image
+            matching_matrix = _keep_cheapest_gt(matching_matrix, multiple_match & reset_image[:, None])
+            unmatched_gt = (matching_matrix.sum(1) == 0) & gt_valid
+            unmatched_image = unmatched_gt.any(1)
+            if self.sync_free:
+                break
+
+        matched_query_id = torch.where(matching_matrix == 0, cost + float('inf'), cost).argmin(1)
+        return matching_matrix, matched_query_id
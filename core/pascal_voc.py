@@ -1,15 +1,16 @@
 import numpy as np
 import os
-import xml.etree.ElementTree as ET
 from typing import List, Tuple, Union
 from fvcore.common.file_io import PathManager
 import itertools
 import logging
+import threading
 
 from detectron2.data import DatasetCatalog, MetadataCatalog
-from detectron2.structures import BoxMode
 
-__all__ = ["load_voc_instances", "register_pascal_voc"]
+from .annotation_index import AnnotationIndex, CompactAnnotations
+
+__all__ = ["VOCAnnotationStore", "load_voc_instances", "register_pascal_voc"]
 
 VOC_CLASS_NAMES_COCOFIED = [
     "airplane", "dining table", "motorcycle",
@@ -87,86 +88,171 @@ VOC_COCO_CLASS_NAMES["S-OWODB"] = tuple(
     itertools.chain(T1_CLASS_NAMES, T2_CLASS_NAMES, T3_CLASS_NAMES, T4_CLASS_NAMES, UNK_CLASS))
 
 
+class VOCAnnotationStore:
+    """
+    The annotations of one image set, parsed once per process and shared by everything that needs them: the
+    dataset dicts of the train loader and of the PreciseBN loader, and the ground truth of the evaluator.
+
+    Get the store of an image set with :meth:`get`. It holds the :class:`AnnotationIndex` of the image set,
+    the XML files are parsed in parallel and cached on disk when DATASETS.ANNOTATION_CACHE_DIR is set. The
+    images in the COCO json files of DATASETS.COCO_ANNOTATION_FILES are read from the json instead of the XML
+    that coco_to_voc.py writes for them, with the same result.
+    """
+
+    _stores = {}
+    _lock = threading.Lock()
+
+    def __init__(self, dirname, split, cache_dir="", num_workers=0, coco_files=()):
+        with PathManager.open(os.path.join(dirname, "ImageSets", "Main", split + ".txt")) as f:
+            fileids = np.loadtxt(f, dtype=np.str_)
+        # Needs to read many small annotation files. Makes sense at local
+        annotation_dirname = PathManager.get_local_path(os.path.join(dirname, "Annotations/"))
+        cache_file = os.path.join(cache_dir, split.replace("/", "_") + ".annidx") if cache_dir else ""
+
+        self.dirname = dirname
+        self.split = split
+        self.fileids = np.atleast_1d(fileids).tolist()
+        coco_files = [PathManager.get_local_path(coco_file) for coco_file in coco_files]
+        self.index = AnnotationIndex.get(annotation_dirname, self.fileids, cache_file, num_workers, coco_files)
+        self._rows = {fileid: row for row, fileid in enumerate(self.index.file_ids.tolist())}
+        self._class_ids = {}
+        self._eval_labels = (None, None)
+
+        logger = logging.getLogger(__name__)
+        for anno_file in self.index.missing:
+            logger.info('Not able to load: ' + anno_file + '. Continuing without aboarting...')
+
+    @classmethod
+    def get(cls, dirname, split, cfg=None):
+        key = (os.path.normpath(dirname), split)
+        with cls._lock:
+            if key not in cls._stores:
+                cache_dir = cfg.DATASETS.ANNOTATION_CACHE_DIR if cfg is not None else ""
+                num_workers = cfg.DATASETS.ANNOTATION_NUM_WORKERS if cfg is not None else 0
+                coco_files = cfg.DATASETS.COCO_ANNOTATION_FILES if cfg is not None else ()
+                cls._stores[key] = cls(dirname, split, cache_dir, num_workers, coco_files)
+            return cls._stores[key]
+
+    def rows(self, fileids):
+        """Index rows of ``fileids``, skipping the ones without a readable annotation."""
+        return [self._rows[fileid] for fileid in fileids if fileid in self._rows]
+
+    def class_ids(self, class_names):
+        """Per-object class ids in ``class_names``."""
+        class_names = tuple(class_names)
+        if class_names not in self._class_ids:
+            self._class_ids[class_names] = voc_class_ids(self.index.names, class_names)[self.index.name_ids]
+        return self._class_ids[class_names]
+
+    def eval_labels(self, known_classes):
+        """Per-object class names as seen by the evaluator, the ones outside ``known_classes`` become "unknown"."""
+        known_classes = tuple(known_classes)
+        if self._eval_labels[0] != known_classes:
+            names = [voc_class_name(cls) for cls in self.index.names]
+            names = np.array([cls if cls in known_classes else UNK_CLASS[0] for cls in names], dtype=np.str_)
+            self._eval_labels = (known_classes, names[self.index.name_ids])
+        return self._eval_labels[1]
+
+    def eval_image_ids(self):
+        """The image set ids with a readable annotation, the first of each integer id, in image set order."""
+        image_ids, seen = [], set()
+        for fileid in self.fileids:
+            if fileid in self._rows and int(fileid) not in seen:
+                seen.add(int(fileid))
+                image_ids.append(fileid)
+        return image_ids
+
+    def class_records(self, classname, known_classes, image_ids):
+        """
+        Ground truth of ``classname`` for the evaluator: image id -> {"bbox": (num_boxes, 4) integer boxes as
+        written in the XML, "difficult": (num_boxes,) bool}, for all ``image_ids``.
+        """
+        rows = np.array([self._rows[image_id] for image_id in image_ids], dtype=np.int64)
+        selected = np.flatnonzero(self.eval_labels(known_classes) == classname)
+        # images are contiguous runs of objects, so the selected objects of the image rows come out in order
+        starts = np.searchsorted(selected, self.index.offsets[rows])
+        ends = np.searchsorted(selected, self.index.offsets[rows + 1])
+        boxes = self.index.boxes[selected].astype(np.int64)
+        difficult = self.index.difficult[selected].astype(np.bool_)
+        return {image_id: {"bbox": boxes[start:end], "difficult": difficult[start:end]}
+                for image_id, start, end in zip(image_ids, starts.tolist(), ends.tolist())}
+
+
 def load_voc_instances(dirname: str, split: str, class_names: Union[List[str], Tuple[str, ...]], cfg):
     """
     Load Pascal VOC detection annotations to Detectron2 format.
 
+    The annotations come from the image set's :class:`VOCAnnotationStore`, the task's class mask is applied to
+    the whole image set at once. The "annotations" of each image are :class:`CompactAnnotations`.
+
     Args:
         dirname: Contain "Annotations", "ImageSets", "JPEGImages"
         split (str): one of "train", "test", "val", "trainval"
         class_names: list or tuple of class names
     """
-    with PathManager.open(os.path.join(dirname, "ImageSets", "Main", split + ".txt")) as f:
-        fileids = np.loadtxt(f, dtype=np.str_)
-
-    # Needs to read many small annotation files. Makes sense at local
-    annotation_dirname = PathManager.get_local_path(os.path.join(dirname, "Annotations/"))
-    dicts = []
+    store = VOCAnnotationStore.get(dirname, split, cfg)
+    index = store.index
 
     # PROB and CAT convert image id to int before iterating over image ids
     # RandBox uses COCO's loader, which implicitly converts image id to int
     ids = []
     id2fileids = {}
-    for fileid in fileids:
+    for fileid in store.fileids:
         id = int(fileid.split('.')[0])
         ids.append(id)
         id2fileids[id] = fileid
+    rows = store.rows(id2fileids[id] for id in ids)
 
+    category_ids = store.class_ids(class_names)
     # filter instances
-    if cfg.TEST.MASK == 1:
-        allowed_class = list(range(0, cfg.TEST.PREV_INTRODUCED_CLS+cfg.TEST.CUR_INTRODUCED_CLS))
-    else:
-        allowed_class = list(range(cfg.TEST.PREV_INTRODUCED_CLS, cfg.TEST.PREV_INTRODUCED_CLS+cfg.TEST.CUR_INTRODUCED_CLS))
-    for id in ids:
-        fileid = id2fileids[id]
-    # for fileid in id2fileids.values():
-        anno_file = os.path.join(annotation_dirname, fileid + ".xml")
-        jpeg_file = os.path.join(dirname, "JPEGImages", fileid + ".jpg")
-
-        try:
-            with PathManager.open(anno_file) as f:
-                tree = ET.parse(f)
-        except:
-            logger = logging.getLogger(__name__)
-            logger.info('Not able to load: ' + anno_file + '. Continuing without aboarting...')
-            continue
+    keep = np.ones(len(category_ids), dtype=bool)
+    if cfg.TEST.MASK and ('test' not in split):
+        first_allowed = 0 if cfg.TEST.MASK == 1 else cfg.TEST.PREV_INTRODUCED_CLS
+        keep = (category_ids >= first_allowed) & (
+                category_ids < cfg.TEST.PREV_INTRODUCED_CLS + cfg.TEST.CUR_INTRODUCED_CLS)
+    offsets = np.concatenate([[0], np.cumsum(keep)])[index.offsets].tolist()
 
+    # We include "difficult" samples in training.
+    # Based on limited experiments, they don't hurt accuracy.
+    bboxes = np.array(index.boxes[keep])
+    # Original annotations are integers in the range [1, W or H]
+    # Assuming they mean 1-based pixel indices (inclusive),
+    # a box with annotation (xmin=1, xmax=W) covers the whole image.
+    # In coordinate space this is represented by (xmin=0, xmax=W)
+    bboxes[:, :2] -= 1.0
+    category_ids = category_ids[keep]
+    fileids, heights, widths = index.file_ids.tolist(), index.heights.tolist(), index.widths.tolist()
+
+    dicts = []
+    for row in rows:
         r = {
-            "file_name": jpeg_file,
-            "image_id": fileid,
-            "height": int(tree.findall("./size/height")[0].text),
-            "width": int(tree.findall("./size/width")[0].text),
+            "file_name": os.path.join(dirname, "JPEGImages", fileids[row] + ".jpg"),
+            "image_id": fileids[row],
+            "height": heights[row],
+            "width": widths[row],
+            "annotations": CompactAnnotations(bboxes[offsets[row]:offsets[row + 1]],
+                                              category_ids[offsets[row]:offsets[row + 1]]),
         }
-        instances = []
-
-        for obj in tree.findall("object"):
-            cls = obj.find("name").text
-            if cls in VOC_CLASS_NAMES_COCOFIED:
-                cls = BASE_VOC_CLASS_NAMES[VOC_CLASS_NAMES_COCOFIED.index(cls)]
-            if cfg.TEST.MASK and ('test' not in split):
-                if class_names.index(cls) not in allowed_class:
-                    continue
-            # We include "difficult" samples in training.
-            # Based on limited experiments, they don't hurt accuracy.
-            # difficult = int(obj.find("difficult").text)
-            # if difficult == 1:
-            # continue
-            bbox = obj.find("bndbox")
-            bbox = [float(bbox.find(x).text) for x in ["xmin", "ymin", "xmax", "ymax"]]
-            # Original annotations are integers in the range [1, W or H]
-            # Assuming they mean 1-based pixel indices (inclusive),
-            # a box with annotation (xmin=1, xmax=W) covers the whole image.
-            # In coordinate space this is represented by (xmin=0, xmax=W)
-            bbox[0] -= 1.0
-            bbox[1] -= 1.0
-            instances.append(
-                {"category_id": class_names.index(cls), "bbox": bbox, "bbox_mode": BoxMode.XYXY_ABS}
-            )
-        r["annotations"] = instances
         dicts.append(r)
     return dicts
 
 
+def voc_class_name(name):
+    """The VOC spelling of a class name, for the VOC classes that COCO names differently."""
+    if name in VOC_CLASS_NAMES_COCOFIED:
+        return BASE_VOC_CLASS_NAMES[VOC_CLASS_NAMES_COCOFIED.index(name)]
+    return name
+
+
+def voc_class_ids(names, class_names):
+    """
+    Class ids of raw annotation names, with the COCO spellings of the VOC classes mapped to the VOC ones.
+
+    Raises ValueError for a name that isn't in ``class_names``.
+    """
+    return np.array([class_names.index(voc_class_name(cls)) for cls in names], dtype=np.int64)
+
+
 def register_pascal_voc(name, dirname, super_split, split, cfg, year=2007):
     # if "voc_coco" in name:
     #     class_names = VOC_COCO_CLASS_NAMES
@@ -3,18 +3,17 @@ import numpy as np
 import os
 import sys
 import tempfile
-import xml.etree.ElementTree as ET
 import matplotlib.pyplot as plt
 from collections import OrderedDict, defaultdict
-from functools import lru_cache
 import torch
-from fvcore.common.file_io import PathManager
 from detectron2.data import MetadataCatalog
 from detectron2.utils import comm
 from detectron2.evaluation.evaluator import DatasetEvaluator
 from detectron2.utils.logger import setup_logger
 import json
 
+from .pascal_voc import VOCAnnotationStore
+
 np.set_printoptions(threshold=sys.maxsize)
 
 
@@ -36,8 +35,9 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
         """
         self._dataset_name = dataset_name
         meta = MetadataCatalog.get(dataset_name)
-        self._anno_file_template = os.path.join(meta.dirname, "Annotations", "{}.xml")
-        self._image_set_path = os.path.join(meta.dirname, 'ImageSets', 'Main', meta.split + '.txt')
+        self._dirname = meta.dirname
+        self._split = meta.split
+        self._cfg = cfg
         self._class_names = meta.thing_classes
         self._is_2007 = False
         # self._is_2007 = meta.year == 2007
@@ -146,6 +146,7 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
             )
         )
 
+        annotations = VOCAnnotationStore.get(self._dirname, self._split, self._cfg)
         with tempfile.TemporaryDirectory(prefix="pascal_voc_eval_") as dirname:
             res_file_template = os.path.join(dirname, "{}.txt")
 
@@ -169,8 +170,7 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
                 thresh = 50
                 rec, prec, ap, unk_det_as_known, num_unk, tp_plus_fp_closed_set, fp_open_set = voc_eval(
                     res_file_template,
-                    self._anno_file_template,
-                    self._image_set_path,
+                    annotations,
                     cls_name,
                     ovthresh=thresh / 100.0,
                     use_07_metric=self._is_2007,
@@ -264,49 +264,6 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
 """Python implementation of the PASCAL VOC devkit's AP evaluation code."""
 
 
-@lru_cache(maxsize=None)
-def parse_rec(filename, known_classes):
-    """Parse a PASCAL VOC xml file."""
-    VOC_CLASS_NAMES_COCOFIED = [
-        "airplane", "dining table", "motorcycle",
-        "potted plant", "couch", "tv"
-    ]
-    BASE_VOC_CLASS_NAMES = [
-        "aeroplane", "diningtable", "motorbike",
-        "pottedplant", "sofa", "tvmonitor"
-    ]
-    try:
-        with PathManager.open(filename) as f:
-            tree = ET.parse(f)
-    except:
-        logger = logging.getLogger(__name__)
-        logger.info('Not able to load: ' + filename + '. Continuing without aborting...')
-        return None
-
-    objects = []
-    for obj in tree.findall("object"):
-        obj_struct = {}
-        cls_name = obj.find("name").text
-        if cls_name in VOC_CLASS_NAMES_COCOFIED:
-            cls_name = BASE_VOC_CLASS_NAMES[VOC_CLASS_NAMES_COCOFIED.index(cls_name)]
-        if cls_name not in known_classes:
-            cls_name = 'unknown'
-        obj_struct["name"] = cls_name
-        # obj_struct["pose"] = obj.find("pose").text
-        # obj_struct["truncated"] = int(obj.find("truncated").text)
-        obj_struct["difficult"] = int(obj.find("difficult").text)
-        bbox = obj.find("bndbox")
-        obj_struct["bbox"] = [
-            int(bbox.find("xmin").text),
-            int(bbox.find("ymin").text),
-            int(bbox.find("xmax").text),
-            int(bbox.find("ymax").text),
-        ]
-        objects.append(obj_struct)
-
-    return objects
-
-
 def voc_ap(rec, prec, use_07_metric=False):
     """Compute VOC AP given precision and recall. If use_07_metric is true, uses
     the VOC 07 11-point method (default:False).
@@ -339,10 +296,9 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
-def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_metric=False, known_classes=None):
+def voc_eval(detpath, annotations, classname, ovthresh=0.5, use_07_metric=False, known_classes=None):
     """rec, prec, ap = voc_eval(detpath,
-                                annopath,
-                                imagesetfile,
+                                annotations,
                                 classname,
                                 [ovthresh],
                                 [use_07_metric])
@@ -351,48 +307,26 @@ def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_me
 
     detpath: Path to detections
         detpath.format(classname) should produce the detection results file.
-    annopath: Path to annotations
-        annopath.format(imagename) should be the xml annotations file.
-    imagesetfile: Text file containing the list of images, one image per line.
+    annotations: VOCAnnotationStore of the evaluated image set
     classname: Category name (duh)
     [ovthresh]: Overlap threshold (default = 0.5)
     [use_07_metric]: Whether to use VOC07's 11 point AP computation
         (default False)
     """
     # assumes detections are in detpath.format(classname)
-    # assumes annotations are in annopath.format(imagename)
-    # assumes imagesetfile is a text file with each line an image name
 
     # first load gt
-    # read list of images
-    with PathManager.open(imagesetfile, "r") as f:
-        lines = f.readlines()
-    imagenames = [x.strip() for x in lines]
-
-    imagenames_filtered = []
-    # load annots
-    recs = {}
-    mapping = {}  # follow RandBox to map image id to image name
-    for imagename in imagenames:
-        rec = parse_rec(annopath.format(imagename), tuple(known_classes))
-        if rec is not None and int(imagename) not in mapping:
-            recs[imagename] = rec
-            imagenames_filtered.append(imagename)
-            mapping[int(imagename)] = imagename
-
-    imagenames = imagenames_filtered
+    # images with a readable annotation, follow RandBox to map image id to image name
+    imagenames = annotations.eval_image_ids()
+    mapping = {int(imagename): imagename for imagename in imagenames}
 
     # extract gt objects for this class
-    class_recs = {}
+    class_recs = annotations.class_records(classname, known_classes, imagenames)
     npos = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj["name"] == classname]
-        bbox = np.array([x["bbox"] for x in R])
-        difficult = np.array([x["difficult"] for x in R]).astype(np.bool_)
-        # difficult = np.array([False for x in R]).astype(np.bool)  # treat all "difficult" as GT
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        class_recs[imagename] = {"bbox": bbox, "difficult": difficult, "det": det}
+    for R in class_recs.values():
+        # R["difficult"] = np.zeros_like(R["difficult"])  # treat all "difficult" as GT
+        R["det"] = [False] * len(R["bbox"])
+        npos = npos + sum(~R["difficult"])
 
     #     print(class_recs)
     # read dets
@@ -483,15 +417,11 @@ def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_me
     logger = logging.getLogger(__name__)
 
     # Finding GT of unknown objects
-    unknown_class_recs = {}
+    unknown_class_recs = annotations.class_records('unknown', known_classes, imagenames)
     n_unk = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj["name"] == 'unknown']
-        bbox = np.array([x["bbox"] for x in R])
-        difficult = np.array([x["difficult"] for x in R]).astype(np.bool_)
-        det = [False] * len(R)
-        n_unk = n_unk + sum(~difficult)
-        unknown_class_recs[imagename] = {"bbox": bbox, "difficult": difficult, "det": det}
+    for R in unknown_class_recs.values():
+        R["det"] = [False] * len(R["bbox"])
+        n_unk = n_unk + sum(~R["difficult"])
 
     if classname == 'unknown':
         return rec, prec, ap, 0, n_unk, None, None
@@ -0,0 +1,96 @@
+import logging
+import os
+
+import torch
+from torch import nn
+from fvcore.common.file_io import PathManager
+
+__all__ = ["ProposalBank", "build_proposal_grid"]
+
+
+def build_proposal_grid(num_levels, low=-2.0, high=2.0):
+    """
+    Build the dense (cx, cy, w, h) grid used by multi-sample inference.
+
+    Every coordinate takes ``num_levels`` evenly spaced values in [low, high),
+    and the rows enumerate their cartesian product in row-major order, i.e.
+    row ``i1 * L**3 + i2 * L**2 + i3 * L + i4`` is ``(v[i1], v[i2], v[i3], v[i4])``.
+
+    Returns a (num_levels ** 4, 4) float tensor in the diffusion signal space.
+    """
+    step = (high - low) / num_levels
+    levels = torch.arange(num_levels, dtype=torch.float32) * step + low
+    return torch.cartesian_prod(levels, levels, levels, levels)
+
+
+class ProposalBank(nn.Module):
+    """
+    A fixed, shuffled bank of proposal boxes sampled from a regular grid.
+
+    The bank lives in a non-persistent buffer, so it follows the model across
+    devices without being written into checkpoints. The shuffle is seeded, so
+    every process builds the same bank, and it can optionally be cached on disk
+    to skip the construction entirely.
+    """
+
+    def __init__(self, num_levels=10, bank_size=10000, low=-2.0, high=2.0, seed=0, cache_file=""):
+        super().__init__()
+        self.num_levels = num_levels
+        self.bank_size = bank_size
+        self.low = low
+        self.high = high
+        self.seed = seed
+
+        boxes = self.load(cache_file) if cache_file else None
+        if boxes is None:
+            boxes = self.build()
+            if cache_file:
+                self.save(cache_file, boxes)
+        self.register_buffer('boxes', boxes, persistent=False)
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            num_levels=cfg.MODEL.PROPOSAL_GRID_LEVELS,
+            bank_size=cfg.MODEL.PROPOSAL_BANK_SIZE,
+            low=cfg.MODEL.PROPOSAL_GRID_RANGE[0],
+            high=cfg.MODEL.PROPOSAL_GRID_RANGE[1],
+            seed=cfg.MODEL.PROPOSAL_BANK_SEED,
+            cache_file=cfg.MODEL.PROPOSAL_BANK_CACHE,
+        )
+
+    def _meta(self):
+        return {"num_levels": self.num_levels, "bank_size": self.bank_size,
+                "low": float(self.low), "high": float(self.high), "seed": self.seed}
+
+    def build(self):
+        grid = build_proposal_grid(self.num_levels, self.low, self.high)
+        generator = torch.Generator().manual_seed(self.seed)
+        # tile independent permutations when the bank is larger than the grid
+        num_perms = -(-self.bank_size // grid.shape[0])
+        order = torch.cat([torch.randperm(grid.shape[0], generator=generator) for _ in range(num_perms)])
+        return grid[order[:self.bank_size]].contiguous()
+
+    def load(self, path):
+        if not PathManager.exists(path):
+            return None
+        with PathManager.open(path, "rb") as f:
+            state = torch.load(f, map_location="cpu")
+        if state.get("meta") != self._meta():
+            logging.getLogger(__name__).info(
+                "Proposal bank cache {} does not match the current config, rebuilding.".format(path))
+            return None
+        return state["boxes"]
+
+    def save(self, path, boxes=None):
+        boxes = self.boxes if boxes is None else boxes
+        PathManager.mkdirs(os.path.dirname(path) or ".")
+        # write-then-rename so concurrent workers never read a partial file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with PathManager.open(tmp_path, "wb") as f:
+            torch.save({"meta": self._meta(), "boxes": boxes.cpu()}, f)
+        os.replace(tmp_path, path)
+
+    def forward(self, sample_i, num_proposals, num_samples=1):
+        """Return ``num_samples`` consecutive slices of ``num_proposals`` boxes, starting at ``sample_i``."""
+        return self.boxes[num_proposals * sample_i:num_proposals * (sample_i + num_samples)]
@@ -1,5 +1,6 @@
+import math
+
 import torch
-from torchvision.ops.boxes import box_area
 
 
 def box_cxcywh_to_xyxy(x):
@@ -16,47 +17,122 @@ def box_xyxy_to_cxcywh(x):
     return torch.stack(b, dim=-1)
 
 
-# modified from torchvision to also return the union
+# modified from torchvision to also return the union, and to accept leading batch dimensions
 def box_iou(boxes1, boxes2):
-    area1 = box_area(boxes1)
-    area2 = box_area(boxes2)
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
 
-    lt = torch.max(boxes1[:, None, :2], boxes2[:, :2])  # [N,M,2]
-    rb = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])  # [N,M,2]
+    lt = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])  # [...,N,M,2]
+    rb = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])  # [...,N,M,2]
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N,M]
 
-    union = area1[:, None] + area2 - inter
+    union = area1[..., :, None] + area2[..., None, :] - inter
 
     iou = inter / union
     return iou, union
 
 
-def generalized_box_iou(boxes1, boxes2):
+def generalized_box_iou(boxes1, boxes2, validate=True):
     """
     Generalized IoU from https://giou.stanford.edu/
 
     The boxes should be in [x0, y0, x1, y1] format
 
     Returns a [N, M] pairwise matrix, where N = len(boxes1)
-    and M = len(boxes2)
+    and M = len(boxes2), or a [B, N, M] one for batched [B, N, 4] and [B, M, 4] inputs
+
+    ``validate=False`` skips the degenerate box check, which syncs with the device.
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
-    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
-    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    if validate:
+        assert (boxes1[..., 2:] >= boxes1[..., :2]).all()
+        assert (boxes2[..., 2:] >= boxes2[..., :2]).all()
     iou, union = box_iou(boxes1, boxes2)
 
-    lt = torch.min(boxes1[:, None, :2], boxes2[:, :2])
-    rb = torch.max(boxes1[:, None, 2:], boxes2[:, 2:])
+    lt = torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    area = wh[:, :, 0] * wh[:, :, 1]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
 
     return iou - (area - union) / area
 
 
+def paired_box_iou(boxes1, boxes2):
+    """
+    IoU between corresponding [..., 4] boxes in [x0, y0, x1, y1] format,
+    the diagonal of box_iou in O(N) memory. Also returns the union.
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+
+    lt = torch.max(boxes1[..., :2], boxes2[..., :2])  # [...,2]
+    rb = torch.min(boxes1[..., 2:], boxes2[..., 2:])  # [...,2]
+
+    wh = (rb - lt).clamp(min=0)  # [...,2]
+    inter = wh[..., 0] * wh[..., 1]
+
+    union = area1 + area2 - inter
+
+    iou = inter / union
+    return iou, union
+
+
+def paired_generalized_box_iou(boxes1, boxes2):
+    """
+    Generalized IoU between corresponding [..., 4] boxes in [x0, y0, x1, y1] format,
+    the diagonal of generalized_box_iou in O(N) memory.
+    """
+    iou, union = paired_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.max(boxes1[..., 2:], boxes2[..., 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [...,2]
+    area = wh[..., 0] * wh[..., 1]
+
+    return iou - (area - union) / area
+
+
+def paired_distance_box_iou(boxes1, boxes2, eps=1e-7):
+    """
+    Distance IoU (https://arxiv.org/abs/1911.08287) between corresponding [..., 4] boxes
+    in [x0, y0, x1, y1] format: IoU minus the squared center distance over the squared
+    diagonal of the enclosing box.
+    """
+    iou, _ = paired_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[..., :2], boxes2[..., :2])
+    rb = torch.max(boxes1[..., 2:], boxes2[..., 2:])
+    diagonal = ((rb - lt) ** 2).sum(-1) + eps
+
+    center1 = (boxes1[..., :2] + boxes1[..., 2:]) / 2
+    center2 = (boxes2[..., :2] + boxes2[..., 2:]) / 2
+    distance = ((center1 - center2) ** 2).sum(-1)
+
+    return iou - distance / diagonal
+
+
+def paired_complete_box_iou(boxes1, boxes2, eps=1e-7):
+    """
+    Complete IoU (https://arxiv.org/abs/1911.08287) between corresponding [..., 4] boxes
+    in [x0, y0, x1, y1] format: Distance IoU with an aspect ratio consistency term.
+    """
+    iou, _ = paired_box_iou(boxes1, boxes2)
+    diou = paired_distance_box_iou(boxes1, boxes2, eps=eps)
+
+    w1, h1 = boxes1[..., 2] - boxes1[..., 0], boxes1[..., 3] - boxes1[..., 1]
+    w2, h2 = boxes2[..., 2] - boxes2[..., 0], boxes2[..., 3] - boxes2[..., 1]
+    v = (4 / math.pi ** 2) * (torch.atan(w2 / (h2 + eps)) - torch.atan(w1 / (h1 + eps))) ** 2
+    with torch.no_grad():
+        alpha = v / (1 - iou + v + eps)
+
+    return diou - alpha * v
+
+
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
 
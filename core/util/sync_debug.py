@@ -0,0 +1,118 @@
+import os
+import sys
+import threading
+import warnings
+from collections import Counter
+
+import torch
+
+__all__ = ["SyncCounter"]
+
+_TORCH_DIR = os.path.dirname(torch.__file__)
+
+# Tensor methods that hand data to Python, which forces a sync on CUDA tensors.
+_CONVERSIONS = ("item", "tolist", "numpy", "nonzero", "__bool__", "__int__", "__float__", "__index__")
+
+# torch.Tensor is patched process-wide, counters of other threads wait until the patches are undone
+_PATCH_LOCK = threading.RLock()
+
+
+def _call_site():
+    """file:line of the innermost frame outside torch and this module."""
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_code.co_filename.startswith(_TORCH_DIR)
+                                 or frame.f_code.co_filename == __file__):
+        frame = frame.f_back
+    if frame is None:
+        return "<unknown>"
+    return "{}:{}".format(os.path.relpath(frame.f_code.co_filename), frame.f_lineno)
+
+
+def _is_mask(index):
+    if isinstance(index, tuple):
+        return any(_is_mask(i) for i in index)
+    return isinstance(index, torch.Tensor) and index.dtype == torch.bool
+
+
+class SyncCounter:
+    """
+    Count the host-device synchronizations inside a ``with`` block, grouped by the line that caused them.
+
+    On CUDA it relies on ``torch.cuda.set_sync_debug_mode("warn")``, which warns on every synchronizing call.
+    Elsewhere nothing ever syncs, so it counts what would on a GPU instead: tensor-to-Python conversions
+    (``item``, ``tolist``, ``bool(t)``, ...), ``nonzero`` and boolean mask indexing. Those are patched on
+    ``torch.Tensor`` for the whole process until the block exits, also when it raises, so only calls from the
+    thread that entered the block are counted and only one thread can count at a time.
+    """
+
+    def __init__(self, use_cuda=None):
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self.sites = Counter()
+
+    @property
+    def total(self):
+        return sum(self.sites.values())
+
+    def summary(self, n=10):
+        sites = ", ".join("{} x{}".format(site, count) for site, count in self.sites.most_common(n))
+        return "{} total{}".format(self.total, " ({})".format(sites) if sites else "")
+
+    def __enter__(self):
+        self.sites.clear()
+        if self.use_cuda:
+            self._debug_mode = torch.cuda.get_sync_debug_mode()
+            self._warnings = warnings.catch_warnings(record=True)
+            self._records = self._warnings.__enter__()
+            warnings.simplefilter("always")
+            torch.cuda.set_sync_debug_mode("warn")
+        else:
+            _PATCH_LOCK.acquire()
+            self._patched = {}
+            try:
+                for name in _CONVERSIONS:
+                    self._patch(name, lambda *args, **kwargs: True)
+                self._patch("__getitem__", lambda self, index: _is_mask(index))
+                self._patch("__setitem__", lambda self, index, value: _is_mask(index))
+            except BaseException:
+                self._restore()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        if self.use_cuda:
+            try:
+                self._warnings.__exit__(*exc)
+            finally:
+                torch.cuda.set_sync_debug_mode(self._debug_mode)
+            for record in self._records:
+                if "synchronizing" in str(record.message):
+                    self.sites["{}:{}".format(os.path.relpath(record.filename), record.lineno)] += 1
+                else:
+                    warnings.warn_explicit(record.message, record.category, record.filename, record.lineno)
+        else:
+            self._restore()
+        return False
+
+    def _restore(self):
+        try:
+            for name, method in self._patched.items():
+                if method is None:
+                    delattr(torch.Tensor, name)
+                else:
+                    setattr(torch.Tensor, name, method)
+        finally:
+            self._patched = {}
+            _PATCH_LOCK.release()
+
+    def _patch(self, name, syncs):
+        method = getattr(torch.Tensor, name)
+        sites = self.sites
+        thread = threading.get_ident()
+
+        def counted(*args, **kwargs):
+            if threading.get_ident() == thread and syncs(*args, **kwargs):
+                sites[_call_site()] += 1
+            return method(*args, **kwargs)
+
+        self._patched[name] = torch.Tensor.__dict__.get(name)
+        setattr(torch.Tensor, name, counted)
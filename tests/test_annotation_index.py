@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from detectron2.config import get_cfg
+
+import coco_to_voc
+from core import add_config
+from core.pascal_voc import VOC_COCO_CLASS_NAMES, VOCAnnotationStore, load_voc_instances
+
+CLASS_NAMES = VOC_COCO_CLASS_NAMES["M-OWODB"]
+# COCO spells some VOC classes differently, the loaders map them back
+COCO_NAMES = ["airplane", "bicycle", "dining table", "tv", "person", "truck", "bench", "kite", "toilet", "bowl"]
+VOC_IDS = ["000002", "000005"]
+
+
+def write_dataset(root, seed=0):
+    """
+    A COCO json whose images have fractional boxes, crowd boxes or no annotations at all, the VOC annotation
+    files of two more images, and the image sets listing all of them and one id without any annotation.
+    """
+    rng = np.random.RandomState(seed)
+    categories = [{"id": i * 3 + 1, "name": name} for i, name in enumerate(COCO_NAMES)]
+    images = [{"id": i * 7 + 1, "file_name": "%012d.jpg" % (i * 7 + 1),
+               "width": int(rng.randint(200, 700)), "height": int(rng.randint(200, 700))} for i in range(30)]
+    annotations = []
+    for k in range(120):
+        image = images[rng.randint(25)]  # the last images have no annotations
+        annotations.append({"id": k, "image_id": image["id"], "category_id": categories[rng.randint(10)]["id"],
+                            "bbox": (rng.rand(4) * 150).tolist(), "iscrowd": int(rng.rand() < 0.1)})
+    coco_file = os.path.join(root, "instances.json")
+    with open(coco_file, "w") as f:
+        json.dump({"images": images, "categories": categories, "annotations": annotations}, f)
+
+    voc_files = {}
+    for file_id in VOC_IDS:
+        objects = "".join(
+            "<object><name>{}</name><difficult>{}</difficult><bndbox><xmin>{}</xmin><ymin>{}</ymin>"
+            "<xmax>{}</xmax><ymax>{}</ymax></bndbox></object>".format(
+                CLASS_NAMES[rng.randint(40)], rng.randint(2), *rng.randint(1, 100, 2), *rng.randint(101, 300, 2))
+            for _ in range(rng.randint(1, 5)))
+        voc_files[file_id] = "<annotation><size><width>500</width><height>375</height></size>{}</annotation>".format(
+            objects)
+
+    file_ids = [image["file_name"][:12] for image in images] + VOC_IDS + ["%012d" % 999999]
+    rng.shuffle(file_ids)
+    return coco_file, voc_files, file_ids
+
+
+def make_voc_dir(root, voc_files, file_ids):
+    os.makedirs(os.path.join(root, "Annotations"))
+    os.makedirs(os.path.join(root, "ImageSets", "Main", "M-OWODB"))
+    for file_id, xml in voc_files.items():
+        with open(os.path.join(root, "Annotations", file_id + ".xml"), "w") as f:
+            f.write(xml)
+    for split in ("t2_train", "test"):
+        with open(os.path.join(root, "ImageSets", "Main", "M-OWODB", split + ".txt"), "w") as f:
+            f.write("\n".join(file_ids) + "\n")
+    return root
+
+
+def make_cfg(mask, cache_dir="", coco_files=()):
+    cfg = get_cfg()
+    add_config(cfg)
+    cfg.TEST.MASK = mask
+    cfg.TEST.PREV_INTRODUCED_CLS = 20
+    cfg.TEST.CUR_INTRODUCED_CLS = 20
+    cfg.DATASETS.ANNOTATION_CACHE_DIR = cache_dir
+    cfg.DATASETS.ANNOTATION_NUM_WORKERS = 0
+    cfg.DATASETS.COCO_ANNOTATION_FILES = coco_files
+    return cfg
+
+
+def _normalized(dataset_dicts):
+    return [dict(d, file_name=os.path.basename(d["file_name"]),
+                 annotations=(d["annotations"].boxes.tolist(), d["annotations"].category_ids.tolist()))
+            for d in dataset_dicts]
+
+
+@pytest.mark.parametrize("cached", [False, True])
+@pytest.mark.parametrize("split,mask", [("M-OWODB/t2_train", 0), ("M-OWODB/t2_train", 1),
+                                        ("M-OWODB/t2_train", 2), ("M-OWODB/test", 1)])
+def test_coco_json_matches_converted_xml(tmp_path, monkeypatch, split, mask, cached):
+    coco_file, voc_files, file_ids = write_dataset(str(tmp_path))
+    xml_root = make_voc_dir(str(tmp_path / "xml"), voc_files, file_ids)
+    coco_to_voc.coco_to_voc_detection(coco_file, xml_root, num_workers=0)
+    json_root = make_voc_dir(str(tmp_path / "json"), voc_files, file_ids)
+
+    for _ in range(2 if cached else 1):  # the second load comes from the caches
+        monkeypatch.setattr(VOCAnnotationStore, "_stores", {})
+        xml_cfg = make_cfg(mask, str(tmp_path / "xml_cache") if cached else "")
+        json_cfg = make_cfg(mask, str(tmp_path / "json_cache") if cached else "", (coco_file,))
+        xml_dicts = load_voc_instances(xml_root, split, CLASS_NAMES, xml_cfg)
+        json_dicts = load_voc_instances(json_root, split, CLASS_NAMES, json_cfg)
+        assert _normalized(json_dicts) == _normalized(xml_dicts)
+        assert sum(len(d["annotations"]) for d in xml_dicts) > 0
+
+        xml_store, json_store = VOCAnnotationStore.get(xml_root, split), VOCAnnotationStore.get(json_root, split)
+        # images without annotations have no XML, and no record in the json
+        assert [os.path.basename(f) for f in json_store.index.missing] == \
+            [os.path.basename(f) for f in xml_store.index.missing]
+        assert len(xml_store.index.missing) >= 6
+
+        image_ids = xml_store.eval_image_ids()
+        assert json_store.eval_image_ids() == image_ids
+        for known_classes in (CLASS_NAMES[:20], CLASS_NAMES[:40]):
+            for classname in set(CLASS_NAMES):
+                xml_records = xml_store.class_records(classname, known_classes, image_ids)
+                json_records = json_store.class_records(classname, known_classes, image_ids)
+                for image_id in image_ids:
+                    np.testing.assert_array_equal(json_records[image_id]["bbox"], xml_records[image_id]["bbox"])
+                    np.testing.assert_array_equal(json_records[image_id]["difficult"],
+                                                  xml_records[image_id]["difficult"])
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+import torch
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+from PIL import Image
+
+from core.annotation_index import CompactAnnotations
+from core.dataset_mapper import (compact_annotations_to_instances, read_image_transformed, sample_transforms,
+                                 transformed_shape)
+
+IMAGE_SIZES = [(480, 640), (1500, 1000), (333, 500), (800, 800)]
+
+GENS = {
+    "flip": [T.RandomFlip()],
+    "vflip": [T.RandomFlip(horizontal=False, vertical=True)],
+    "resize": [T.ResizeShortestEdge((480, 512, 544, 576, 608, 640), 1000, "choice")],
+    "resize_range": [T.ResizeShortestEdge((400, 800), 1333, "range")],
+    "flip_resize": [T.RandomFlip(), T.ResizeShortestEdge((480, 608, 800), 1333, "choice")],
+    "crop": [T.RandomCrop("absolute_range", (384, 600))],
+    # the training gens of DatasetMapper with the random crop
+    "flip_resize_crop_resize": [T.RandomFlip(),
+                                T.ResizeShortestEdge([400, 500, 600], sample_style="choice"),
+                                T.RandomCrop("absolute_range", (384, 600)),
+                                T.ResizeShortestEdge((480, 608, 800), 1333, "choice")],
+}
+
+
+def _boxes(height, width):
+    return np.array([[0, 0, width, height],
+                     [width * 0.1, height * 0.2, width * 0.5, height * 0.6],
+                     [width * 0.3, height * 0.05, width * 0.95, height * 0.9]])
+
+
+def _write_image(path, height, width):
+    """A smooth JPEG with a sharp-edged block, for comparing resampled pixels."""
+    yy, xx = np.mgrid[0:height, 0:width]
+    image = np.stack([128 + 100 * np.sin(xx / 37. + c) * np.cos(yy / 53.) for c in range(3)], -1).astype(np.uint8)
+    image[height // 4:height // 2, width // 3:width // 2] = [200, 30, 30]
+    Image.fromarray(image).save(path, quality=95)
+    return str(path)
+
+
+def _assert_same_transforms(transforms, expected):
+    assert len(transforms.transforms) == len(expected.transforms)
+    for tfm, expected_tfm in zip(transforms.transforms, expected.transforms):
+        assert type(tfm) is type(expected_tfm)
+        assert vars(tfm) == vars(expected_tfm)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("height,width", IMAGE_SIZES)
+@pytest.mark.parametrize("gens", list(GENS.values()), ids=list(GENS))
+def test_sample_transforms_matches_apply_transform_gens(gens, height, width, seed):
+    np.random.seed(seed)
+    transforms, shape = sample_transforms(gens, height, width)
+    np.random.seed(seed)
+    image, expected = T.apply_transform_gens(gens, np.zeros((height, width, 3), dtype=np.uint8))
+
+    _assert_same_transforms(transforms, expected)
+    assert shape == image.shape[:2] == transformed_shape(expected, height, width)
+    boxes = _boxes(height, width)
+    np.testing.assert_array_equal(transforms.apply_box(boxes), expected.apply_box(boxes))
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("height,width", IMAGE_SIZES)
+@pytest.mark.parametrize("gens", list(GENS.values()), ids=list(GENS))
+def test_read_image_transformed(tmp_path, gens, height, width, seed):
+    file_name = _write_image(tmp_path / "image.jpg", height, width)
+
+    np.random.seed(seed)
+    image, transforms = read_image_transformed(file_name, gens, "RGB")
+    np.random.seed(seed)
+    _, expected = T.apply_transform_gens(gens, np.zeros((height, width, 3), dtype=np.uint8))
+    _assert_same_transforms(transforms, expected)
+
+    # the same pixels, up to resampling once instead of at every resize, and decoding at a reduced scale
+    reference = expected.apply_image(utils.read_image(file_name, format="RGB"))
+    assert image.shape == reference.shape == transformed_shape(transforms, height, width) + (3,)
+    assert np.abs(image.astype(np.float32) - reference).mean() < 1.0
+
+    # transforms given for the image size are applied as they are
+    image_given, transforms_given = read_image_transformed(file_name, None, "RGB", transforms=transforms)
+    assert transforms_given is transforms
+    np.testing.assert_array_equal(image_given, image)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("height,width", IMAGE_SIZES)
+@pytest.mark.parametrize("gens", list(GENS.values()), ids=list(GENS))
+def test_compact_annotations_to_instances(gens, height, width, seed):
+    rng = np.random.RandomState(seed)
+    xy = rng.rand(12, 2) * [width, height]
+    # boxes partly or fully outside the crops, and degenerate ones
+    boxes = np.concatenate([xy, xy + rng.rand(12, 2) * [width, height] * 0.6], 1)
+    boxes[-1, 2:] = boxes[-1, :2]
+    category_ids = rng.randint(0, 80, len(boxes))
+    annotations = CompactAnnotations(boxes, category_ids)
+
+    np.random.seed(seed)
+    transforms, image_size = sample_transforms(gens, height, width)
+    instances = compact_annotations_to_instances(annotations, transforms, image_size)
+    annos = [utils.transform_instance_annotations(dict(obj), transforms, image_size) for obj in annotations]
+    expected = utils.annotations_to_instances(annos, image_size)
+
+    assert instances.image_size == expected.image_size
+    torch.testing.assert_close(instances.gt_boxes.tensor, expected.gt_boxes.tensor)
+    assert torch.equal(instances.gt_classes, expected.gt_classes)
+    instances.gt_classes[0] = -1  # a copy, not a view of the read-only category ids
+    assert annotations.category_ids[0] == category_ids[0]
+
+    filtered, expected_filtered = utils.filter_empty_instances(instances), utils.filter_empty_instances(expected)
+    torch.testing.assert_close(filtered.gt_boxes.tensor, expected_filtered.gt_boxes.tensor)
+    assert len(filtered) < len(instances)
@@ -0,0 +1,63 @@
+import pytest
+import torch
+from detectron2.config import get_cfg
+
+import core.head
+from core import add_config
+from core.head import DynamicConv
+
+# the parameters of DynamicConv before chunking, checkpoints have to keep loading
+DYNAMIC_CONV_KEYS = [
+    "dynamic_layer.weight", "dynamic_layer.bias", "norm1.weight", "norm1.bias", "norm2.weight", "norm2.bias",
+    "out_layer.weight", "out_layer.bias", "norm3.weight", "norm3.bias",
+]
+
+
+def make_dynamic_conv(chunk_size):
+    cfg = get_cfg()
+    add_config(cfg)
+    cfg.MODEL.HIDDEN_DIM = 32
+    cfg.MODEL.DIM_DYNAMIC = 8
+    cfg.MODEL.DYNAMIC_CONV_CHUNK_SIZE = chunk_size
+    return DynamicConv(cfg)
+
+
+def make_inputs(num_proposals, resolution=7, hidden_dim=32, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return (torch.randn(1, num_proposals, hidden_dim, generator=g),
+            torch.randn(resolution ** 2, num_proposals, hidden_dim, generator=g))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 16, 50])
+def test_chunked_dynamic_conv_matches_unchunked(monkeypatch, chunk_size):
+    checkpointed = []
+    checkpoint = core.head.checkpoint
+    monkeypatch.setattr(core.head, "checkpoint", lambda *args, **kwargs: checkpointed.append(1) or checkpoint(
+        *args, **kwargs))
+    torch.manual_seed(0)
+    reference = make_dynamic_conv(0)
+    chunked = make_dynamic_conv(chunk_size)
+    assert list(chunked.state_dict()) == list(reference.state_dict()) == DYNAMIC_CONV_KEYS
+    chunked.load_state_dict(reference.state_dict())
+
+    pro_features, roi_features = make_inputs(50)
+    outputs, grads = [], []
+    for module in (reference, chunked):
+        module.zero_grad()
+        inputs = [pro_features.clone().requires_grad_(), roi_features.clone().requires_grad_()]
+        output = module(*inputs)
+        # a loss that weights every output differently, so misplaced chunks show up in the gradients
+        (output * torch.linspace(-1, 1, output.numel()).view_as(output)).sum().backward()
+        outputs.append(output)
+        grads.append([x.grad for x in inputs] + [p.grad for p in module.parameters()])
+
+    # the chunks are recomputed in backward, except when a single chunk takes all the proposals
+    assert len(checkpointed) == (0 if chunk_size >= 50 else -(-50 // chunk_size))
+    assert outputs[1].shape == outputs[0].shape == (50, 32)
+    torch.testing.assert_close(outputs[1], outputs[0], rtol=1e-5, atol=1e-6)
+    for grad, expected in zip(grads[1], grads[0]):
+        torch.testing.assert_close(grad, expected, rtol=1e-4, atol=1e-5)
+
+    with torch.no_grad():
+        torch.testing.assert_close(chunked(pro_features, roi_features), reference(pro_features, roi_features),
+                                   rtol=1e-5, atol=1e-6)
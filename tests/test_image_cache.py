@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from core.image_cache import ImageCache
+
+PARAMS = (64, 100, "RGB")
+
+
+def write_images(root, num_images=3):
+    rng = np.random.RandomState(0)
+    os.makedirs(os.path.join(root, "JPEGImages"))
+    file_names = []
+    for i in range(num_images):
+        file_name = os.path.join("JPEGImages", "{:06d}.jpg".format(i))
+        Image.fromarray(rng.randint(0, 255, (40 + i * 10, 60, 3), dtype=np.uint8)).save(os.path.join(root, file_name))
+        file_names.append(file_name)
+    return file_names
+
+
+def test_relative_and_absolute_file_names_hit_the_same_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    relative = write_images(str(tmp_path))
+    absolute = [os.path.join(str(tmp_path), f) for f in relative]
+
+    cache = ImageCache.build("cache", relative[:2], *PARAMS)
+    for file_names in (relative, absolute, ["./" + f for f in relative]):
+        assert [cache.get(f) is not None for f in file_names] == [True, True, False]
+    np.testing.assert_array_equal(cache.get(absolute[0])[0], cache.get(relative[0])[0])
+
+    # resuming with absolute names only adds the missing image
+    cache = ImageCache.build("cache", absolute, *PARAMS)
+    assert len(cache) == 3
+    monkeypatch.chdir(tmp_path / "JPEGImages")
+    cache = ImageCache.open(os.path.join(str(tmp_path), "cache"), *PARAMS)
+    assert all(cache.get(f) is not None for f in absolute + [os.path.basename(f) for f in relative])
@@ -0,0 +1,101 @@
+import pytest
+import torch
+from detectron2.config import get_cfg
+from fvcore.nn import sigmoid_focal_loss_jit
+
+from core import add_config
+from core.loss import HungarianMatcherDynamicK, SetCriterionDynamicK
+
+NUM_CLASSES = 21
+
+
+def make_criterion(disentangled, mask):
+    cfg = get_cfg()
+    add_config(cfg)
+    cfg.MODEL.NUM_CLASSES = NUM_CLASSES
+    cfg.MODEL.DISENTANGLED = disentangled
+    cfg.TEST.MASK = mask
+    cfg.TEST.PREV_INTRODUCED_CLS = 10
+    matcher = HungarianMatcherDynamicK(cfg, cost_class=2.0, cost_bbox=5.0, cost_giou=2.0)
+    return SetCriterionDynamicK(cfg, NUM_CLASSES, matcher, weight_dict={}, eos_coef=0.1, losses=["labels"])
+
+
+def dense_loss_labels(criterion, outputs, targets, indices):
+    """loss_labels with one-hot targets and ``sigmoid_focal_loss_jit``, as it was before the sparse loss."""
+    if criterion.disentangled == 0:
+        src_logits = outputs['pred_logits']
+    else:
+        src_prob = torch.softmax(outputs['pred_logits'], dim=-1) * outputs['pred_objectness']
+        src_logits = torch.log(src_prob / (1 - src_prob))
+
+    if criterion.cfg.TEST.MASK == 2:
+        masked_logit = src_logits.clone()
+        masked_logit[..., list(range(0, criterion.cfg.TEST.PREV_INTRODUCED_CLS))] = -10e10
+        src_logits = masked_logit
+
+    target_classes = torch.full(src_logits.shape[:2], criterion.num_classes, dtype=torch.int64)
+    target_classes_o_list = []
+    for batch_idx, (valid_query, gt_multi_idx) in enumerate(indices):
+        if len(gt_multi_idx) == 0:
+            continue
+        target_classes_o = targets[batch_idx]["labels"]
+        target_classes[batch_idx, valid_query] = target_classes_o[gt_multi_idx]
+        target_classes_o_list.append(target_classes_o[gt_multi_idx])
+    num_boxes = torch.cat(target_classes_o_list).shape[0] if len(target_classes_o_list) != 0 else 1
+
+    target_classes_onehot = torch.zeros(src_logits.shape[:2] + (criterion.num_classes + 1,), dtype=src_logits.dtype)
+    target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
+    cls_loss = sigmoid_focal_loss_jit(src_logits.flatten(0, 1), target_classes_onehot[:, :, :-1].flatten(0, 1),
+                                      alpha=criterion.focal_loss_alpha, gamma=criterion.focal_loss_gamma,
+                                      reduction="none")
+    return torch.sum(cls_loss) / num_boxes
+
+
+def make_batch(seed, bs=3, num_queries=50, empty=()):
+    """Random outputs, targets and a matching with 1 to 8 matched queries per image, none for ``empty``."""
+    g = torch.Generator().manual_seed(seed)
+    outputs = {"pred_logits": torch.randn(bs, num_queries, NUM_CLASSES, generator=g) * 3,
+               "pred_objectness": torch.rand(bs, num_queries, 1, generator=g) * 0.98 + 0.01}
+    targets, indices = [], []
+    for i in range(bs):
+        num_gts = 0 if i in empty else int(torch.randint(1, 6, (1,), generator=g))
+        targets.append({"labels": torch.randint(0, NUM_CLASSES, (num_gts,), generator=g)})
+        valid_query = torch.zeros(num_queries, dtype=torch.bool)
+        if num_gts:
+            valid_query[torch.randperm(num_queries, generator=g)[:int(torch.randint(1, 9, (1,), generator=g))]] = True
+        indices.append((valid_query, torch.randint(0, max(num_gts, 1), (int(valid_query.sum()),), generator=g)))
+    return outputs, targets, indices
+
+
+@pytest.mark.parametrize("empty", [(), (1,), (0, 1, 2)])
+@pytest.mark.parametrize("mask", [0, 1, 2])
+@pytest.mark.parametrize("disentangled", [0, 1, 2])
+def test_sparse_focal_loss_matches_dense(disentangled, mask, empty):
+    criterion = make_criterion(disentangled, mask)
+    for seed in range(3):
+        outputs, targets, indices = make_batch(seed, empty=empty)
+        leaves = [outputs["pred_logits"].requires_grad_(), outputs["pred_objectness"].requires_grad_()]
+
+        criterion._prob_cache = {}
+        loss = criterion.loss_labels(outputs, targets, indices)["loss_ce"]
+        grads = torch.autograd.grad(loss, leaves, allow_unused=True)
+        expected = dense_loss_labels(criterion, outputs, targets, indices)
+        expected_grads = torch.autograd.grad(expected, leaves, allow_unused=True)
+
+        torch.testing.assert_close(loss, expected, rtol=1e-5, atol=1e-6)
+        for grad, expected_grad in zip(grads, expected_grads):
+            if expected_grad is None:
+                assert grad is None or not grad.any()
+            else:
+                torch.testing.assert_close(grad, expected_grad, rtol=1e-4, atol=1e-6)
+
+
+def test_prob_cache_follows_the_logits():
+    criterion = make_criterion(0, 0)
+    first = torch.randn(2, 10, NUM_CLASSES)
+    prob, _ = criterion._get_src_prob({"pred_logits": first})
+    torch.testing.assert_close(prob, first.sigmoid())
+    # other logits get their own probabilities, even at the address of a freed tensor
+    for _ in range(20):
+        logits = torch.randn(2, 10, NUM_CLASSES)
+        torch.testing.assert_close(criterion._get_src_prob({"pred_logits": logits})[0], logits.sigmoid())
@@ -0,0 +1,221 @@
+import pytest
+import torch
+from detectron2.config import get_cfg
+
+from core import add_config
+from core.loss import HungarianMatcherDynamicK, pad_targets
+from core.util.box_ops import box_iou, box_xyxy_to_cxcywh, generalized_box_iou
+
+NUM_CLASSES = 21
+
+
+def make_cfg(sync_free):
+    cfg = get_cfg()
+    add_config(cfg)
+    cfg.MODEL.NUM_CLASSES = NUM_CLASSES
+    cfg.MODEL.NC = True
+    cfg.MODEL.SYNC_FREE = sync_free
+    return cfg
+
+
+def make_batch(seed, bs=4, num_queries=100, max_gt=8, empty=()):
+    """Random predictions and per-image targets, the images in ``empty`` have no gt."""
+    g = torch.Generator().manual_seed(seed)
+    W, H = 320., 256.
+    whwh = torch.tensor([W, H, W, H])
+    xy = torch.rand(bs, num_queries, 2, generator=g) * whwh[:2]
+    boxes = torch.cat([xy, xy + torch.rand(bs, num_queries, 2, generator=g) * 120 + 1], -1)
+    out_prob = torch.randn(bs, num_queries, NUM_CLASSES, generator=g).sigmoid()
+    targets = []
+    for i in range(bs):
+        n = 0 if i in empty else int(torch.randint(1, max_gt + 1, (1,), generator=g))
+        gxy = torch.rand(n, 2, generator=g) * torch.tensor([W - 50, H - 50])
+        gt_boxes = torch.cat([gxy, gxy + torch.rand(n, 2, generator=g) * 100 + 2], -1)
+        targets.append({"labels": torch.randint(0, NUM_CLASSES, (n,), generator=g),
+                        "boxes": box_xyxy_to_cxcywh(gt_boxes / whwh),
+                        "boxes_xyxy": gt_boxes,
+                        "image_size_xyxy": whwh,
+                        "image_size_xyxy_tgt": whwh.repeat(n, 1)})
+    return out_prob, boxes, targets
+
+
+def reference_dynamic_k_matching(matcher, cost, pair_wise_ious, num_gt):
+    """The per-image dynamic-k assignment the batched one replaces."""
+    matching_matrix = torch.zeros_like(cost)
+    topk_ious, _ = torch.topk(pair_wise_ious, matcher.ota_k, dim=0)
+    dynamic_ks = torch.clamp(topk_ious.sum(0).int(), min=1)
+    for gt_idx in range(num_gt):
+        _, pos_idx = torch.topk(cost[:, gt_idx], k=dynamic_ks[gt_idx].item(), largest=False)
+        matching_matrix[:, gt_idx][pos_idx] = 1.0
+
+    anchor_matching_gt = matching_matrix.sum(1)
+    if (anchor_matching_gt > 1).sum() > 0:
+        _, cost_argmin = torch.min(cost[anchor_matching_gt > 1], dim=1)
+        matching_matrix[anchor_matching_gt > 1] *= 0
+        matching_matrix[anchor_matching_gt > 1, cost_argmin] = 1
+
+    rematched = False
+    while (matching_matrix.sum(0) == 0).any():
+        rematched = True
+        cost[matching_matrix.sum(1) > 0] += 100000.0
+        for gt_idx in torch.nonzero(matching_matrix.sum(0) == 0, as_tuple=False).squeeze(1):
+            matching_matrix[:, gt_idx][torch.argmin(cost[:, gt_idx])] = 1.0
+        if (matching_matrix.sum(1) > 1).sum() > 0:
+            _, cost_argmin = torch.min(cost[anchor_matching_gt > 1], dim=1)
+            matching_matrix[anchor_matching_gt > 1] *= 0
+            matching_matrix[anchor_matching_gt > 1, cost_argmin] = 1
+
+    selected_query = matching_matrix.sum(1) > 0
+    gt_indices = matching_matrix[selected_query].max(1)[1]
+    cost[matching_matrix == 0] = cost[matching_matrix == 0] + float('inf')
+    return (selected_query, gt_indices), torch.min(cost, dim=0)[1], rematched
+
+
+def reference_matching(matcher, out_prob, out_bbox, targets):
+    """Match every image on its own, returns indices, matched_ids, the NC unknown queries and the rematch flag."""
+    indices, matched_ids, unknown_queries, rematched = [], [], [], False
+    for batch_idx, target in enumerate(targets):
+        bz_boxes, bz_out_prob = out_bbox[batch_idx], out_prob[batch_idx]
+        bz_tgt_ids = target["labels"]
+        if len(bz_tgt_ids) == 0:
+            indices_batchi = (torch.zeros(bz_out_prob.shape[0]) > 0, torch.arange(0, 0).to(bz_out_prob))
+            matched_qidx = torch.arange(0, 0).to(bz_out_prob)
+        else:
+            bz_gtboxs_abs_xyxy = target["boxes_xyxy"]
+            fg_mask, is_in_boxes_and_center = matcher.get_in_boxes_info(
+                box_xyxy_to_cxcywh(bz_boxes), box_xyxy_to_cxcywh(bz_gtboxs_abs_xyxy), expanded_strides=32)
+            pair_wise_ious = box_iou(bz_boxes, bz_gtboxs_abs_xyxy)[0]
+
+            alpha, gamma = matcher.focal_loss_alpha, matcher.focal_loss_gamma
+            neg_cost_class = (1 - alpha) * (bz_out_prob ** gamma) * (-(1 - bz_out_prob + 1e-8).log())
+            pos_cost_class = alpha * ((1 - bz_out_prob) ** gamma) * (-(bz_out_prob + 1e-8).log())
+            cost_class = pos_cost_class[:, bz_tgt_ids] - neg_cost_class[:, bz_tgt_ids]
+            cost_bbox = torch.cdist(bz_boxes / target["image_size_xyxy"],
+                                    bz_gtboxs_abs_xyxy / target["image_size_xyxy_tgt"], p=1)
+            cost_giou = -generalized_box_iou(bz_boxes, bz_gtboxs_abs_xyxy)
+            cost = matcher.cost_bbox * cost_bbox + matcher.cost_class * cost_class + \
+                matcher.cost_giou * cost_giou + 100.0 * (~is_in_boxes_and_center)
+            cost[~fg_mask] = cost[~fg_mask] + 10000.0
+
+            indices_batchi, matched_qidx, image_rematched = reference_dynamic_k_matching(
+                matcher, cost, pair_wise_ious, len(bz_tgt_ids))
+            rematched |= image_rematched
+        indices.append(indices_batchi)
+        matched_ids.append(matched_qidx)
+
+        _, forward_index = torch.topk(bz_out_prob.sum(1), matcher.forward_k, largest=True, sorted=True)
+        unknown_query = torch.zeros_like(indices_batchi[0])
+        unknown_query[[q for q in forward_index.tolist() if q not in matched_qidx.tolist()]] = True
+        unknown_queries.append(unknown_query)
+    return indices, matched_ids, unknown_queries, rematched
+
+
+BATCHES = [
+    dict(seed=0),
+    dict(seed=1, empty=(1,)),
+    dict(seed=2, empty=(0, 2), max_gt=30),
+    dict(seed=3, empty=(0, 1, 2, 3)),
+    dict(seed=4, bs=1),
+    dict(seed=5, max_gt=40),
+    # few queries for many gts, so gts go unmatched by the top-k and take the rematch path
+    dict(seed=6, num_queries=12, max_gt=10),
+    dict(seed=7, num_queries=12, max_gt=10, empty=(3,)),
+] + [dict(seed=seed, num_queries=[12, 50, 100][seed % 3], max_gt=[4, 10, 30][seed % 3],
+          empty=(seed % 4,) if seed % 2 else ()) for seed in range(8, 40)]
+
+
+@pytest.mark.parametrize("sync_free", [False, True])
+@pytest.mark.parametrize("batch", BATCHES)
+def test_batched_matching_matches_per_image(batch, sync_free):
+    matcher = HungarianMatcherDynamicK(make_cfg(sync_free), cost_class=2.0, cost_bbox=5.0, cost_giou=2.0)
+    out_prob, out_bbox, targets = make_batch(**batch)
+
+    ref_indices, ref_matched_ids, ref_unknowns, _ = reference_matching(matcher, out_prob, out_bbox, targets)
+    padded_targets = pad_targets(targets)
+    indices, matched_ids, matched_query = matcher.batched_matching(out_prob, out_bbox, padded_targets)
+    ow_indices, unknown_targets = matcher.select_unknowns(out_prob, matched_query, padded_targets)
+
+    for i, target in enumerate(targets):
+        (selected_query, gt_indices), (ref_selected_query, ref_gt_indices) = indices[i], ref_indices[i]
+        assert torch.equal(selected_query, ref_selected_query)
+        if sync_free and len(target["labels"]):
+            # every query holds a gt index, only the selected ones are meaningful
+            assert gt_indices.shape == selected_query.shape
+            gt_indices = gt_indices[selected_query]
+        assert torch.equal(gt_indices, ref_gt_indices) and gt_indices.dtype == ref_gt_indices.dtype
+        assert torch.equal(matched_ids[i], ref_matched_ids[i]) and matched_ids[i].dtype == ref_matched_ids[i].dtype
+
+        unknown_query, unknown_gt_indices = ow_indices[i]
+        assert torch.equal(unknown_query, ref_unknowns[i])
+        labels = unknown_targets[i]["labels"]
+        assert (labels == NUM_CLASSES - 1).all()
+        assert torch.equal(unknown_targets[i]["boxes"], target["image_size_xyxy"].expand(len(labels), 4))
+        if sync_free:
+            assert len(labels) == 1 and unknown_gt_indices.shape == unknown_query.shape
+        else:
+            assert len(labels) == int(ref_unknowns[i].sum())
+        assert (unknown_gt_indices == 0).all()
+
+
+def test_batches_take_rematch_path():
+    """Keep the rematch cases above honest: some of the batches have to leave gts unmatched after the top-k."""
+    matcher = HungarianMatcherDynamicK(make_cfg(False), cost_class=2.0, cost_bbox=5.0, cost_giou=2.0)
+    assert any(reference_matching(matcher, *make_batch(**batch))[3] for batch in BATCHES)
+
+
+def reference_select_unknowns(matcher, out_prob, matched_ids, targets):
+    """The NC pseudo targets, image by image from the matched query ids, as before select_unknowns."""
+    ow_indices, unknown_targets = [], []
+    for i, target in enumerate(targets):
+        _, forward_index = torch.topk(torch.sum(out_prob[i], dim=1), matcher.forward_k, largest=True, sorted=True)
+        unknown_label = [each for each in forward_index.tolist() if each not in matched_ids[i].tolist()]
+        unknown_query = torch.zeros(out_prob.shape[1], dtype=torch.bool)
+        unknown_query[unknown_label] = True
+        ow_indices.append((unknown_query, torch.tensor([0] * len(unknown_label), dtype=torch.long)))
+        unity_boxes = target['image_size_xyxy'].unsqueeze(0).repeat(len(unknown_label), 1)
+        unknown_targets.append({'labels': torch.tensor([NUM_CLASSES - 1] * len(unknown_label), dtype=torch.long),
+                                'boxes': unity_boxes,
+                                'image_size_xyxy': target['image_size_xyxy'],
+                                'boxes_xyxy': unity_boxes,
+                                'image_size_xyxy_tgt': unity_boxes,
+                                'area': unity_boxes})
+    return ow_indices, unknown_targets
+
+
+@pytest.mark.parametrize("sync_free", [False, True])
+@pytest.mark.parametrize("forward_k", [1, 10, 12])
+@pytest.mark.parametrize("batch", [dict(seed=0, empty=(1,)), dict(seed=1, empty=(0, 1, 2, 3)),
+                                   dict(seed=2, num_queries=12, max_gt=10), dict(seed=3, max_gt=30, empty=(2,))])
+def test_select_unknowns_matches_per_image(batch, forward_k, sync_free):
+    cfg = make_cfg(sync_free)
+    cfg.MODEL.FORWARD_K = forward_k
+    matcher = HungarianMatcherDynamicK(cfg, cost_class=2.0, cost_bbox=5.0, cost_giou=2.0)
+    out_prob, out_bbox, targets = make_batch(**batch)
+    padded_targets = pad_targets(targets)
+    _, matched_ids, matched_query = matcher.batched_matching(out_prob, out_bbox, padded_targets)
+    # every top-k query of the last image is matched, it gets no unknown at all
+    _, forward_index = torch.topk(out_prob[-1].sum(1), forward_k)
+    matched_ids[-1] = torch.cat([matched_ids[-1], forward_index])
+    matched_query[-1, forward_index] = True
+
+    ow_indices, unknown_targets = matcher.select_unknowns(out_prob, matched_query, padded_targets)
+    ref_ow_indices, ref_unknown_targets = reference_select_unknowns(matcher, out_prob, matched_ids, targets)
+
+    assert not ref_ow_indices[-1][0].any()
+    for i, target in enumerate(targets):
+        (unknown_query, gt_indices), (ref_unknown_query, ref_gt_indices) = ow_indices[i], ref_ow_indices[i]
+        assert torch.equal(unknown_query, ref_unknown_query)
+        unknown_target, ref_unknown_target = unknown_targets[i], ref_unknown_targets[i]
+        assert set(unknown_target) == set(ref_unknown_target)
+        if sync_free:
+            # a single whole-image target that every query points at
+            assert torch.equal(gt_indices, torch.zeros(len(unknown_query), dtype=torch.long))
+            for key, value in ref_unknown_target.items():
+                expected = value if key == 'image_size_xyxy' else target['image_size_xyxy'].expand(1, 4)
+                if key == 'labels':
+                    expected = torch.tensor([NUM_CLASSES - 1])
+                assert torch.equal(unknown_target[key], expected)
+        else:
+            assert torch.equal(gt_indices, ref_gt_indices) and gt_indices.dtype == ref_gt_indices.dtype
+            for key, value in ref_unknown_target.items():
+                assert torch.equal(unknown_target[key], value) and unknown_target[key].dtype == value.dtype
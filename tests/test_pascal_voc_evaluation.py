@@ -0,0 +1,174 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+
+from core.pascal_voc import VOC_COCO_CLASS_NAMES, VOCAnnotationStore
+from core.pascal_voc_evaluation import voc_eval
+
+CLASS_NAMES = VOC_COCO_CLASS_NAMES["M-OWODB"]
+COCO_SPELLINGS = ["airplane", "dining table", "motorcycle", "potted plant", "couch", "tv"]
+
+
+def parse_rec(filename, known_classes):
+    """Parse a PASCAL VOC xml file, as the evaluator did before VOCAnnotationStore."""
+    VOC_CLASS_NAMES_COCOFIED = [
+        "airplane", "dining table", "motorcycle",
+        "potted plant", "couch", "tv"
+    ]
+    BASE_VOC_CLASS_NAMES = [
+        "aeroplane", "diningtable", "motorbike",
+        "pottedplant", "sofa", "tvmonitor"
+    ]
+    try:
+        with open(filename) as f:
+            tree = ET.parse(f)
+    except Exception:
+        return None
+
+    objects = []
+    for obj in tree.findall("object"):
+        obj_struct = {}
+        cls_name = obj.find("name").text
+        if cls_name in VOC_CLASS_NAMES_COCOFIED:
+            cls_name = BASE_VOC_CLASS_NAMES[VOC_CLASS_NAMES_COCOFIED.index(cls_name)]
+        if cls_name not in known_classes:
+            cls_name = 'unknown'
+        obj_struct["name"] = cls_name
+        obj_struct["difficult"] = int(obj.find("difficult").text)
+        bbox = obj.find("bndbox")
+        obj_struct["bbox"] = [int(bbox.find(x).text) for x in ["xmin", "ymin", "xmax", "ymax"]]
+        objects.append(obj_struct)
+    return objects
+
+
+class ParsedAnnotations:
+    """The ground truth of an image set file the way voc_eval read it with parse_rec, as a VOCAnnotationStore."""
+
+    def __init__(self, dirname, split):
+        with open(os.path.join(dirname, "ImageSets", "Main", split + ".txt")) as f:
+            self.imagenames = [x.strip() for x in f.readlines()]
+        self.annopath = os.path.join(dirname, "Annotations", "{}.xml")
+
+    def eval_image_ids(self):
+        imagenames, mapping = [], {}
+        for imagename in self.imagenames:
+            if os.path.exists(self.annopath.format(imagename)) and int(imagename) not in mapping:
+                imagenames.append(imagename)
+                mapping[int(imagename)] = imagename
+        return imagenames
+
+    def class_records(self, classname, known_classes, image_ids):
+        class_recs = {}
+        for imagename in image_ids:
+            R = [obj for obj in parse_rec(self.annopath.format(imagename), tuple(known_classes))
+                 if obj["name"] == classname]
+            class_recs[imagename] = {"bbox": np.array([x["bbox"] for x in R]),
+                                     "difficult": np.array([x["difficult"] for x in R]).astype(np.bool_)}
+        return class_recs
+
+
+def write_dataset(root, seed=0):
+    """
+    VOC annotation files with difficult boxes, COCO spellings of VOC classes, classes of later tasks, images
+    without objects, an image set entry without a file and two files of the same integer id.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, "Annotations"))
+    os.makedirs(os.path.join(root, "ImageSets", "Main"))
+    file_ids = ["%06d" % (i * 3 + 1) for i in range(40)] + ["00004", "999999"]
+    for i, file_id in enumerate(file_ids[:-1]):
+        objects = []
+        for _ in range(0 if i % 7 == 0 else rng.randint(1, 6)):
+            name = COCO_SPELLINGS[rng.randint(6)] if rng.rand() < 0.2 else CLASS_NAMES[rng.randint(80)]
+            x0, y0 = rng.randint(1, 300, 2)
+            w, h = rng.randint(10, 200, 2)
+            objects.append("<object><name>{}</name><difficult>{}</difficult><bndbox><xmin>{}</xmin>"
+                           "<ymin>{}</ymin><xmax>{}</xmax><ymax>{}</ymax></bndbox></object>".format(
+                               name, int(rng.rand() < 0.2), x0, y0, x0 + w, y0 + h))
+        with open(os.path.join(root, "Annotations", file_id + ".xml"), "w") as f:
+            f.write("<annotation><size><width>500</width><height>375</height></size>{}</annotation>".format(
+                "".join(objects)))
+    rng.shuffle(file_ids)
+    with open(os.path.join(root, "ImageSets", "Main", "test.txt"), "w") as f:
+        f.write("\n".join(file_ids) + "\n")
+    return file_ids
+
+
+def write_detections(path, classnames, annotations, known_classes, seed=0):
+    """Noisy copies of the ground truth of every class plus random boxes, in the format voc_eval reads."""
+    rng = np.random.RandomState(seed)
+    image_ids = annotations.eval_image_ids()
+    for classname in classnames:
+        lines = []
+        # detections of other classes' boxes too, so the unknown ones are hit
+        for other in (classname, "unknown"):
+            for image_id, R in annotations.class_records(other, known_classes, image_ids).items():
+                for box in R["bbox"]:
+                    box = box + rng.randint(-15, 16, 4)
+                    lines.append("{} {:.3f} {} {} {} {}".format(image_id, rng.rand(), *box))
+        for _ in range(30):
+            x0, y0 = rng.randint(1, 300, 2)
+            lines.append("{} {:.3f} {} {} {} {}".format(
+                image_ids[rng.randint(len(image_ids))], rng.rand(), x0, y0, x0 + 100, y0 + 80))
+        with open(path.format(classname), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+@pytest.fixture
+def voc_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(VOCAnnotationStore, "_stores", {})
+    root = str(tmp_path / "voc")
+    return root, write_dataset(root)
+
+
+@pytest.mark.parametrize("num_known", [20, 40, 80])
+def test_class_records_match_parse_rec(voc_dir, num_known):
+    root, _ = voc_dir
+    known_classes = CLASS_NAMES[:num_known]
+    store, parsed = VOCAnnotationStore.get(root, "test"), ParsedAnnotations(root, "test")
+
+    image_ids = parsed.eval_image_ids()
+    assert store.eval_image_ids() == image_ids
+    # only the first file of an integer id is evaluated, and only images with a file
+    assert ("000004" in image_ids) != ("00004" in image_ids) and "999999" not in image_ids
+
+    num_boxes = 0
+    for classname in set(CLASS_NAMES):
+        records = store.class_records(classname, known_classes, image_ids)
+        expected = parsed.class_records(classname, known_classes, image_ids)
+        assert list(records) == list(expected)
+        for image_id in image_ids:
+            bbox, expected_bbox = records[image_id]["bbox"], expected[image_id]["bbox"]
+            # without ground truth the store gives (0, 4) boxes where parse_rec gave (0,)
+            assert bbox.shape == (len(expected_bbox), 4)
+            np.testing.assert_array_equal(bbox, expected_bbox.reshape(-1, 4))
+            np.testing.assert_array_equal(records[image_id]["difficult"], expected[image_id]["difficult"])
+            num_boxes += len(bbox)
+    assert num_boxes > 0
+
+
+@pytest.mark.parametrize("num_known", [20, 40])
+def test_voc_eval_matches_parse_rec(voc_dir, tmp_path, num_known):
+    root, _ = voc_dir
+    known_classes = CLASS_NAMES[:num_known]
+    store, parsed = VOCAnnotationStore.get(root, "test"), ParsedAnnotations(root, "test")
+    detpath = str(tmp_path / "det_{}.txt")
+    classnames = list(known_classes) + ["unknown"]
+    write_detections(detpath, classnames, parsed, known_classes)
+
+    logging.disable(logging.INFO)
+    try:
+        for classname in classnames:
+            results = voc_eval(detpath, store, classname, 0.5, False, known_classes)
+            expected = voc_eval(detpath, parsed, classname, 0.5, False, known_classes)
+            assert len(results) == len(expected)
+            for result, expected_result in zip(results, expected):
+                if expected_result is None:
+                    assert result is None
+                else:
+                    np.testing.assert_array_equal(result, expected_result)
+    finally:
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+import torch
+
+from core.util.sync_debug import _CONVERSIONS, SyncCounter
+
+PATCHED = _CONVERSIONS + ("__getitem__", "__setitem__")
+
+
+def tensor_methods():
+    return {name: torch.Tensor.__dict__.get(name) for name in PATCHED}
+
+
+def test_counts_conversions_and_mask_indexing():
+    x = torch.arange(6.)
+    with SyncCounter(use_cuda=False) as counter:
+        x.sum().item()
+        x[x > 2]
+        x[1:3]  # slicing doesn't sync
+        bool(x.any())
+    assert counter.total == 3
+
+
+@pytest.mark.parametrize("nested", [False, True])
+def test_methods_are_restored_after_an_exception(nested):
+    methods = tensor_methods()
+    with pytest.raises(RuntimeError, match="in the loss"):
+        with SyncCounter(use_cuda=False) as counter:
+            torch.ones(1).item()
+            if nested:
+                with SyncCounter(use_cuda=False):
+                    raise RuntimeError("in the loss")
+            raise RuntimeError("in the loss")
+    assert tensor_methods() == methods
+    assert counter.total == 1
+    # the lock is released, another thread can count
+    thread = threading.Thread(target=lambda: SyncCounter(use_cuda=False).__enter__().__exit__(None, None, None))
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert tensor_methods() == methods
+
+
+def test_other_threads_are_not_counted():
+    with SyncCounter(use_cuda=False) as counter:
+        thread = threading.Thread(target=lambda: [torch.ones(1).item() for _ in range(10)])
+        thread.start()
+        thread.join()
+        torch.ones(1).item()
+    assert counter.total == 1
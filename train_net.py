@@ -12,7 +12,7 @@ import detectron2.utils.comm as comm
 from detectron2.utils.logger import setup_logger
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
-from detectron2.data import build_detection_train_loader
+from detectron2.data import build_detection_train_loader, build_detection_test_loader
 from detectron2.engine import DefaultTrainer, default_argument_parser, default_setup, launch, create_ddp_model, \
     AMPTrainer, SimpleTrainer, hooks
 from detectron2.evaluation import COCOEvaluator, LVISEvaluator, verify_results
@@ -20,6 +20,8 @@ from detectron2.solver.build import maybe_add_gradient_clipping
 from detectron2.modeling import build_model
 
 from core import DatasetMapper, add_config
+from core.batching import build_bucketed_test_loader, build_bucketed_train_loader
+from core.image_shards import build_sharded_train_loader
 from core.util.model_ema import add_model_ema_configs, may_build_model_ema, may_get_ema_checkpointer, EMAHook, \
     apply_model_ema_and_restore, EMADetectionCheckpointer
 from core.pascal_voc import register_pascal_voc
@@ -125,8 +127,21 @@ class Trainer(DefaultTrainer):
     @classmethod
     def build_train_loader(cls, cfg):
         mapper = DatasetMapper(cfg, is_train=True)
+        if cfg.DATALOADER.IMAGE_SHARD_DIR:
+            data_loader = build_sharded_train_loader(cfg, mapper)
+            if data_loader is not None:
+                return data_loader
+        if cfg.DATALOADER.BUCKETED_BATCHING:
+            return build_bucketed_train_loader(cfg, mapper)
         return build_detection_train_loader(cfg, mapper=mapper)
 
+    @classmethod
+    def build_test_loader(cls, cfg, dataset_name):
+        mapper = DatasetMapper(cfg, is_train=False)
+        if cfg.TEST.IMS_PER_BATCH > 1:
+            return build_bucketed_test_loader(cfg, dataset_name, mapper)
+        return build_detection_test_loader(cfg, dataset_name, mapper=mapper)
+
     @classmethod
     def build_optimizer(cls, cfg, model):
         params: List[Dict[str, Any]] = []